@@ -5,6 +5,7 @@ import * as ec2 from 'aws-cdk-lib/aws-ec2';
 import {Platform} from 'aws-cdk-lib/aws-ecr-assets';
 import * as ecs from 'aws-cdk-lib/aws-ecs';
 import * as elbv2 from 'aws-cdk-lib/aws-elasticloadbalancingv2';
+import * as iam from 'aws-cdk-lib/aws-iam';
 import * as route53 from 'aws-cdk-lib/aws-route53';
 import * as route53Targets from 'aws-cdk-lib/aws-route53-targets';
 import * as secrets from 'aws-cdk-lib/aws-secretsmanager';
@@ -67,6 +68,13 @@ export class MomentoVectorIndexChatDemoStack extends cdk.Stack {
       });
     }
 
+    // Full reindexes build a new index generation and flip the index alias to it. The alias is
+    // kept in a Momento cache, which the Momento API key of both apps can read and write, so
+    // that every container of both apps serves the same generation across restarts and
+    // scale-outs rather than falling back to the bare index name.
+    const momentoIndexName = 'momento';
+    const indexAliasCacheName = 'robomo-index-aliases';
+
     this.addEcsApp({
       appName: 'mvi-chat-demo',
       chatSubdomain: props.streamlitDemoSubdomain,
@@ -77,6 +85,8 @@ export class MomentoVectorIndexChatDemoStack extends cdk.Stack {
         STREAMLIT_SERVER_ADDRESS: '0.0.0.0',
         STREAMLIT_SERVER_PORT: `${80}`,
         STREAMLIT_SERVER_HEADLESS: 'true',
+        MOMENTO_INDEX_NAME: momentoIndexName,
+        INDEX_ALIAS_CACHE_NAME: indexAliasCacheName,
       },
       dockerCommand: [
         'poetry',
@@ -91,7 +101,6 @@ export class MomentoVectorIndexChatDemoStack extends cdk.Stack {
       momentoApiKeySecret,
     });
 
-    const momentoIndexName = 'momento';
     this.addEcsApp({
       appName: 'langserve-robomo',
       chatSubdomain: props.langserveDemoSubdomain,
@@ -100,6 +109,7 @@ export class MomentoVectorIndexChatDemoStack extends cdk.Stack {
       dockerFilePath: '../robo-mo-langserve',
       additionalEnvVars: {
         MOMENTO_INDEX_NAME: momentoIndexName,
+        INDEX_ALIAS_CACHE_NAME: indexAliasCacheName,
       },
       vpc,
       hostedZone,
@@ -204,6 +214,15 @@ export class MomentoVectorIndexChatDemoStack extends cdk.Stack {
     );
     options.openAiApiKeySecret.grantRead(chatDemoTaskDefinition.taskRole);
     options.momentoApiKeySecret.grantRead(chatDemoTaskDefinition.taskRole);
+    // The apps fetch both secrets in one BatchGetSecretValue call, which cannot be scoped to
+    // resources; GetSecretValue is still checked for each secret it returns.
+    chatDemoTaskDefinition.addToTaskRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ['secretsmanager:BatchGetSecretValue'],
+        resources: ['*'],
+      })
+    );
 
     chatDemoTaskDefinition.addContainer(`${options.appName}-container`, {
       containerName: options.appName,
@@ -0,0 +1,167 @@
+"""
+Admission control for the chain endpoints.
+
+A burst of questions would otherwise all run retrieval and the LLM at once and exhaust the
+OpenAI rate limit for everyone. `AdmissionMiddleware` lets at most `ADMISSION_MAX_CONCURRENCY`
+requests to the chain run at a time and queues up to `ADMISSION_MAX_QUEUE` more, first come
+first served. A request that cannot be queued, or waits longer than
+`ADMISSION_QUEUE_TIMEOUT_SECONDS`, is shed with a 429 and a `Retry-After` estimated from the
+queue and recent request durations. A request holds its slot until its response, including a
+stream, is complete.
+"""
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, MutableMapping
+
+from rag_momento_vector_index.metrics import ADMISSION_REQUESTS, ADMISSION_WAIT_SECONDS
+
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", "32"))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", "128"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", "10"))
+# Weight of the latest request in the moving average of request durations.
+DURATION_SMOOTHING = 0.1
+
+Scope = MutableMapping[str, Any]
+Message = MutableMapping[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+
+class Overloaded(Exception):
+    def __init__(self, reason: str, retry_after_seconds: int):
+        super().__init__(f"Overloaded ({reason}), retry after {retry_after_seconds}s.")
+        self.reason = reason
+        self.retry_after_seconds = retry_after_seconds
+
+
+class AdmissionController:
+    """A FIFO concurrency limiter with a bounded queue and a deadline for waiting in it.
+
+    Args:
+        max_concurrency (int): How many requests may run at once.
+        max_queue (int): How many more may wait for one of them to finish.
+        queue_timeout_seconds (float): The longest a request waits before it is shed.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = ADMISSION_MAX_CONCURRENCY,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        queue_timeout_seconds: float = ADMISSION_QUEUE_TIMEOUT_SECONDS,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.active = 0
+        self.mean_duration_seconds = 1.0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for waiter in self._waiters if not waiter.done())
+
+    def retry_after_seconds(self) -> int:
+        """How long until a request arriving now would likely be admitted."""
+        wait = (self.queued + 1) * self.mean_duration_seconds / max(1, self.max_concurrency)
+        return max(1, math.ceil(wait))
+
+    async def acquire(self) -> float:
+        """Waits for a slot and returns how long that took.
+
+        Raises:
+            Overloaded: If the queue is full or the wait exceeded `queue_timeout_seconds`.
+        """
+        if self.active < self.max_concurrency and not self.queued:
+            self.active += 1
+            return 0.0
+        if self.queued >= self.max_queue:
+            raise Overloaded("queue_full", self.retry_after_seconds())
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            self._forget(waiter)
+            raise Overloaded("timeout", self.retry_after_seconds()) from None
+        except asyncio.CancelledError:
+            # The slot may have been handed over just as the client went away.
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            self._forget(waiter)
+            raise
+        return time.perf_counter() - start
+
+    def _forget(self, waiter: asyncio.Future) -> None:
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self, duration_seconds: float = 0.0) -> None:
+        """Frees a slot, handing it to the longest waiting request if there is one."""
+        if duration_seconds:
+            self.mean_duration_seconds += DURATION_SMOOTHING * (duration_seconds - self.mean_duration_seconds)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict[str, float]:
+        return {"active": self.active, "queued": self.queued, "mean_duration_seconds": self.mean_duration_seconds}
+
+
+class AdmissionMiddleware:
+    """ASGI middleware that admits `POST` requests under `path_prefix` through `controller`.
+
+    Args:
+        app (ASGIApp): The app to wrap.
+        controller (AdmissionController): Limits the requests.
+        path_prefix (str): The path of the endpoints to limit.
+    """
+
+    def __init__(self, app: ASGIApp, controller: AdmissionController, path_prefix: str):
+        self.app = app
+        self.controller = controller
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].startswith(self.path_prefix)
+            or self.controller.max_concurrency <= 0
+        ):
+            await self.app(scope, receive, send)
+            return
+        try:
+            waited = await self.controller.acquire()
+        except Overloaded as e:
+            ADMISSION_REQUESTS.inc(outcome=f"shed_{e.reason}")
+            await self._reject(send, e)
+            return
+        ADMISSION_REQUESTS.inc(outcome="admitted")
+        ADMISSION_WAIT_SECONDS.observe(waited)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(time.perf_counter() - start)
+
+    @staticmethod
+    async def _reject(send: Send, overloaded: Overloaded) -> None:
+        body = json.dumps({"detail": str(overloaded)}).encode("utf-8")
+        headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(overloaded.retry_after_seconds).encode()),
+        ]
+        await send({"type": "http.response.start", "status": 429, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
@@ -1,39 +1,242 @@
+"""
+Fetches the API keys of the app and keeps them current when they are rotated.
+
+`SecretProvider` fetches all of its secrets from AWS Secrets Manager in one `BatchGetSecretValue`
+call, serves them from memory and refreshes them every `SECRETS_TTL_SECONDS` on a background
+thread. Listeners registered with `on_rotate` are told which keys changed, so that the clients
+built with the old keys can be rebuilt without a restart.
+
+A key that is set as an environment variable takes precedence and is never refreshed. For
+offline testing, `SECRETS_FILE` can point at a JSON file of secret values by secret name, which
+stands in for Secrets Manager and is read again on every refresh.
+
+This module is shared by the langserve app and the Streamlit chatbot and is kept identical in both.
+"""
+import json
+import logging
 import os
-from typing import Optional
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from typing import Any, Callable, Optional
 
-import boto3  # type: ignore[import]
-from botocore.exceptions import ClientError  # type: ignore[import]
+logger = logging.getLogger(__name__)
 
+SECRETS_TTL_SECONDS = float(os.environ.get("SECRETS_TTL_SECONDS", "300"))
+SECRETS_FILE = os.environ.get("SECRETS_FILE")
 
-def get_secret_from_secrets_manager(secret_name: str, region_name: str = "us-west-2") -> str:
-    # Create a Secrets Manager client
-    client = boto3.Session().client(service_name="secretsmanager", region_name=region_name)
 
-    get_secret_value_response: dict[str, str] | None = None
+class SecretSource(ABC):
+    """Where secrets are fetched from."""
+
+    @abstractmethod
+    def fetch(self, secret_names: list[str]) -> dict[str, str]:
+        """Returns the value of each of `secret_names`, raising if any of them cannot be fetched."""
+
+
+class SecretsManagerSource(SecretSource):
+    """Fetches secrets from AWS Secrets Manager, in a single request where possible.
+
+    Falls back to a `GetSecretValue` call per secret if `BatchGetSecretValue` is not available,
+    either because botocore predates it or because the role may not call it.
+    """
+
+    def __init__(self, region_name: str = "us-west-2"):
+        self.region_name = region_name
+        self.batch = True
+
+    @cached_property
+    def client(self) -> Any:
+        # boto3 is slow to import and only needed when secrets are not in the environment.
+        import boto3  # type: ignore[import]
+
+        return boto3.Session().client(service_name="secretsmanager", region_name=self.region_name)
+
+    def fetch(self, secret_names: list[str]) -> dict[str, str]:
+        from botocore.exceptions import ClientError  # type: ignore[import]
+
+        if self.batch and hasattr(self.client, "batch_get_secret_value"):
+            try:
+                return self._batch_get(secret_names)
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "AccessDeniedException":
+                    raise
+                logger.warning("Not allowed to call BatchGetSecretValue, fetching secrets one at a time.")
+                self.batch = False
+        with ThreadPoolExecutor(max_workers=max(1, len(secret_names))) as executor:
+            return dict(zip(secret_names, executor.map(self._get, secret_names), strict=True))
+
+    def _batch_get(self, secret_names: list[str]) -> dict[str, str]:
+        values: dict[str, str] = {}
+        request: dict[str, Any] = {"SecretIdList": secret_names}
+        while True:
+            response = self.client.batch_get_secret_value(**request)
+            for error in response.get("Errors", []):
+                raise ValueError(f"Could not fetch secret {error['SecretId']}: {error['ErrorCode']} {error['Message']}")
+            for secret in response.get("SecretValues", []):
+                if "SecretString" not in secret:
+                    raise ValueError(f"Secret {secret['Name']} is not a string.")
+                # Secrets may have been requested by name or by ARN.
+                name = secret["Name"] if secret["Name"] in secret_names else secret["ARN"]
+                values[name] = secret["SecretString"]
+            if "NextToken" not in response:
+                break
+            request["NextToken"] = response["NextToken"]
+        if missing := set(secret_names) - values.keys():
+            raise ValueError(f"Secrets {', '.join(sorted(missing))} were not returned.")
+        return values
+
+    def _get(self, secret_name: str) -> str:
+        response = self.client.get_secret_value(SecretId=secret_name)
+        # Depending on whether the secret is a string or binary, one of these fields will be populated.
+        if "SecretString" not in response:
+            raise ValueError(f"Secret {secret_name} is not a string.")
+        return response["SecretString"]
+
+
+class FileSecretSource(SecretSource):
+    """Reads secrets from a JSON object of secret values by secret name, for offline testing.
+
+    The file is read on every fetch, so editing it simulates a rotation.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def fetch(self, secret_names: list[str]) -> dict[str, str]:
+        with open(self.path) as f:
+            secrets = json.load(f)
+        if missing := [name for name in secret_names if name not in secrets]:
+            raise ValueError(f"Secrets {', '.join(missing)} are not in {self.path}.")
+        return {name: secrets[name] for name in secret_names}
 
-    try:
-        get_secret_value_response = client.get_secret_value(SecretId=secret_name)
-    except ClientError as e:
-        if e.response["Error"]["Code"] == "DecryptionFailureException":
-            raise e
-        elif e.response["Error"]["Code"] == "InternalServiceErrorException":
-            raise e
-        elif e.response["Error"]["Code"] == "InvalidParameterException":
-            raise e
-        elif e.response["Error"]["Code"] == "InvalidRequestException":
-            raise e
-        elif e.response["Error"]["Code"] == "ResourceNotFoundException":
-            raise e
 
-    # Decrypts secret using the associated KMS CMK.
-    # Depending on whether the secret is a string or binary, one of these fields will be populated.
-    if get_secret_value_response is None:
-        raise ValueError("Secret value is None. This resource possibly does not have permissions.")
+def create_secret_source(aws_region: Optional[str] = None) -> SecretSource:
+    """Returns the `SECRETS_FILE` stand-in if it is set, otherwise Secrets Manager in `aws_region`."""
+    if SECRETS_FILE:
+        return FileSecretSource(SECRETS_FILE)
+    if aws_region is None:
+        raise ValueError("No AWS region specified")
+    return SecretsManagerSource(aws_region)
+
+
+class SecretProvider:
+    """Serves secrets from memory and refreshes them in the background.
+
+    Args:
+        secret_names (dict[str, Optional[str]]): The name of the environment variable of each
+            secret, mapped to its name in the secret source. A secret whose environment variable
+            is set when the provider is created is taken from there instead.
+        aws_region (Optional[str], optional): The AWS region to fetch the secrets from. Defaults to None.
+        source (Optional[SecretSource], optional): Where the secrets are fetched from. Defaults
+            to `create_secret_source(aws_region)`, created when first needed.
+        ttl_seconds (float, optional): How often the secrets are fetched again once `start` is
+            called. Defaults to `SECRETS_TTL_SECONDS`.
+        export_to_environ (bool, optional): Whether to also set the fetched secrets as environment
+            variables, for clients that read their keys from there. Defaults to False.
+
+    Raises:
+        ValueError: If a secret is neither set in the environment nor named in the secret source.
+    """
+
+    def __init__(
+        self,
+        secret_names: dict[str, Optional[str]],
+        aws_region: Optional[str] = None,
+        source: Optional[SecretSource] = None,
+        ttl_seconds: float = SECRETS_TTL_SECONDS,
+        export_to_environ: bool = False,
+    ):
+        self.aws_region = aws_region
+        self.ttl_seconds = ttl_seconds
+        self.export_to_environ = export_to_environ
+        self._source = source
+        self._static = {name: value for name in secret_names if (value := os.environ.get(name)) is not None}
+        self._fetched_names: dict[str, str] = {}
+        for env_var_name, secret_name in secret_names.items():
+            if env_var_name in self._static:
+                continue
+            if secret_name is None:
+                raise ValueError(f"No secret specified for {env_var_name}")
+            self._fetched_names[env_var_name] = secret_name
+        self._values: Optional[dict[str, str]] = None
+        self._lock = threading.Lock()
+        self._listeners: list[Callable[[list[str]], None]] = []
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def source(self) -> SecretSource:
+        if self._source is None:
+            self._source = create_secret_source(self.aws_region)
+        return self._source
 
-    if "SecretString" not in get_secret_value_response:
-        raise ValueError("Secret value is not a string.")
+    def get(self, env_var_name: str) -> str:
+        """Returns the current value of the secret for `env_var_name`."""
+        if env_var_name in self._static:
+            return self._static[env_var_name]
+        if self._values is None:
+            self.refresh()
+        assert self._values is not None
+        return self._values[env_var_name]
 
-    return get_secret_value_response["SecretString"]
+    def get_all(self) -> dict[str, str]:
+        """Returns the current value of every secret by environment variable name."""
+        return {name: self.get(name) for name in [*self._static, *self._fetched_names]}
+
+    def on_rotate(self, listener: Callable[[list[str]], None]) -> None:
+        """Calls `listener` with the environment variable names of the secrets that changed,
+        after every refresh that changed any."""
+        self._listeners.append(listener)
+
+    def refresh(self) -> list[str]:
+        """Fetches the secrets again and returns the names of those that changed."""
+        with self._lock:
+            previous = self._values
+            if self._fetched_names:
+                fetched = self.source.fetch(list(dict.fromkeys(self._fetched_names.values())))
+            else:
+                fetched = {}
+            values = {name: fetched[secret_name] for name, secret_name in self._fetched_names.items()}
+            if self.export_to_environ:
+                os.environ.update(values)
+            self._values = values
+        if previous is None:
+            return []
+        changed = [name for name, value in values.items() if previous.get(name) != value]
+        if changed:
+            logger.info(f"Secrets rotated: {', '.join(changed)}")
+            for listener in self._listeners:
+                try:
+                    listener(changed)
+                except Exception:
+                    logger.exception(f"Rebuilding clients after rotating {', '.join(changed)} failed.")
+        return changed
+
+    def start(self) -> None:
+        """Starts refreshing the secrets every `ttl_seconds` on a daemon thread. A failed
+        refresh is logged and the last fetched values keep being served."""
+        if self._thread is not None or not self._fetched_names or self.ttl_seconds <= 0:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._refresh_periodically, name="secret-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread = None
+
+    def _refresh_periodically(self) -> None:
+        while not self._stopped.wait(self.ttl_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Refreshing secrets failed, still using the previous values: {e}")
+
+
+def get_secret_from_secrets_manager(secret_name: str, region_name: str = "us-west-2") -> str:
+    return SecretsManagerSource(region_name).fetch([secret_name])[secret_name]
 
 
 def get_secret_from_env_var_or_secrets_manager(
@@ -44,17 +247,18 @@ def get_secret_from_env_var_or_secrets_manager(
     """Fetches a secret from either an environment variable or AWS Secrets Manager.
 
     First checks if the secret is available as an environment variable. If not, then
-    the secret is fetched from AWS Secrets Manager.
+    the secret is fetched from AWS Secrets Manager, or from `SECRETS_FILE` if it is set.
+    Use `SecretProvider` for secrets that should be refreshed.
 
     Args:
         secret_env_var_name (Optional[str], optional): The name of the environment variable to check. Defaults to None.
         secret_name (Optional[str], optional): The name of the secret in AWS Secrets Manager. Defaults to None.
-        aws_region (Optional[str], optional): The AWS region to use to check for the secret. Defaults to None.
+        aws_region (Optional[str], optional): The AWS region to check for the secret. Defaults to None.
 
     Raises:
         ValueError: If no secret is specified, ie both secret_env_var_name and (secret_name or aws_region) are None.
     Returns:
-        str: _description_
+        str: The value of the secret.
     """
     if secret_env_var_name is not None:
         value = os.getenv(secret_env_var_name)
@@ -62,10 +266,4 @@ def get_secret_from_env_var_or_secrets_manager(
             return value
     if secret_name is None:
         raise ValueError("No secret specified")
-    if aws_region is None:
-        raise ValueError("No AWS region specified")
-
-    return get_secret_from_secrets_manager(
-        secret_name=secret_name,
-        region_name=aws_region,
-    )
+    return create_secret_source(aws_region).fetch([secret_name])[secret_name]
@@ -1,29 +1,73 @@
+import json
 import os
+from contextlib import asynccontextmanager
 
 import uvicorn
-from fastapi import BackgroundTasks, FastAPI
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse, StreamingResponse
 from langserve import add_routes
+from pydantic import BaseModel
 
-from .secrets import get_secret_from_env_var_or_secrets_manager
+from .secrets import SecretProvider
 
-os.environ["MOMENTO_API_KEY"] = get_secret_from_env_var_or_secrets_manager(
-    secret_env_var_name="MOMENTO_API_KEY",
-    secret_name=os.environ.get("MOMENTO_API_KEY_SECRET_NAME"),
-    aws_region=os.environ.get("AWS_REGION"),
-)
-os.environ["OPENAI_API_KEY"] = get_secret_from_env_var_or_secrets_manager(
-    secret_env_var_name="OPENAI_API_KEY",
-    secret_name=os.environ.get("OPENAI_API_KEY_SECRET_NAME"),
+# Keys not set in the environment are fetched from Secrets Manager in one request, set as
+# environment variables for the clients that read them there, and refreshed in the background.
+secrets = SecretProvider(
+    {
+        "MOMENTO_API_KEY": os.environ.get("MOMENTO_API_KEY_SECRET_NAME"),
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY_SECRET_NAME"),
+    },
     aws_region=os.environ.get("AWS_REGION"),
+    export_to_environ=True,
 )
+secrets.refresh()
 
 # Note the imports are here since they expect the above environment variables to be set
 from rag_momento_vector_index import chain as rag_momento_vector_index_chain  # noqa: E402
-from rag_momento_vector_index.index import reindex_content  # noqa: E402
+from rag_momento_vector_index import chat_chain  # noqa: E402
+from rag_momento_vector_index.chain import batch_answerer, reload_credentials  # noqa: E402
+from rag_momento_vector_index.metrics import REGISTRY, CallbackGauge  # noqa: E402
+from rag_momento_vector_index.worker import ReindexWorker  # noqa: E402
+
+from .admission import AdmissionController, AdmissionMiddleware  # noqa: E402
+
+# Reindexing runs in its own process so that it does not compete with serving requests.
+reindex_worker = ReindexWorker()
+
+
+def on_secrets_rotated(env_var_names: list[str]) -> None:
+    reload_credentials(env_var_names)
+    # The worker process was started with the old keys in its environment.
+    reindex_worker.recycle()
+
 
-app = FastAPI()
+secrets.on_rotate(on_secrets_rotated)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    secrets.start()
+    yield
+    secrets.stop()
+    reindex_worker.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# At most ADMISSION_MAX_CONCURRENCY questions are answered at once, more wait their turn in a
+# bounded queue, and the rest are turned away with a 429 instead of slowing everyone down.
+admission = AdmissionController()
+# Added before CORS so that CORS headers are also set on the 429s.
+app.add_middleware(AdmissionMiddleware, controller=admission, path_prefix="/rag-momento-vector-index")
+REGISTRY.register(
+    CallbackGauge(
+        "rag_admission_in_progress",
+        "Requests to the chain running and waiting to run.",
+        ("state",),
+        lambda: {(state,): admission.stats()[state] for state in ("active", "queued")},
+    )
+)
 
 origins = [
     "*",
@@ -45,12 +89,60 @@ async def redirect_root_to_docs():
 
 # Edit this to add the chain you want to add
 add_routes(app, rag_momento_vector_index_chain, path="/rag-momento-vector-index")
+# Multi-turn chat, with the conversation of each `session_id` kept on the server.
+add_routes(app, chat_chain, path="/rag-momento-vector-index/chat")
+
+
+class BatchRequest(BaseModel):
+    inputs: list[str]
+
+
+@app.post("/rag-momento-vector-index/batch_as_completed")
+async def batch_as_completed(request: BatchRequest):
+    """Answers `inputs` like `/batch`, streaming each answer back as a JSON line as soon as it is
+    ready, e.g. `{"index": 3, "output": "..."}`, or `{"index": 3, "error": "..."}` if it failed."""
+
+    async def answers():
+        async for i, result in batch_answerer().answer_as_completed(request.inputs, return_exceptions=True):
+            if isinstance(result, Exception):
+                yield json.dumps({"index": i, "error": str(result)}) + "\n"
+            else:
+                yield json.dumps({"index": i, "output": result}) + "\n"
+
+    return StreamingResponse(answers(), media_type="application/x-ndjson")
 
 
 @app.post("/reindex/{index_name}")
-async def reindex(index_name: str, background_tasks: BackgroundTasks):
-    background_tasks.add_task(reindex_content, index_name)
-    return {"message": f"Reindexing {index_name} in progress."}
+async def reindex(index_name: str, full: bool = False):
+    # A reindex of an index that is already queued or running is not started again.
+    job, submitted = reindex_worker.submit(index_name, incremental=not full)
+    message = f"Reindexing {index_name} in progress." if submitted else f"Reindexing {index_name} already in progress."
+    return {"message": message, "job": job.to_dict()}
+
+
+@app.get("/reindex/jobs")
+async def reindex_jobs():
+    return {"jobs": [job.to_dict() for job in reindex_worker.jobs()]}
+
+
+@app.get("/reindex/jobs/{job_id}")
+async def reindex_job(job_id: str):
+    if (job := reindex_worker.get(job_id)) is None:
+        raise HTTPException(status_code=404, detail=f"No reindex job {job_id}.")
+    return job.to_dict()
+
+
+@app.post("/reindex/jobs/{job_id}/cancel")
+async def cancel_reindex_job(job_id: str):
+    if (job := reindex_worker.cancel(job_id)) is None:
+        raise HTTPException(status_code=404, detail=f"No reindex job {job_id}.")
+    return job.to_dict()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Stage timings, token counts and cache hit rates of this server and its reindex worker.
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,404 @@
+"""
+Deterministic local stand-ins for the OpenAI API, Momento Vector Index and the crawled sites.
+
+One aiohttp server provides:
+
+- `POST /v1/embeddings` and `POST /v1/chat/completions` (streaming and not), compatible with the
+  `openai` client. Embeddings are hashed bags of words, so similar texts get similar vectors.
+  Chat answers are built from the retrieved context and end with a source link, exercising the
+  chain's postprocessing.
+- `POST /mvi/<operation>`, an in-memory vector index used through `FakeVectorIndexClient` and
+  `FakeVectorIndexClientAsync`, which mirror the parts of the Momento clients the app uses. It
+  lives in this server so that the app and its reindex worker process share it.
+- `GET /sitemap.xml`, `GET /blog-sitemap.xml` and the pages they list, to reindex from.
+
+Latency is injectable per operation. Run it with:
+
+    python benchmarks/fakes.py --port 8089 --chat-first-token-ms 300 --chat-token-ms 20
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from typing import Any, Callable, Optional
+
+import aiohttp
+import numpy as np
+import requests
+from aiohttp import web
+from langchain_core.embeddings import Embeddings
+from momento.requests.vector_index import Item, SimilarityMetric
+from momento.responses.vector_index import (
+    CreateIndex,
+    CreateIndexResponse,
+    DeleteIndex,
+    DeleteIndexResponse,
+    DeleteItemBatch,
+    DeleteItemBatchResponse,
+    GetItemMetadataBatch,
+    GetItemMetadataBatchResponse,
+    ListIndexes,
+    ListIndexesResponse,
+    Search,
+    SearchResponse,
+    UpsertItemBatch,
+    UpsertItemBatchResponse,
+)
+from momento.responses.vector_index.control.list import IndexInfo
+from momento.responses.vector_index.data.search import SearchHit
+
+FAKES_URL_ENV_VAR_NAME = "BENCHMARK_FAKES_URL"
+EMBEDDING_DIMENSIONS = 1536
+WORDS = (
+    "momento cache vector index serverless latency topic store token region client key value ttl "
+    "collection dictionary sorted set list eviction throughput request limit api sdk console"
+).split()
+
+
+def fake_embedding(item: Any, dimensions: int = EMBEDDING_DIMENSIONS) -> np.ndarray:
+    """A normalized, signed bag of hashed words (or token ids)."""
+    words = item if isinstance(item, list) else re.findall(r"\w+", str(item).lower())
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for word in words:
+        h = int.from_bytes(hashlib.blake2b(str(word).encode(), digest_size=8).digest(), "little")
+        vector[h % dimensions] += 1.0 if h >> 63 else -1.0
+    norm = np.linalg.norm(vector)
+    if not norm:
+        vector[0], norm = 1.0, 1.0
+    return vector / norm
+
+
+class Latency:
+    """A base delay with optional uniform jitter, from a seeded generator."""
+
+    def __init__(self, milliseconds: float, jitter: float, seed: int = 0):
+        self.seconds = milliseconds / 1000
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    async def sleep(self) -> None:
+        if self.seconds > 0:
+            await asyncio.sleep(self.seconds * (1 + self.jitter * (2 * self.random.random() - 1)))
+
+
+def synthetic_page(kind: str, i: int) -> str:
+    rng = random.Random(f"{kind}-{i}")
+
+    def paragraph() -> str:
+        return " ".join(rng.choices(WORDS, k=rng.randint(30, 90)))
+
+    sections = "".join(f"<h2>{rng.choice(WORDS)}</h2><p>{paragraph()}</p><p>{paragraph()}</p>" for _ in range(5))
+    return (
+        f"<html><head><title>{kind} {i}</title></head><body><header><nav>{' '.join(WORDS)}</nav></header>"
+        f"<main><h1>{kind} {i}</h1>{sections}</main><footer>{' '.join(WORDS)}</footer></body></html>"
+    )
+
+
+class FakeBackend:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.embedding_latency = Latency(args.embedding_latency_ms, args.jitter, seed=1)
+        self.chat_first_token_latency = Latency(args.chat_first_token_ms, args.jitter, seed=2)
+        self.chat_token_latency = Latency(args.chat_token_ms, args.jitter, seed=3)
+        self.mvi_latency = Latency(args.mvi_latency_ms, args.jitter, seed=4)
+        # index name -> item id -> (vector, metadata), and the vectors stacked for searching
+        self.indexes: dict[str, dict[str, tuple[np.ndarray, dict]]] = {}
+        self._matrices: dict[str, tuple[list[str], np.ndarray]] = {}
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post("/v1/embeddings", self.embeddings)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/mvi/{operation}", self.mvi)
+        app.router.add_get("/sitemap.xml", self.sitemap)
+        app.router.add_get("/blog-sitemap.xml", self.sitemap)
+        app.router.add_get("/{kind:docs|blog}/{i:\\d+}", self.page)
+        return app
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        if inputs and isinstance(inputs[0], int):
+            inputs = [inputs]
+        await self.embedding_latency.sleep()
+        data = []
+        for i, item in enumerate(inputs):
+            vector = fake_embedding(item)
+            embedding: Any = (
+                base64.b64encode(vector.astype("<f4").tobytes()).decode()
+                if body.get("encoding_format") == "base64"
+                else vector.tolist()
+            )
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(item) if isinstance(item, list) else len(str(item).split()) for item in inputs)
+        return web.json_response(
+            {"object": "list", "data": data, "model": body["model"], "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+        )
+
+    def answer_tokens(self, messages: list[dict]) -> list[str]:
+        prompt = "\n".join(str(message.get("content", "")) for message in messages)
+        content = re.findall(r"Content: (.*)", prompt)
+        sources = re.findall(r"Source: (\S+)", prompt)
+        words = " ".join(content).split() or WORDS
+        tokens = [f" {words[i % len(words)]}" for i in range(self.args.answer_tokens)]
+        tokens[0] = tokens[0].lstrip()
+        if sources:
+            tokens += ["\n\n", "Source:", f" - [{sources[0]}]", f"({sources[0]})"]
+        return tokens
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        tokens = self.answer_tokens(body["messages"])
+        completion_id = f"chatcmpl-{hashlib.md5(json.dumps(body['messages']).encode()).hexdigest()}"
+        created = int(time.time())
+        await self.chat_first_token_latency.sleep()
+
+        if not body.get("stream"):
+            for _ in tokens[1:]:
+                await self.chat_token_latency.sleep()
+            return web.json_response(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": body["model"],
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}
+                    ],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish_reason: Optional[str] = None) -> None:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": body["model"],
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        await send({"role": "assistant", "content": ""})
+        for i, token in enumerate(tokens):
+            if i:
+                await self.chat_token_latency.sleep()
+            await send({"content": token})
+        await send({}, "stop")
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def mvi(self, request: web.Request) -> web.Response:
+        operation = request.match_info["operation"]
+        body = await request.json()
+        await self.mvi_latency.sleep()
+        name = body.get("index_name")
+        if operation == "create_index":
+            if name in self.indexes:
+                return web.json_response({"already_exists": True})
+            self.indexes[name] = {}
+        elif operation == "delete_index":
+            self.indexes.pop(name, None)
+            self._matrices.pop(name, None)
+        elif operation == "list_indexes":
+            return web.json_response({"indexes": list(self.indexes)})
+        elif operation == "upsert_item_batch":
+            index = self.indexes.setdefault(name, {})
+            for item in body["items"]:
+                index[item["id"]] = (np.asarray(item["vector"], dtype=np.float32), item["metadata"])
+            self._matrices.pop(name, None)
+        elif operation == "delete_item_batch":
+            for id_ in body["ids"]:
+                self.indexes.get(name, {}).pop(id_, None)
+            self._matrices.pop(name, None)
+        elif operation == "get_item_metadata_batch":
+            index = self.indexes.get(name, {})
+            return web.json_response({"values": {id_: index[id_][1] for id_ in body["ids"] if id_ in index}})
+        elif operation == "search":
+            return web.json_response({"hits": self.search(name, body["query_vector"], body["top_k"])})
+        else:
+            raise web.HTTPNotFound()
+        return web.json_response({})
+
+    def search(self, name: str, query_vector: list[float], top_k: int) -> list[dict]:
+        index = self.indexes.get(name, {})
+        if not index:
+            return []
+        if name not in self._matrices:
+            ids = list(index)
+            self._matrices[name] = (ids, np.stack([index[id_][0] for id_ in ids]))
+        ids, matrix = self._matrices[name]
+        scores = matrix @ np.asarray(query_vector, dtype=np.float32)
+        top = np.argsort(-scores)[:top_k]
+        return [{"id": ids[i], "score": float(scores[i]), "metadata": index[ids[i]][1]} for i in top]
+
+    async def sitemap(self, request: web.Request) -> web.Response:
+        base = f"{request.scheme}://{request.host}"
+        kind, count = ("blog", self.args.blog_pages) if "blog" in request.path else ("docs", self.args.doc_pages)
+        urls = "".join(f"<url><loc>{base}/{kind}/{i}</loc><lastmod>2024-01-01</lastmod></url>" for i in range(count))
+        return web.Response(
+            text=f'<?xml version="1.0" encoding="UTF-8"?><urlset>{urls}</urlset>', content_type="application/xml"
+        )
+
+    async def page(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=synthetic_page(request.match_info["kind"], int(request.match_info["i"])), content_type="text/html"
+        )
+
+
+class FakeVectorIndexClient:
+    """The subset of `PreviewVectorIndexClient` the app uses, backed by the fake server."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def _call(self, operation: str, **body: Any) -> dict:
+        response = self.session.post(f"{self.base_url}/mvi/{operation}", json=body)
+        response.raise_for_status()
+        return response.json()
+
+    def create_index(
+        self, index_name: str, num_dimensions: int, similarity_metric: SimilarityMetric = SimilarityMetric.COSINE_SIMILARITY
+    ) -> CreateIndexResponse:
+        result = self._call("create_index", index_name=index_name, num_dimensions=num_dimensions)
+        return CreateIndex.IndexAlreadyExists() if result.get("already_exists") else CreateIndex.Success()
+
+    def delete_index(self, index_name: str) -> DeleteIndexResponse:
+        self._call("delete_index", index_name=index_name)
+        return DeleteIndex.Success()
+
+    def list_indexes(self) -> ListIndexesResponse:
+        names = self._call("list_indexes")["indexes"]
+        return ListIndexes.Success(
+            indexes=[IndexInfo(name, EMBEDDING_DIMENSIONS, SimilarityMetric.COSINE_SIMILARITY) for name in names]
+        )
+
+    def upsert_item_batch(self, index_name: str, items: list[Item]) -> UpsertItemBatchResponse:
+        self._call(
+            "upsert_item_batch",
+            index_name=index_name,
+            items=[{"id": item.id, "vector": list(item.vector), "metadata": item.metadata} for item in items],
+        )
+        return UpsertItemBatch.Success()
+
+    def delete_item_batch(self, index_name: str, ids: list[str]) -> DeleteItemBatchResponse:
+        self._call("delete_item_batch", index_name=index_name, ids=list(ids))
+        return DeleteItemBatch.Success()
+
+    def get_item_metadata_batch(self, index_name: str, ids: list[str]) -> GetItemMetadataBatchResponse:
+        return GetItemMetadataBatch.Success(values=self._call("get_item_metadata_batch", index_name=index_name, ids=ids)["values"])
+
+    def search(self, index_name: str, query_vector: list[float], top_k: int = 10, **_kwargs: Any) -> SearchResponse:
+        hits = self._call("search", index_name=index_name, query_vector=list(query_vector), top_k=top_k)["hits"]
+        return Search.Success(hits=[SearchHit(**hit) for hit in hits])
+
+
+class FakeVectorIndexClientAsync:
+    """The subset of `PreviewVectorIndexClientAsync` the app uses, backed by the fake server."""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def search(self, index_name: str, query_vector: list[float], top_k: int = 10, **_kwargs: Any) -> SearchResponse:
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        body = {"index_name": index_name, "query_vector": list(query_vector), "top_k": top_k}
+        async with self._session.post(f"{self.base_url}/mvi/search", json=body) as response:
+            response.raise_for_status()
+            hits = (await response.json())["hits"]
+        return Search.Success(hits=[SearchHit(**hit) for hit in hits])
+
+
+class FakeEmbeddings(Embeddings):
+    """Calls the fake embeddings endpoint with plain strings. Used in place of `OpenAIEmbeddings`
+    when tiktoken cannot load its encodings, e.g. on a machine without network access."""
+
+    def __init__(self, base_url: str, model: str = "text-embedding-ada-002"):
+        self.base_url = base_url
+        self.model = model
+        self.session = requests.Session()
+        self._async_session: Optional[aiohttp.ClientSession] = None
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        response = self.session.post(f"{self.base_url}/v1/embeddings", json={"input": texts, "model": self.model})
+        response.raise_for_status()
+        return [item["embedding"] for item in response.json()["data"]]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        if self._async_session is None:
+            self._async_session = aiohttp.ClientSession()
+        body = {"input": texts, "model": self.model}
+        async with self._async_session.post(f"{self.base_url}/v1/embeddings", json=body) as response:
+            response.raise_for_status()
+            return [item["embedding"] for item in (await response.json())["data"]]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self.aembed_documents([text]))[0]
+
+
+def tiktoken_available() -> bool:
+    try:
+        import tiktoken
+
+        tiktoken.encoding_for_model("text-embedding-ada-002")
+        return True
+    except Exception:
+        return False
+
+
+def use_fakes_for_embeddings(embeddings: Embeddings, base_url: str) -> None:
+    """Swaps the model under the app's cached embeddings for `FakeEmbeddings` if tiktoken,
+    which `OpenAIEmbeddings` needs, is unavailable. Otherwise the real client talks to the fake
+    API through `OPENAI_API_BASE`."""
+    from rag_momento_vector_index.embedding_cache import CachedEmbeddings
+
+    if not tiktoken_available() and isinstance(embeddings, CachedEmbeddings):
+        embeddings.underlying = FakeEmbeddings(base_url)
+
+
+def fake_reindex(
+    index_name: str, momento_env_var_name: str, incremental: bool, on_progress: Optional[Callable] = None
+) -> dict:
+    """A `ReindexWorker` target that reindexes from the fake sites into the fake index."""
+    from rag_momento_vector_index import index
+    from rag_momento_vector_index.embedding_cache import get_embeddings
+    from rag_momento_vector_index.metrics import REGISTRY
+
+    base_url = os.environ[FAKES_URL_ENV_VAR_NAME]
+    index.create_vector_index_client = lambda _env_var_name: FakeVectorIndexClient(base_url)
+    use_fakes_for_embeddings(get_embeddings(momento_env_var_name=momento_env_var_name), base_url)
+    index.reindex_content(index_name, momento_env_var_name, incremental=incremental, on_progress=on_progress)
+    return REGISTRY.drain()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--embedding-latency-ms", type=float, default=30)
+    parser.add_argument("--chat-first-token-ms", type=float, default=300)
+    parser.add_argument("--chat-token-ms", type=float, default=15)
+    parser.add_argument("--mvi-latency-ms", type=float, default=10)
+    parser.add_argument("--jitter", type=float, default=0.2, help="Uniform jitter as a fraction of each latency.")
+    parser.add_argument("--answer-tokens", type=int, default=80)
+    parser.add_argument("--doc-pages", type=int, default=200)
+    parser.add_argument("--blog-pages", type=int, default=50)
+    args = parser.parse_args()
+    web.run_app(FakeBackend(args).app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
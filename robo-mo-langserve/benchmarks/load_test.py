@@ -0,0 +1,313 @@
+"""
+Drives the langserve endpoints at a fixed concurrency and reports latency, time to first token,
+throughput and server memory, optionally comparing against a previous run.
+
+Start the fakes and the app (see `fakes.py` and `serve.py`), or pass `--spawn` to have this
+script start both and stop them afterwards:
+
+    python benchmarks/load_test.py --spawn --endpoints invoke,stream,batch --concurrency 16 \\
+        --requests 200 --output results.json
+    python benchmarks/load_test.py --spawn --baseline results.json --tolerance 0.15
+
+With `--baseline`, the exit status is 1 if any p50/p95/p99 latency or time to first token got
+worse by more than `--tolerance`, or throughput dropped by more than that.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import aiohttp
+import numpy as np
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = ["invoke", "batch", "stream", "reindex"]
+QUESTIONS = [
+    "What is Momento Cache?",
+    "How do I create a Momento Vector Index?",
+    "What is the maximum item size in Momento Cache?",
+    "How do I set a TTL on a cache item?",
+    "What SDKs does Momento support?",
+    "How do Momento Topics work?",
+    "How do I store a dictionary in Momento?",
+    "What are the rate limits for the free tier?",
+    "How does eviction work in Momento Cache?",
+    "How do I list the caches in my account?",
+    "What is a sorted set and how do I use one?",
+    "How do I generate an API key in the console?",
+]
+
+
+@dataclass
+class EndpointResults:
+    latencies: list[float] = field(default_factory=list)
+    first_token_latencies: list[float] = field(default_factory=list)
+    chunks: int = 0
+    errors: int = 0
+    error_samples: list[str] = field(default_factory=list)
+    seconds: float = 0.0
+
+    def record_error(self, error: str) -> None:
+        self.errors += 1
+        if len(self.error_samples) < 5:
+            self.error_samples.append(error)
+
+    def summary(self) -> dict:
+        def percentiles(values: list[float]) -> dict:
+            if not values:
+                return {}
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            return {"p50": p50, "p95": p95, "p99": p99, "mean": float(np.mean(values)), "max": max(values)}
+
+        completed = len(self.latencies)
+        result = {
+            "requests": completed + self.errors,
+            "errors": self.errors,
+            "error_samples": self.error_samples,
+            "seconds": self.seconds,
+            "throughput_rps": completed / self.seconds if self.seconds else 0.0,
+            "latency_seconds": percentiles(self.latencies),
+        }
+        if self.first_token_latencies:
+            result["time_to_first_token_seconds"] = percentiles(self.first_token_latencies)
+            result["chunks_per_second"] = self.chunks / self.seconds if self.seconds else 0.0
+        return result
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.chain_url = f"{args.url}{args.path}"
+        self._next_question = 0
+
+    def question(self) -> str:
+        question = QUESTIONS[self._next_question % len(QUESTIONS)]
+        self._next_question += 1
+        # A suffix makes questions distinct, so the embedding cache does not serve every query.
+        return question if self.args.repeat_questions else f"{question} (#{self._next_question})"
+
+    async def invoke(self, session: aiohttp.ClientSession, results: EndpointResults) -> None:
+        async with session.post(f"{self.chain_url}/invoke", json={"input": self.question()}) as response:
+            body = await response.json()
+            if response.status != 200 or not body.get("output"):
+                raise RuntimeError(f"/invoke returned {response.status}: {str(body)[:200]}")
+
+    async def batch(self, session: aiohttp.ClientSession, results: EndpointResults) -> None:
+        inputs = [self.question() for _ in range(self.args.batch_size)]
+        async with session.post(f"{self.chain_url}/batch", json={"inputs": inputs}) as response:
+            body = await response.json()
+            if response.status != 200 or len(body.get("output", [])) != len(inputs):
+                raise RuntimeError(f"/batch returned {response.status}: {str(body)[:200]}")
+
+    async def stream(self, session: aiohttp.ClientSession, results: EndpointResults) -> Optional[float]:
+        start = time.perf_counter()
+        first_token: Optional[float] = None
+        event = None
+        async with session.post(f"{self.chain_url}/stream", json={"input": self.question()}) as response:
+            if response.status != 200:
+                raise RuntimeError(f"/stream returned {response.status}: {(await response.text())[:200]}")
+            async for line in response.content:
+                text = line.decode().strip()
+                if text.startswith("event:"):
+                    event = text.split(":", 1)[1].strip()
+                    if event == "error":
+                        raise RuntimeError("/stream sent an error event.")
+                elif text.startswith("data:") and event == "data":
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    results.chunks += 1
+        if first_token is None:
+            raise RuntimeError("/stream returned no data.")
+        return first_token
+
+    async def reindex(self, session: aiohttp.ClientSession, results: EndpointResults) -> None:
+        async with session.post(f"{self.args.url}/reindex/{self.args.index_name}") as response:
+            if response.status != 200:
+                raise RuntimeError(f"/reindex returned {response.status}: {(await response.text())[:200]}")
+
+    async def run_endpoint(self, session: aiohttp.ClientSession, endpoint: str) -> EndpointResults:
+        results = EndpointResults()
+        call = getattr(self, endpoint)
+        total = self.args.reindex_requests if endpoint == "reindex" else self.args.requests
+        remaining = iter(range(total))
+
+        async def worker() -> None:
+            for _ in remaining:
+                start = time.perf_counter()
+                try:
+                    first_token = await call(session, results)
+                except Exception as e:
+                    results.record_error(repr(e))
+                    continue
+                results.latencies.append(time.perf_counter() - start)
+                if first_token is not None:
+                    results.first_token_latencies.append(first_token)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+        results.seconds = time.perf_counter() - start
+        return results
+
+    async def memory(self, session: aiohttp.ClientSession) -> dict:
+        try:
+            async with session.get(f"{self.args.url}/_benchmark/memory") as response:
+                return await response.json() if response.status == 200 else {}
+        except aiohttp.ClientError:
+            return {}
+
+    async def run(self) -> dict:
+        timeout = aiohttp.ClientTimeout(total=self.args.timeout_seconds)
+        connector = aiohttp.TCPConnector(limit=self.args.concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            memory_before = await self.memory(session)
+            endpoints = {}
+            for endpoint in self.args.endpoints:
+                # A few requests first, so one-time setup does not land in the percentiles.
+                for _ in range(self.args.warmup if endpoint != "reindex" else 0):
+                    try:
+                        await getattr(self, endpoint)(session, EndpointResults())
+                    except Exception:
+                        pass
+                print(f"Running {endpoint}...", file=sys.stderr)
+                endpoints[endpoint] = (await self.run_endpoint(session, endpoint)).summary()
+            memory_after = await self.memory(session)
+        return {
+            "config": {
+                key: getattr(self.args, key)
+                for key in ["url", "endpoints", "concurrency", "requests", "batch_size", "repeat_questions"]
+            },
+            "endpoints": endpoints,
+            "memory": {"before": memory_before, "after": memory_after},
+        }
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    found = []
+    for endpoint, summary in results["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(endpoint)
+        if not previous:
+            continue
+        for metric in ["latency_seconds", "time_to_first_token_seconds"]:
+            for percentile in ["p50", "p95", "p99"]:
+                old, new = previous.get(metric, {}).get(percentile), summary.get(metric, {}).get(percentile)
+                if old and new and new > old * (1 + tolerance):
+                    found.append(f"{endpoint} {metric} {percentile}: {old:.3f}s -> {new:.3f}s")
+        old, new = previous.get("throughput_rps"), summary.get("throughput_rps")
+        if old and new is not None and new < old * (1 - tolerance):
+            found.append(f"{endpoint} throughput: {old:.1f}/s -> {new:.1f}/s")
+        if summary["errors"] > previous.get("errors", 0):
+            found.append(f"{endpoint} errors: {previous.get('errors', 0)} -> {summary['errors']}")
+    return found
+
+
+def print_report(results: dict) -> None:
+    for endpoint, summary in results["endpoints"].items():
+        latency = summary["latency_seconds"]
+        line = f"{endpoint:8} {summary['requests']:5} requests, {summary['errors']} errors, {summary['throughput_rps']:7.1f}/s"
+        if latency:
+            line += f"  latency p50 {latency['p50']:.3f}s p95 {latency['p95']:.3f}s p99 {latency['p99']:.3f}s"
+        ttft = summary.get("time_to_first_token_seconds")
+        if ttft:
+            line += f"  ttft p50 {ttft['p50']:.3f}s p95 {ttft['p95']:.3f}s p99 {ttft['p99']:.3f}s"
+        print(line)
+        for sample in summary["error_samples"]:
+            print(f"         {sample}")
+    after = results["memory"].get("after")
+    if after:
+        print(f"server rss {after['rss_bytes'] / 1e6:.0f} MB, peak {after['peak_rss_bytes'] / 1e6:.0f} MB")
+
+
+async def wait_until_up(url: str, process: subprocess.Popen, timeout_seconds: float = 120) -> None:
+    deadline = time.monotonic() + timeout_seconds
+    async with aiohttp.ClientSession() as session:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"{' '.join(process.args)} exited with status {process.returncode}.")
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{url} did not come up within {timeout_seconds}s.")
+            await asyncio.sleep(0.5)
+
+
+def spawn_servers(args: argparse.Namespace) -> list[subprocess.Popen]:
+    fakes_url = f"http://127.0.0.1:{args.fakes_port}"
+    port = args.url.rsplit(":", 1)[1]
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(BENCHMARKS_DIR, "fakes.py"), "--port", str(args.fakes_port), *args.fakes_args]
+        )
+    ]
+    serve_args = ["--fakes-url", fakes_url, "--port", port, "--index-name", args.index_name, *args.serve_args]
+    try:
+        asyncio.run(wait_until_up(f"{fakes_url}/sitemap.xml", processes[0]))
+        processes.append(subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_DIR, "serve.py"), *serve_args]))
+        asyncio.run(wait_until_up(f"{args.url}/_benchmark/memory", processes[1]))
+    except BaseException:
+        stop(processes)
+        raise
+    return processes
+
+
+def stop(processes: list[subprocess.Popen]) -> None:
+    for process in reversed(processes):
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--path", default="/rag-momento-vector-index")
+    parser.add_argument("--index-name", default="benchmark")
+    parser.add_argument("--endpoints", default="invoke,stream", help=f"Comma separated, from {', '.join(ENDPOINTS)}.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="Requests per endpoint.")
+    parser.add_argument("--reindex-requests", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--repeat-questions", action="store_true", help="Send the same few questions over and over.")
+    parser.add_argument("--timeout-seconds", type=float, default=120)
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="A previous --output to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--spawn", action="store_true", help="Start fakes.py and serve.py, and stop them at the end.")
+    parser.add_argument("--fakes-port", type=int, default=8089)
+    parser.add_argument("--fakes-args", default="", help="Extra arguments for fakes.py, e.g. '--chat-token-ms 5'.")
+    parser.add_argument("--serve-args", default="", help="Extra arguments for serve.py, e.g. --serve-args=--answer-cache.")
+    args = parser.parse_args()
+    args.endpoints = [endpoint.strip() for endpoint in args.endpoints.split(",") if endpoint.strip()]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"Unknown endpoints: {', '.join(sorted(unknown))}")
+    args.fakes_args, args.serve_args = args.fakes_args.split(), args.serve_args.split()
+
+    processes = spawn_servers(args) if args.spawn else []
+    try:
+        results = asyncio.run(LoadTest(args).run())
+    finally:
+        stop(processes)
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, default=float)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
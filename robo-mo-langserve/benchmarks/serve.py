@@ -0,0 +1,168 @@
+"""
+Runs `app/server.py` against the local fakes in `fakes.py`, for load testing.
+
+OpenAI is pointed at the fake API through `OPENAI_API_BASE`, the Momento vector index clients,
+including the reindex worker's, are swapped for the fake index, and the sitemaps are pointed at
+the fake sites. Manifests, aliases and caches go to a scratch directory. Before serving, the
+fake index is seeded with a few hundred chunks so queries retrieve something. The app also
+gets a `GET /_benchmark/memory` endpoint reporting the server's memory use.
+
+    python benchmarks/serve.py --fakes-url http://127.0.0.1:8089 --port 8000
+
+With `--corpus-snapshot`, the index is seeded with the chunks of a corpus snapshot, and
+reindexing reads the snapshot instead of crawling the fake sites.
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import re
+import resource
+import sys
+import tempfile
+from typing import Optional
+
+import uvicorn
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path[:0] = [BENCHMARKS_DIR, APP_DIR]
+
+from fakes import (  # noqa: E402
+    FAKES_URL_ENV_VAR_NAME,
+    FakeVectorIndexClient,
+    FakeVectorIndexClientAsync,
+    fake_embedding,
+    fake_reindex,
+    synthetic_page,
+    use_fakes_for_embeddings,
+)
+
+logger = logging.getLogger(__name__)
+
+SEED_PAGES = 60
+SEED_CHUNK_WORDS = 100
+
+
+def configure_environment(args: argparse.Namespace) -> None:
+    scratch = args.scratch_dir or tempfile.mkdtemp(prefix="robo-mo-benchmark-")
+    fake_key = base64.b64encode(json.dumps({"endpoint": "fake.invalid", "api_key": "fake"}).encode()).decode()
+    os.environ.update(
+        {
+            FAKES_URL_ENV_VAR_NAME: args.fakes_url,
+            "OPENAI_API_BASE": f"{args.fakes_url}/v1",
+            "OPENAI_API_KEY": "sk-benchmark",
+            "MOMENTO_API_KEY": fake_key,
+            "MOMENTO_INDEX_NAME": args.index_name,
+            "TECH_DOCS_SITEMAP_URL": f"{args.fakes_url}/sitemap.xml",
+            "BLOGS_SITEMAP_URL": f"{args.fakes_url}/blog-sitemap.xml",
+            "REINDEX_MANIFEST_DIR": os.path.join(scratch, "manifests"),
+            "EMBEDDING_CACHE": args.embedding_cache,
+            "EMBEDDING_CACHE_PATH": os.path.join(scratch, "embeddings.sqlite3"),
+            "CRAWL_CACHE_PATH": os.path.join(scratch, "crawl.sqlite3"),
+            "ANSWER_CACHE": str(args.answer_cache).lower(),
+        }
+    )
+    if args.corpus_snapshot:
+        os.environ["CORPUS_SNAPSHOT"] = os.path.abspath(args.corpus_snapshot)
+    # Keep the index alias in the scratch directory rather than a Momento cache.
+    os.environ.pop("INDEX_ALIAS_CACHE_NAME", None)
+    for secret_name in ["MOMENTO_API_KEY_SECRET_NAME", "OPENAI_API_KEY_SECRET_NAME"]:
+        os.environ.pop(secret_name, None)
+    logger.info(f"Scratch directory: {scratch}")
+
+
+def seed_index(client: FakeVectorIndexClient, alias: str, snapshot_path: Optional[str] = None) -> None:
+    """Loads synthetic pages, or the chunks of the corpus snapshot at `snapshot_path`, into a
+    fresh index generation and points the alias at it."""
+    from momento.requests.vector_index import Item
+    from rag_momento_vector_index.aliases import get_index_resolver, new_generation_name
+    from rag_momento_vector_index.manifest import chunk_id
+    from rag_momento_vector_index.snapshot import CorpusSnapshot
+
+    generation = new_generation_name(alias)
+    client.create_index(generation, len(fake_embedding("")))
+    items = []
+    if snapshot_path is not None:
+        for _, chunks in CorpusSnapshot(snapshot_path).pages():
+            items.extend(
+                Item(
+                    id=chunk_id(chunk),
+                    vector=fake_embedding(chunk.page_content).tolist(),
+                    metadata={**chunk.metadata, "text": chunk.page_content},
+                )
+                for chunk in chunks or []
+            )
+    else:
+        for kind, count in [("docs", SEED_PAGES), ("blog", SEED_PAGES // 4)]:
+            for i in range(count):
+                words = re.sub(r"<[^>]+>", " ", synthetic_page(kind, i)).split()
+                source = f"{os.environ[FAKES_URL_ENV_VAR_NAME]}/{kind}/{i}"
+                for start in range(0, len(words), SEED_CHUNK_WORDS):
+                    text = " ".join(words[start : start + SEED_CHUNK_WORDS])
+                    items.append(
+                        Item(
+                            id=f"{source}, chunk={start}",
+                            vector=fake_embedding(text).tolist(),
+                            metadata={"source": source, "start_index": start, "text": text},
+                        )
+                    )
+    for i in range(0, len(items), 128):
+        client.upsert_item_batch(generation, items[i : i + 128])
+    get_index_resolver(alias, "MOMENTO_API_KEY").set(generation)
+    logger.info(f"Seeded {generation} with {len(items)} chunks.")
+
+
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+def peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fakes-url", default="http://127.0.0.1:8089")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--index-name", default="benchmark")
+    parser.add_argument("--scratch-dir", help="Where manifests, aliases and caches go. Defaults to a temp dir.")
+    parser.add_argument("--embedding-cache", default="local", choices=["local", "none"])
+    parser.add_argument(
+        "--answer-cache", action="store_true", help="Enable the semantic answer cache, which hides retrieval and generation."
+    )
+    parser.add_argument("--corpus-snapshot", help="Seed and reindex from this corpus snapshot instead of the fake sites.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    configure_environment(args)
+    from app import server
+    from rag_momento_vector_index.worker import ReindexWorker
+
+    chain_module = sys.modules["rag_momento_vector_index.chain"]
+    client = FakeVectorIndexClient(args.fakes_url)
+    chain_module.vector_index_client = lambda: client
+    chain_module.vectorstore_for.cache_clear()
+    async_client = FakeVectorIndexClientAsync(args.fakes_url)
+    chain_module.async_vector_index_client = lambda: async_client
+    use_fakes_for_embeddings(chain_module.embeddings(), args.fakes_url)
+    server.reindex_worker = ReindexWorker(target=fake_reindex)
+
+    @server.app.get("/_benchmark/memory")
+    async def memory() -> dict:
+        return {"rss_bytes": current_rss_bytes(), "peak_rss_bytes": peak_rss_bytes()}
+
+    seed_index(client, args.index_name, os.environ.get("CORPUS_SNAPSHOT"))
+    uvicorn.run(server.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Measures how long the langserve app takes to start, in fresh processes.
+
+Each run starts a new interpreter and reports how long importing `app.server` took, which
+covers fetching secrets, importing the chain and building the app, and how long it took from
+starting `uvicorn` until the app answered its first HTTP request. The app runs against the
+same placeholder credentials as `serve.py` and makes no network calls while starting.
+
+    python benchmarks/startup.py --runs 10 --output startup.json
+    python benchmarks/startup.py --runs 10 --baseline startup.json --tolerance 0.15
+
+With `--baseline`, the exit status is 1 if the median of either measurement got worse by more
+than `--tolerance`. Pass `--importtime` to also print the slowest imports of one run.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path[:0] = [BENCHMARKS_DIR, APP_DIR]
+
+from serve import configure_environment  # noqa: E402
+
+IMPORT_SCRIPT = (
+    "import json, time\n"
+    "start = time.perf_counter()\n"
+    "import app.server\n"
+    "print(json.dumps({'import_seconds': time.perf_counter() - start}))\n"
+)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_import() -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT], cwd=APP_DIR, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])["import_seconds"]
+
+
+def measure_ready(timeout_seconds: float = 120) -> float:
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.server:app", "--port", str(port), "--log-level", "warning"],
+        cwd=APP_DIR,
+    )
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with status {process.returncode}.")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/docs", timeout=1):
+                    return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            if time.perf_counter() - start > timeout_seconds:
+                raise TimeoutError(f"The app did not come up within {timeout_seconds}s.")
+            time.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def print_importtime(top: int) -> None:
+    """Prints the `top` modules with the highest cumulative import time."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.server"],
+        cwd=APP_DIR,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        rows.append((int(cumulative), name.strip()))
+    for cumulative, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative / 1e6:8.3f}s  {name}")
+
+
+def summarize(values: list[float]) -> dict:
+    return {"median": statistics.median(values), "min": min(values), "max": max(values)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--scratch-dir", help="Where manifests, aliases and caches go. Defaults to a temp dir.")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="A previous --output to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--importtime", action="store_true", help="Print the slowest imports of one run.")
+    args = parser.parse_args()
+
+    configure_environment(
+        argparse.Namespace(
+            scratch_dir=args.scratch_dir,
+            fakes_url="http://127.0.0.1:9",
+            index_name="benchmark",
+            embedding_cache="local",
+            answer_cache=False,
+            corpus_snapshot=None,
+        )
+    )
+    # Warm the OS file cache so the first run is not an outlier.
+    measure_import()
+    results = {
+        "runs": args.runs,
+        "import_seconds": summarize([measure_import() for _ in range(args.runs)]),
+        "ready_seconds": summarize([measure_ready() for _ in range(args.runs)]),
+    }
+    for key in ["import_seconds", "ready_seconds"]:
+        summary = results[key]
+        print(f"{key:15} median {summary['median']:.3f}s min {summary['min']:.3f}s max {summary['max']:.3f}s")
+    if args.importtime:
+        print_importtime(top=15)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = []
+        for key in ["import_seconds", "ready_seconds"]:
+            old, new = baseline.get(key, {}).get("median"), results[key]["median"]
+            if old and new > old * (1 + args.tolerance):
+                found.append(f"{key}: {old:.3f}s -> {new:.3f}s")
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Compares parsing and splitting pages serially with the original 12 `find_all` passes against the
+single-pass parser on a process pool, and checks that both produce the same chunks.
+
+    python benchmarks/parse_split.py --pages 500 --workers 8
+    python benchmarks/parse_split.py --corpus path/to/html/pages
+    python benchmarks/parse_split.py --pages 500 --snapshot
+
+Without `--corpus`, a synthetic corpus shaped like the docs and blog pages is generated. The
+splitter needs the tiktoken encodings; pass `--parse-only` where they cannot be downloaded.
+With `--snapshot`, the pages and chunks are also written to a corpus snapshot and read back, to
+compare replaying a snapshot with parsing and splitting again.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import Executor
+from typing import Optional
+
+from bs4 import BeautifulSoup
+from langchain.docstore.document import Document
+from langchain.text_splitter import TokenTextSplitter
+
+from rag_momento_vector_index.crawler import parse_page
+from rag_momento_vector_index.index import (
+    SPLIT_CHUNK_OVERLAP,
+    SPLIT_CHUNK_SIZE,
+    parse_content_fn,
+    split_documents,
+    trim_metadata_fn,
+)
+from rag_momento_vector_index.pipeline import create_process_pool
+from rag_momento_vector_index.snapshot import CorpusSnapshot, SnapshotWriter, split_params
+
+WORDS = "momento cache vector index serverless latency topic store token region client key value".split()
+
+
+def legacy_parse_content_fn(content: BeautifulSoup) -> str:
+    to_remove = list(
+        itertools.chain(
+            content.find_all("title"),
+            content.find_all("nav"),
+            content.find_all("div", role="region"),
+            content.find_all("div", class_="page-wrapper"),
+            content.find_all("div", class_="blog-post_newsletter"),
+            content.find_all("div", class_="blog-post-social-wrapper"),
+            content.find_all("section", class_="section-more-blog-posts"),
+            content.find_all("button"),
+            content.find_all("aside"),
+            content.find_all(id="faqs"),
+            content.find_all("header"),
+            content.find_all("footer"),
+        )
+    )
+    for element in to_remove:
+        element.decompose()
+    return str(content.get_text()).strip()
+
+
+def legacy_split_documents(documents: list[Document]) -> list[Document]:
+    text_splitter = TokenTextSplitter(
+        chunk_size=128, chunk_overlap=32, model_name="text-embedding-ada-002", add_start_index=True
+    )
+    return text_splitter.split_documents(documents)
+
+
+def paragraphs(rng: random.Random, count: int) -> str:
+    return "".join(f"<p>{' '.join(rng.choices(WORDS, k=rng.randint(20, 80)))}</p>" for _ in range(count))
+
+
+def synthetic_page(rng: random.Random, i: int) -> str:
+    links = "".join(f'<li><a href="/docs/{j}">{rng.choice(WORDS)}</a></li>' for j in range(60))
+    sections = "".join(
+        f"<section><h2>{rng.choice(WORDS)}</h2><div class='content'>{paragraphs(rng, 4)}"
+        f"<pre><code>client.get('{rng.choice(WORDS)}')</code></pre><button>Copy</button></div></section>"
+        for _ in range(rng.randint(3, 10))
+    )
+    return (
+        f"<html><head><title>Page {i}</title></head><body>"
+        f"<header><nav><ul>{links}</ul></nav></header>"
+        f"<div class='page-wrapper'><aside><ul>{links}</ul></aside></div>"
+        f"<main><article>{sections}</article>"
+        f"<div role='region'>{paragraphs(rng, 1)}</div><div id='faqs'>{paragraphs(rng, 3)}</div>"
+        f"<div class='blog-post_newsletter'>{paragraphs(rng, 1)}</div>"
+        f"<section class='section-more-blog-posts'>{paragraphs(rng, 2)}</section></main>"
+        f"<footer>{links}</footer></body></html>"
+    )
+
+
+def load_corpus(corpus: Optional[str], pages: int) -> list[tuple[str, dict]]:
+    if corpus is None:
+        rng = random.Random(0)
+        return [(synthetic_page(rng, i), {"loc": f"https://docs.example.com/page-{i}"}) for i in range(pages)]
+    files = sorted(os.path.join(corpus, name) for name in os.listdir(corpus) if name.endswith(".html"))
+    result = []
+    for path in files:
+        with open(path, encoding="utf-8") as f:
+            result.append((f.read(), {"loc": f"file://{os.path.abspath(path)}"}))
+    return result
+
+
+def run_legacy(corpus: list[tuple[str, dict]], parse_only: bool) -> list[Document]:
+    documents = [parse_page(html, entry, legacy_parse_content_fn, trim_metadata_fn) for html, entry in corpus]
+    return documents if parse_only else legacy_split_documents(documents)
+
+
+async def run_pooled(corpus: list[tuple[str, dict]], pool: Optional[Executor], parse_only: bool) -> list[Document]:
+    loop = asyncio.get_running_loop()
+
+    async def process(html: str, entry: dict) -> list[Document]:
+        document = await loop.run_in_executor(pool, parse_page, html, entry, parse_content_fn, trim_metadata_fn)
+        return [document] if parse_only else await loop.run_in_executor(pool, split_documents, [document])
+
+    results = await asyncio.gather(*(process(html, entry) for html, entry in corpus))
+    return [document for documents in results for document in documents]
+
+
+def snapshot_round_trip(pages: list[Document], chunks: list[Document], pooled_seconds: float) -> None:
+    by_source: dict[str, list[Document]] = {}
+    for chunk in chunks:
+        by_source.setdefault(chunk.metadata["source"], []).append(chunk)
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(scratch, "corpus.jsonl.gz")
+        start = time.perf_counter()
+        with SnapshotWriter(path, split_params(SPLIT_CHUNK_SIZE, SPLIT_CHUNK_OVERLAP)) as snapshot:
+            for page in pages:
+                snapshot.write(page, by_source.get(page.metadata["source"], []))
+        write_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        replayed = [chunk for _, page_chunks in CorpusSnapshot(path).pages() for chunk in page_chunks or []]
+        read_seconds = time.perf_counter() - start
+        megabytes = os.path.getsize(path) / 1e6
+    same = [(d.page_content, d.metadata) for d in replayed] == [
+        (d.page_content, d.metadata) for page in pages for d in by_source.get(page.metadata["source"], [])
+    ]
+    print(
+        f"snapshot, {megabytes:.1f} MB: written in {write_seconds:.2f}s, read in {read_seconds:.2f}s "
+        f"({pooled_seconds / read_seconds:.1f}x faster than parsing and splitting), identical: {same}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", help="A directory of .html pages. Defaults to a synthetic corpus.")
+    parser.add_argument("--pages", type=int, default=300, help="Pages in the synthetic corpus.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes in the pool.")
+    parser.add_argument("--parse-only", action="store_true", help="Skip splitting.")
+    parser.add_argument("--snapshot", action="store_true", help="Also time writing and reading a corpus snapshot.")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus, args.pages)
+    megabytes = sum(len(html) for html, _entry in corpus) / 1e6
+    print(f"{len(corpus)} pages, {megabytes:.1f} MB of HTML")
+
+    start = time.perf_counter()
+    legacy = run_legacy(corpus, args.parse_only)
+    legacy_seconds = time.perf_counter() - start
+    print(f"serial, 12 find_all passes:  {legacy_seconds:.2f}s ({len(corpus) / legacy_seconds:.0f} pages/s)")
+
+    pool = create_process_pool(args.workers)
+    try:
+        # Start the workers and load their imports outside the timed section, as a reindex only
+        # pays for this once.
+        asyncio.run(run_pooled(corpus[: args.workers * 2], pool, args.parse_only))
+        start = time.perf_counter()
+        pooled = asyncio.run(run_pooled(corpus, pool, args.parse_only))
+        pooled_seconds = time.perf_counter() - start
+        pages = asyncio.run(run_pooled(corpus, pool, parse_only=True)) if args.snapshot else []
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    print(
+        f"{args.workers} workers, single pass:  {pooled_seconds:.2f}s ({len(corpus) / pooled_seconds:.0f} pages/s), "
+        f"{legacy_seconds / pooled_seconds:.1f}x"
+    )
+
+    def key(document: Document) -> tuple:
+        return document.metadata["source"], document.metadata.get("start_index", 0)
+
+    same = [(d.page_content, d.metadata) for d in sorted(legacy, key=key)] == [
+        (d.page_content, d.metadata) for d in sorted(pooled, key=key)
+    ]
+    print(f"{len(pooled)} {'documents' if args.parse_only else 'chunks'}, identical: {same}")
+    if args.snapshot and not args.parse_only:
+        snapshot_round_trip(pages, pooled, pooled_seconds)
+
+
+if __name__ == "__main__":
+    main()
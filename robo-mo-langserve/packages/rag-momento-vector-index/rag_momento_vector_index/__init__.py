@@ -1,3 +1,3 @@
-from rag_momento_vector_index.chain import chain
+from rag_momento_vector_index.chain import chain, chat_chain
 
-__all__ = ["chain"]
+__all__ = ["chain", "chat_chain"]
@@ -0,0 +1,198 @@
+"""
+Index aliases, so that reindexing can build a new index generation while the old one keeps serving.
+
+An alias is the logical index name (eg `MOMENTO_INDEX_NAME`) and points at the physical
+index generation that queries should go to. Reindexing builds a fresh generation, validates it
+and then flips the alias. The serving path resolves the alias through `ActiveIndexResolver`,
+which keeps the active generation in memory and only goes back to the alias store once its
+TTL expires.
+
+The alias store is a Momento cache when `INDEX_ALIAS_CACHE_NAME` is set, so that every server
+sees the flip, and a local JSON file otherwise.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from functools import cached_property
+from typing import Optional
+
+from momento import CacheClient
+from momento.responses import CacheGet, CacheSet
+
+from .manifest import MANIFEST_DIR
+from .momento_cache import create_cache_client
+
+logger = logging.getLogger(__name__)
+
+ALIAS_CACHE_NAME = os.environ.get("INDEX_ALIAS_CACHE_NAME")
+ALIAS_FILE = os.path.join(MANIFEST_DIR, "aliases.json")
+ALIAS_TTL_SECONDS = float(os.environ.get("INDEX_ALIAS_TTL_SECONDS", "30"))
+
+
+def new_generation_name(alias: str) -> str:
+    return f"{alias}-g{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}"
+
+
+def is_generation_of(alias: str, index_name: str) -> bool:
+    return re.fullmatch(rf"{re.escape(alias)}-g\d{{14}}", index_name) is not None
+
+
+class AliasStore(ABC):
+    """Where aliases are persisted."""
+
+    @abstractmethod
+    def get(self, alias: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def set(self, alias: str, index_name: str) -> None:
+        pass
+
+
+class FileAliasStore(AliasStore):
+    """Keeps aliases in a local JSON file. Only suitable when a single server serves the index."""
+
+    def __init__(self, path: str = ALIAS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _read(self) -> dict[str, str]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def get(self, alias: str) -> Optional[str]:
+        with self._lock:
+            return self._read().get(alias)
+
+    def set(self, alias: str, index_name: str) -> None:
+        with self._lock:
+            aliases = self._read()
+            aliases[alias] = index_name
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(aliases, f)
+            os.replace(tmp_path, self.path)
+
+
+class MomentoCacheAliasStore(AliasStore):
+    """Keeps aliases in a Momento cache so every server resolves to the same generation."""
+
+    KEY_PREFIX = "index-alias:"
+    # Aliases should outlive any reindex schedule; they are overwritten on every flip.
+    TTL = timedelta(days=365)
+
+    def __init__(self, cache_name: str, momento_env_var_name: str = "MOMENTO_API_KEY"):
+        self.cache_name = cache_name
+        self.momento_env_var_name = momento_env_var_name
+
+    @cached_property
+    def client(self) -> CacheClient:
+        return create_cache_client(self.cache_name, self.TTL, self.momento_env_var_name)
+
+    def get(self, alias: str) -> Optional[str]:
+        response = self.client.get(self.cache_name, self.KEY_PREFIX + alias)
+        if isinstance(response, CacheGet.Hit):
+            return response.value_string
+        elif isinstance(response, CacheGet.Miss):
+            return None
+        elif isinstance(response, CacheGet.Error):
+            raise response.inner_exception
+        raise Exception(f"Unexpected response: {response}")
+
+    def set(self, alias: str, index_name: str) -> None:
+        response = self.client.set(self.cache_name, self.KEY_PREFIX + alias, index_name)
+        if isinstance(response, CacheSet.Error):
+            raise response.inner_exception
+
+
+def create_alias_store(momento_env_var_name: str = "MOMENTO_API_KEY") -> AliasStore:
+    if ALIAS_CACHE_NAME:
+        return MomentoCacheAliasStore(ALIAS_CACHE_NAME, momento_env_var_name)
+    return FileAliasStore()
+
+
+class ActiveIndexResolver:
+    """Resolves an alias to its active index generation without a remote lookup per call.
+
+    The resolved name is cached in memory for `ttl_seconds`. If the alias store cannot be
+    reached, the last known generation keeps being served. An alias that was never set
+    resolves to itself, which keeps indexes created before aliases were introduced working.
+
+    Alongside the generation, the resolver tracks a version token that changes whenever the
+    content of the index changes, including incremental reindexes of the same generation, so
+    that caches derived from the index know when to drop their entries.
+    """
+
+    def __init__(self, alias: str, store: AliasStore, ttl_seconds: float = ALIAS_TTL_SECONDS):
+        self.alias = alias
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self._index_name: Optional[str] = None
+        self._version = ""
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def version_key(self) -> str:
+        return f"{self.alias}#version"
+
+    def resolve(self) -> str:
+        if self._index_name is not None and time.monotonic() < self._expires_at:
+            return self._index_name
+        return self.refresh()
+
+    def version(self) -> str:
+        """Returns the version of the active index, eg to key caches with."""
+        return f"{self.resolve()}@{self._version}"
+
+    def refresh(self) -> str:
+        with self._lock:
+            try:
+                self._index_name = self.store.get(self.alias) or self.alias
+                self._version = self.store.get(self.version_key) or ""
+            except Exception as e:
+                if self._index_name is None:
+                    raise
+                logger.warning(f"Could not refresh alias {self.alias}, still using {self._index_name}: {e}")
+            self._expires_at = time.monotonic() + self.ttl_seconds
+            return self._index_name
+
+    def set(self, index_name: str) -> None:
+        """Points the alias at `index_name`, both in the store and in this process."""
+        with self._lock:
+            self.store.set(self.alias, index_name)
+            self._index_name = index_name
+            self._set_version()
+        logger.info(f"Alias {self.alias} now points to {index_name}.")
+
+    def bump_version(self) -> None:
+        """Records that the content of the active index changed."""
+        with self._lock:
+            self._set_version()
+
+    def _set_version(self) -> None:
+        self._version = datetime.now(timezone.utc).isoformat()
+        self.store.set(self.version_key, self._version)
+        self._expires_at = time.monotonic() + self.ttl_seconds
+
+
+_resolvers: dict[str, ActiveIndexResolver] = {}
+_resolvers_lock = threading.Lock()
+
+
+def get_index_resolver(alias: str, momento_env_var_name: str = "MOMENTO_API_KEY") -> ActiveIndexResolver:
+    """Returns the process-wide resolver for `alias`, so a flip by the reindexer is seen at once."""
+    with _resolvers_lock:
+        if alias not in _resolvers:
+            _resolvers[alias] = ActiveIndexResolver(alias, create_alias_store(momento_env_var_name))
+        return _resolvers[alias]
@@ -0,0 +1,182 @@
+"""
+A semantic cache of final answers, consulted before running the RAG chain.
+
+Questions are embedded and compared against previously answered ones. If a prior question
+is at least `ANSWER_CACHE_SIMILARITY_THRESHOLD` similar (cosine), its postprocessed answer is
+returned instead of running retrieval and the LLM again. Entries expire after
+`ANSWER_CACHE_TTL_SECONDS` and are dropped whenever the index they were answered from changes.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import Runnable, RunnableGenerator, RunnableLambda
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE", "true").lower() == "true"
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.97"))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get("ANSWER_CACHE_TTL_SECONDS", str(60 * 60)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+
+
+class SemanticAnswerCache:
+    """An in-memory, fixed size store of (question embedding, answer) pairs.
+
+    Embeddings live in a preallocated matrix so that a lookup is a single matrix-vector
+    product. When full, the least recently used entry is replaced.
+
+    Args:
+        embeddings (Embeddings): Used to embed questions.
+        index_version (Callable[[], str]): Returns the version of the index answers are
+            generated from. The cache is cleared whenever it changes.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        index_version: Callable[[], str],
+        similarity_threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD,
+        ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+    ):
+        self.embeddings = embeddings
+        self.index_version = index_version
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None
+        self._answers: list[Optional[str]] = [None] * max_entries
+        self._expires_at = np.zeros(max_entries)
+        self._last_used = np.zeros(max_entries)
+        self._version = ""
+
+    @staticmethod
+    def _normalize(embedding: list[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _check_version(self) -> None:
+        version = self.index_version()
+        if version != self._version:
+            if self._version:
+                logger.info(f"Index changed to {version}, clearing the answer cache.")
+            self.clear()
+            self._version = version
+
+    def clear(self) -> None:
+        with self._lock:
+            self._answers = [None] * self.max_entries
+            self._expires_at[:] = 0
+
+    def lookup(self, question: str) -> Optional[str]:
+        """Returns the answer to a sufficiently similar question, if there is one."""
+        self._check_version()
+        return self._lookup_vector(self._normalize(self.embeddings.embed_query(question)))
+
+    async def alookup(self, question: str) -> Optional[str]:
+        self._check_version()
+        return self._lookup_vector(self._normalize(await self.embeddings.aembed_query(question)))
+
+    def lookup_embedding(self, embedding: list[float]) -> Optional[str]:
+        """Like `lookup`, for a question that has already been embedded."""
+        self._check_version()
+        return self._lookup_vector(self._normalize(embedding))
+
+    def _lookup_vector(self, vector: np.ndarray) -> Optional[str]:
+        with self._lock:
+            if self._vectors is None:
+                self.misses += 1
+                return None
+            now = time.time()
+            scores = self._vectors @ vector
+            scores[self._expires_at <= now] = -np.inf
+            slot = int(np.argmax(scores))
+            if scores[slot] < self.similarity_threshold:
+                self.misses += 1
+                return None
+            self._last_used[slot] = now
+            self.hits += 1
+            return self._answers[slot]
+
+    def store(self, question: str, answer: str) -> None:
+        self._check_version()
+        self._store_vector(self._normalize(self.embeddings.embed_query(question)), answer)
+
+    async def astore(self, question: str, answer: str) -> None:
+        self._check_version()
+        self._store_vector(self._normalize(await self.embeddings.aembed_query(question)), answer)
+
+    def store_embedding(self, embedding: list[float], answer: str) -> None:
+        self._check_version()
+        self._store_vector(self._normalize(embedding), answer)
+
+    def _store_vector(self, vector: np.ndarray, answer: str) -> None:
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            now = time.time()
+            free = np.flatnonzero(self._expires_at <= now)
+            slot = int(free[0]) if free.size else int(np.argmin(self._last_used))
+            self._vectors[slot] = vector
+            self._answers[slot] = answer
+            self._expires_at[slot] = now + self.ttl_seconds
+            self._last_used[slot] = now
+
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+def replay_answer(answer: str) -> Runnable:
+    """A runnable that ignores its input and streams `answer` word by word."""
+
+    chunks = re.findall(r"\s*\S+|\s+$", answer) or [answer]
+
+    def replay(_input: Iterator) -> Iterator[str]:
+        yield from chunks
+
+    async def areplay(_input: AsyncIterator) -> AsyncIterator[str]:
+        for chunk in chunks:
+            yield chunk
+
+    return RunnableGenerator(replay, areplay)
+
+
+def with_answer_cache(chain: Runnable, cache: SemanticAnswerCache) -> Runnable:
+    """Puts `cache` in front of `chain`, which takes a question and returns the final answer."""
+
+    def store_answer(question: str) -> Runnable:
+        def store(chunks: Iterator[str]) -> Iterator[str]:
+            response = []
+            for chunk in chunks:
+                response.append(chunk)
+                yield chunk
+            cache.store(question, "".join(response))
+
+        async def astore(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+            response = []
+            async for chunk in chunks:
+                response.append(chunk)
+                yield chunk
+            await cache.astore(question, "".join(response))
+
+        return chain | RunnableGenerator(store, astore)
+
+    def answer(question: str) -> Runnable:
+        cached = cache.lookup(question)
+        return replay_answer(cached) if cached is not None else store_answer(question)
+
+    async def aanswer(question: str) -> Runnable:
+        cached = await cache.alookup(question)
+        return replay_answer(cached) if cached is not None else store_answer(question)
+
+    return RunnableLambda(answer, afunc=aanswer)
@@ -0,0 +1,93 @@
+"""
+A single-file format for the local indexes built alongside each index generation.
+
+A file holds a JSON header followed by raw, aligned numpy arrays, which are memory-mapped when
+the file is loaded, so loading is cheap and the pages are shared between processes. Chunks are
+stored as JSON records concatenated into one byte array, with an array of their offsets.
+"""
+import json
+import logging
+import math
+import os
+import struct
+from typing import Any, Optional
+
+import numpy as np
+from langchain.docstore.document import Document
+
+logger = logging.getLogger(__name__)
+
+ALIGNMENT = 8
+
+
+def write_array_file(path: str, header: dict[str, Any], arrays: dict[str, np.ndarray]) -> None:
+    """Atomically writes `header` and `arrays` to `path`. The header must be JSON serializable."""
+    specs, offset = {}, 0
+    for name, array in arrays.items():
+        specs[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+    encoded = json.dumps({**header, "arrays": specs}).encode("utf-8")
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(encoded)))
+        f.write(encoded)
+        f.write(b"\0" * (_align(8 + len(encoded)) - 8 - len(encoded)))
+        for array in arrays.values():
+            f.write(np.ascontiguousarray(array).tobytes())
+            f.write(b"\0" * (_align(array.nbytes) - array.nbytes))
+    os.replace(tmp_path, path)
+
+
+def read_array_file(path: str, version: int) -> Optional[tuple[dict[str, Any], dict[str, np.ndarray]]]:
+    """Reads the header of the file at `path` and memory-maps its arrays, returning None if there
+    is no such file or it is unreadable or of another `version`."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            (header_length,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_length))
+    except (OSError, ValueError, struct.error) as e:
+        logger.warning(f"Ignoring unreadable index file {path}: {e}")
+        return None
+    if header.get("version") != version:
+        logger.warning(f"Ignoring index file {path} with unsupported version {header.get('version')}.")
+        return None
+    data_start = _align(8 + header_length)
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        shape = tuple(spec["shape"])
+        if math.prod(shape) == 0:
+            arrays[name] = np.empty(shape, dtype=spec["dtype"])
+        else:
+            arrays[name] = np.memmap(path, dtype=spec["dtype"], mode="r", offset=data_start + spec["offset"], shape=shape)
+    return header, arrays
+
+
+def pack_chunks(chunks: list[tuple[str, Document]]) -> dict[str, np.ndarray]:
+    """Encodes (chunk id, chunk) pairs as the `chunk_offsets` and `chunks` arrays."""
+    records = [
+        json.dumps({"id": id_, "text": document.page_content, "metadata": document.metadata}, ensure_ascii=False).encode(
+            "utf-8"
+        )
+        for id_, document in chunks
+    ]
+    offsets = np.zeros(len(records) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(record) for record in records])
+    return {"chunk_offsets": offsets, "chunks": np.frombuffer(b"".join(records), dtype=np.uint8)}
+
+
+def unpack_chunk(arrays: dict[str, np.ndarray], i: int) -> tuple[str, Document]:
+    """Returns the chunk id and the chunk stored at position `i`."""
+    offsets = arrays["chunk_offsets"]
+    start, end = int(offsets[i]), int(offsets[i + 1])
+    record = json.loads(arrays["chunks"][start:end].tobytes())
+    return record["id"], Document(page_content=record["text"], metadata=record["metadata"])
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
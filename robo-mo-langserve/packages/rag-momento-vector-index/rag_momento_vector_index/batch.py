@@ -0,0 +1,236 @@
+"""
+Answers large batches of questions, eg offline evaluation runs, with shared and bounded work.
+
+Rather than running one pipeline per question, the questions are embedded in a few large
+embedding requests, their vector searches fan out with bounded concurrency, and completions are
+scheduled to stay within the OpenAI tokens-per-minute limit. Answers are yielded as they
+complete rather than once the whole batch is done.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional, Sequence, Type, Union
+
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.pydantic_v1 import BaseModel
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import get_config_list
+from langchain_core.runnables.utils import ConfigurableFieldSpec
+
+from .answer_cache import SemanticAnswerCache
+from .context import encoding
+from .routing import ModelRouter
+
+logger = logging.getLogger(__name__)
+
+BATCH_EMBED_SIZE = int(os.environ.get("BATCH_EMBED_SIZE", "256"))
+BATCH_SEARCH_CONCURRENCY = int(os.environ.get("BATCH_SEARCH_CONCURRENCY", "16"))
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "8"))
+# The OpenAI tokens-per-minute limit to stay within. 0 disables rate limiting.
+OPENAI_TOKENS_PER_MINUTE = int(os.environ.get("OPENAI_TOKENS_PER_MINUTE", "0"))
+# Completion tokens reserved for each answer, on top of the prompt tokens.
+COMPLETION_TOKEN_ESTIMATE = int(os.environ.get("COMPLETION_TOKEN_ESTIMATE", "400"))
+
+
+class TokenRateLimiter:
+    """Bounds concurrent completions and the tokens they use per minute.
+
+    Tokens are drawn from a bucket that holds up to a minute's worth and refills continuously.
+    Waiters are served in order, so a large request is not starved by smaller ones.
+
+    Args:
+        tokens_per_minute (int): The limit to stay within. 0 disables it.
+        max_concurrency (int): How many completions may be in flight.
+    """
+
+    def __init__(self, tokens_per_minute: int = OPENAI_TOKENS_PER_MINUTE, max_concurrency: int = LLM_CONCURRENCY):
+        self.tokens_per_minute = tokens_per_minute
+        self._slots = asyncio.Semaphore(max(1, max_concurrency))
+        self._lock = asyncio.Lock()
+        self._available = float(tokens_per_minute)
+        self._updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        rate = self.tokens_per_minute / 60
+        self._available = min(self.tokens_per_minute, self._available + (now - self._updated_at) * rate)
+        self._updated_at = now
+
+    async def _take(self, tokens: int) -> None:
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self._lock:
+            self._refill()
+            while self._available < tokens:
+                await asyncio.sleep((tokens - self._available) * 60 / self.tokens_per_minute)
+                self._refill()
+            self._available -= tokens
+
+    @asynccontextmanager
+    async def reserve(self, tokens: int) -> AsyncIterator[None]:
+        """Waits for a free slot and for `tokens` to be available, and holds the slot."""
+        async with self._slots:
+            if self.tokens_per_minute > 0:
+                await self._take(tokens)
+            yield
+
+
+class BatchAnswerer:
+    """Answers many questions with batched embedding, bounded search and scheduled completions.
+
+    Args:
+        embeddings (Embeddings): Embeds the questions, `BATCH_EMBED_SIZE` at a time.
+        search (Callable[[str, list[float]], Awaitable[list[Document]]]): Retrieves the
+            documents for a question given its embedding.
+        format_docs (Callable[[list[Document]], str]): Formats the documents as the context.
+        router (ModelRouter): Picks the prompt and model to answer each question with.
+        answer_cache (Optional[SemanticAnswerCache]): Consulted and filled with the
+            precomputed question embeddings, if given.
+        limiter (Optional[TokenRateLimiter]): Schedules the completions.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        search: Callable[[str, list[float]], Awaitable[list[Document]]],
+        format_docs: Callable[[list[Document]], str],
+        router: ModelRouter,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        limiter: Optional[TokenRateLimiter] = None,
+    ):
+        self.embeddings = embeddings
+        self.search = search
+        self.format_docs = format_docs
+        self.router = router
+        self.answer_cache = answer_cache
+        self.limiter = limiter if limiter is not None else TokenRateLimiter()
+        self._search_slots = asyncio.Semaphore(max(1, BATCH_SEARCH_CONCURRENCY))
+
+    async def _answer(self, question: str, vector: list[float], config: RunnableConfig) -> str:
+        if self.answer_cache is not None and (cached := self.answer_cache.lookup_embedding(vector)) is not None:
+            return cached
+        async with self._search_slots:
+            docs = await self.search(question, vector)
+        context = self.format_docs(docs)
+        tier = self.router.choose(question, context)
+        prompt = tier.build_prompt({"context": context, "question": question})
+        tokens = len(encoding().encode(prompt.to_string(), disallowed_special=())) + COMPLETION_TOKEN_ESTIMATE
+        async with self.limiter.reserve(tokens):
+            answer = await tier.llm.ainvoke(prompt, config)
+        # Nothing found usually means the search failed, which should not be replayed to similar questions.
+        if self.answer_cache is not None and docs:
+            self.answer_cache.store_embedding(vector, answer)
+        return answer
+
+    async def answer_as_completed(
+        self,
+        questions: Sequence[str],
+        config: Optional[Union[RunnableConfig, list[RunnableConfig]]] = None,
+        return_exceptions: bool = False,
+    ) -> AsyncIterator[tuple[int, Union[str, Exception]]]:
+        """Yields the index of each question and its answer as soon as it is answered.
+
+        Questions are answered as soon as the embedding request they are part of returns. If
+        `return_exceptions` is set, failures are yielded in place of answers, otherwise the
+        first failure is raised and the remaining questions are cancelled.
+        """
+        configs = get_config_list(config, len(questions))
+        results: asyncio.Queue = asyncio.Queue()
+        tasks: list[asyncio.Task] = []
+
+        async def answer(i: int, vector: list[float]) -> None:
+            try:
+                result: Union[str, Exception] = await self._answer(questions[i], vector, configs[i])
+            except Exception as e:
+                result = e
+            results.put_nowait((i, result))
+
+        async def dispatch() -> None:
+            for start in range(0, len(questions), BATCH_EMBED_SIZE):
+                batch = list(questions[start : start + BATCH_EMBED_SIZE])
+                try:
+                    vectors = await self.embeddings.aembed_documents(batch)
+                except Exception as e:
+                    logger.warning(f"Embedding questions {start} to {start + len(batch)} failed: {e}")
+                    for i in range(start, start + len(batch)):
+                        results.put_nowait((i, e))
+                    continue
+                tasks.extend(asyncio.create_task(answer(start + j, vector)) for j, vector in enumerate(vectors))
+
+        dispatcher = asyncio.create_task(dispatch())
+        try:
+            for _ in range(len(questions)):
+                i, result = await results.get()
+                if isinstance(result, Exception) and not return_exceptions:
+                    raise result
+                yield i, result
+        finally:
+            dispatcher.cancel()
+            for task in tasks:
+                task.cancel()
+
+
+class BatchedRunnable(Runnable[str, str]):
+    """Runs `chain` as is, except that batches go through `answerer`.
+
+    Args:
+        chain (Runnable[str, str]): Answers a single question.
+        answerer (Callable[[], BatchAnswerer]): Returns the answerer of batches, which is
+            created on the first batch.
+    """
+
+    def __init__(self, chain: Runnable[str, str], answerer: Callable[[], BatchAnswerer]):
+        self.chain = chain
+        self.answerer = answerer
+
+    @property
+    def config_specs(self) -> list[ConfigurableFieldSpec]:
+        return self.chain.config_specs
+
+    def get_input_schema(self, config: Optional[RunnableConfig] = None) -> Type[BaseModel]:
+        return self.chain.get_input_schema(config)
+
+    def get_output_schema(self, config: Optional[RunnableConfig] = None) -> Type[BaseModel]:
+        return self.chain.get_output_schema(config)
+
+    def invoke(self, input: str, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        return self.chain.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input: str, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        return await self.chain.ainvoke(input, config, **kwargs)
+
+    def stream(self, input: str, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[str]:
+        yield from self.chain.stream(input, config, **kwargs)
+
+    async def astream(
+        self, input: str, config: Optional[RunnableConfig] = None, **kwargs: Any
+    ) -> AsyncIterator[str]:
+        async for chunk in self.chain.astream(input, config, **kwargs):
+            yield chunk
+
+    async def abatch_as_completed(
+        self,
+        inputs: Sequence[str],
+        config: Optional[Union[RunnableConfig, Sequence[RunnableConfig]]] = None,
+        *,
+        return_exceptions: bool = False,
+        **kwargs: Any,
+    ) -> AsyncIterator[tuple[int, Union[str, Exception]]]:
+        configs = get_config_list(config, len(inputs))
+        async for i, result in self.answerer().answer_as_completed(inputs, configs, return_exceptions):
+            yield i, result
+
+    async def abatch(
+        self,
+        inputs: list[str],
+        config: Optional[Union[RunnableConfig, list[RunnableConfig]]] = None,
+        *,
+        return_exceptions: bool = False,
+        **kwargs: Any,
+    ) -> list[Union[str, Exception]]:
+        results: list[Union[str, Exception]] = [""] * len(inputs)
+        async for i, result in self.abatch_as_completed(inputs, config, return_exceptions=return_exceptions):
+            results[i] = result
+        return results
@@ -1,24 +1,58 @@
+import asyncio
+import logging
 import os
-import re
+from functools import lru_cache
+from typing import Any, Callable, Optional, TypeVar
 
 from langchain.schema import Document, StrOutputParser
 from langchain_community.vectorstores import MomentoVectorIndex
+from langchain_core.embeddings import Embeddings
 from langchain_core.pydantic_v1 import BaseModel
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda, RunnablePassthrough
+from langchain_openai import ChatOpenAI
 from momento import (
     CredentialProvider,
     PreviewVectorIndexClient,
+    PreviewVectorIndexClientAsync,
     VectorIndexConfigurations,
 )
+from momento.requests.vector_index import ALL_METADATA
+from momento.responses.vector_index import Search
 
-from .prompts import QA_PROMPT
+from .aliases import get_index_resolver
+from .answer_cache import ANSWER_CACHE_ENABLED, SemanticAnswerCache, with_answer_cache
+from .batch import BatchAnswerer, BatchedRunnable
+from .context import pack_context
+from .conversation import ConversationMemory, create_conversation_store, with_conversation_memory
+from .embedding_cache import embedding_stats, get_embeddings
+from .hybrid import HYBRID_RETRIEVAL, RERANKER, lexical_index_for, reciprocal_rank_fusion, rerank
+from .local_index import LOCAL_VECTOR_FALLBACK_TIMEOUT_SECONDS, LOCAL_VECTOR_INDEX, local_vector_index_for
+from .metrics import (
+    LOCAL_VECTOR_SEARCHES,
+    REGISTRY,
+    RETRIEVED_DOCUMENTS,
+    CallbackGauge,
+    llm_callbacks,
+    register_cache_stats,
+    stage,
+    timed,
+)
+from .prompts import CONDENSE_QUESTION_PROMPT, SUMMARY_PROMPT
+from .retrieval_cache import RETRIEVAL_CACHE_ENABLED, RetrievalCache
+from .routing import LLM_TIMEOUT_SECONDS, ModelRouter, build_tiers
+from .single_flight import REQUEST_COALESCING_ENABLED, SingleFlight, with_single_flight
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
 
 API_KEY_ENV_VAR_NAME = "MOMENTO_API_KEY"
 if os.environ.get(API_KEY_ENV_VAR_NAME, None) is None:
     raise Exception(f"Missing `{API_KEY_ENV_VAR_NAME}` environment variable.")
 
 MOMENTO_INDEX_NAME = os.environ.get("MOMENTO_INDEX_NAME", "langchain-test")
+RETRIEVAL_K = int(os.environ.get("RETRIEVAL_K", "4"))
+TEXT_FIELD = "text"
 
 ### Sample Ingest Code - this populates the vector index with data
 ### Run this on the first time to seed with data
@@ -26,40 +60,327 @@ MOMENTO_INDEX_NAME = os.environ.get("MOMENTO_INDEX_NAME", "langchain-test")
 # ingest.load(API_KEY_ENV_VAR_NAME, MOMENTO_INDEX_NAME)
 
 
+# Clients, models and caches are created on first use rather than at import, which keeps
+# startup fast. Importing this module only wires up the chains.
+def built(factory: Callable[[], T]) -> Optional[T]:
+    """Returns what the cached `factory` returned, or None if it was not called yet."""
+    return factory() if factory.cache_info().currsize else None  # type: ignore[attr-defined]
+
+
 # Vector store setup
-vectorstore = MomentoVectorIndex(
-    embedding=OpenAIEmbeddings(),
-    client=PreviewVectorIndexClient(
+# MOMENTO_INDEX_NAME is an alias; reindexing flips it to a new index generation once that is ready.
+# The alias store connects on its first lookup.
+index_resolver = get_index_resolver(MOMENTO_INDEX_NAME, API_KEY_ENV_VAR_NAME)
+
+
+@lru_cache(maxsize=None)
+def embeddings() -> Embeddings:
+    return get_embeddings(momento_env_var_name=API_KEY_ENV_VAR_NAME)
+
+
+@lru_cache(maxsize=None)
+def vector_index_client() -> PreviewVectorIndexClient:
+    return PreviewVectorIndexClient(
         configuration=VectorIndexConfigurations.Default.latest(),
         credential_provider=CredentialProvider.from_environment_variable(API_KEY_ENV_VAR_NAME),
-    ),
-    index_name=MOMENTO_INDEX_NAME,
-)
-retriever = vectorstore.as_retriever()
+    )
+
+
+@lru_cache(maxsize=4)
+def vectorstore_for(index_name: str) -> MomentoVectorIndex:
+    return MomentoVectorIndex(embedding=embeddings(), client=vector_index_client(), index_name=index_name)
+
+
+@lru_cache(maxsize=None)
+def async_vector_index_client() -> PreviewVectorIndexClientAsync:
+    # Created on first use, from within the serving event loop that its gRPC channel binds to,
+    # and then shared by all requests.
+    return PreviewVectorIndexClientAsync(
+        configuration=VectorIndexConfigurations.Default.latest(),
+        credential_provider=CredentialProvider.from_environment_variable(API_KEY_ENV_VAR_NAME),
+    )
+
+
+def _rebuild_openai_client(target: BaseModel) -> None:
+    # Runs the model's own validator again to build its clients from the current OPENAI_API_KEY.
+    values = type(target).validate_environment(  # type: ignore[attr-defined]
+        {**target.__dict__, "openai_api_key": None, "client": None, "async_client": None}
+    )
+    for field in ["openai_api_key", "client", "async_client"]:
+        setattr(target, field, values[field])
+
+
+def reload_credentials(env_var_names: list[str]) -> None:
+    """Rebuilds the clients that use any of the rotated keys in `env_var_names`, once their
+    environment variables hold the new keys. Requests in flight finish with the old clients."""
+    if API_KEY_ENV_VAR_NAME in env_var_names:
+        vectorstore_for.cache_clear()
+        vector_index_client.cache_clear()
+        async_vector_index_client.cache_clear()
+        # The Momento alias, embedding and conversation stores connect again on their next lookup.
+        memory = built(conversation_memory)
+        for store in [index_resolver.store, getattr(built(embeddings), "store", None), memory and memory.store]:
+            if store is not None:
+                vars(store).pop("client", None)
+    # Models and embeddings that were not created yet will read the new key when they are.
+    if "OPENAI_API_KEY" in env_var_names:
+        for llm in [built(model), *tier_models]:
+            if llm is not None:
+                _rebuild_openai_client(llm)
+        if (underlying := built(embeddings)) is not None:
+            _rebuild_openai_client(getattr(underlying, "underlying", underlying))
+    logger.info(f"Rebuilt the clients using {', '.join(env_var_names)}.")
+
+
+def lexical_search(question: str) -> list[Document]:
+    with stage("lexical_search"):
+        index = lexical_index_for(index_resolver.resolve(), index_resolver.version())
+        return index.search(question, RETRIEVAL_K) if index is not None else []
+
+
+def local_search(vector: list[float]) -> Optional[list[Document]]:
+    """Searches the local vector index for the embedding `vector`, or returns None if there is none."""
+    with stage("local_search"):
+        index = local_vector_index_for(index_resolver.resolve(), index_resolver.version())
+        return index.search(vector, RETRIEVAL_K) if index is not None else None
+
+
+def embed_query(question: str) -> list[float]:
+    with stage("embed_query"):
+        return embeddings().embed_query(question)
+
+
+def vector_search(question: str, config: RunnableConfig) -> list[Document]:
+    if LOCAL_VECTOR_INDEX == "primary" and (docs := local_search(embed_query(question))) is not None:
+        LOCAL_VECTOR_SEARCHES.inc(reason="primary")
+        return docs
+    try:
+        vector_retriever = vectorstore_for(index_resolver.resolve()).as_retriever(search_kwargs={"k": RETRIEVAL_K})
+        return vector_retriever.invoke(question, config)
+    except Exception:
+        # Without an event loop to time out on, this path only falls back when MVI fails.
+        if LOCAL_VECTOR_INDEX != "fallback" or (docs := local_search(embed_query(question))) is None:
+            raise
+        logger.warning("Searching MVI failed, answered from the local vector index.", exc_info=True)
+        LOCAL_VECTOR_SEARCHES.inc(reason="error")
+        return docs
+
+
+def fuse(question: str, vector_docs: list[Document], lexical_docs: list[Document]) -> list[Document]:
+    with stage("rerank"):
+        return rerank(question, reciprocal_rank_fusion([vector_docs, lexical_docs]), RETRIEVAL_K)
+
+
+# Repeated questions reuse the documents retrieved for them until the index changes.
+retrieval_cache = RetrievalCache(index_version=index_resolver.version)
+RETRIEVAL_PARAMS = {"k": RETRIEVAL_K, "hybrid": HYBRID_RETRIEVAL, "reranker": RERANKER}
+
+
+def cached_documents(question: str) -> Optional[list[Document]]:
+    return retrieval_cache.get(question, **RETRIEVAL_PARAMS) if RETRIEVAL_CACHE_ENABLED else None
+
+
+def cache_documents(question: str, docs: list[Document]) -> None:
+    # Nothing found usually means the search failed, which should be retried next time.
+    if RETRIEVAL_CACHE_ENABLED and docs:
+        retrieval_cache.put(question, docs, **RETRIEVAL_PARAMS)
+
+
+@timed("retrieve")
+def retrieve(question: str, config: RunnableConfig) -> list[Document]:
+    docs = cached_documents(question)
+    if docs is None:
+        docs = vector_search(question, config)
+        if HYBRID_RETRIEVAL:
+            docs = fuse(question, docs, lexical_search(question))
+        cache_documents(question, docs)
+    RETRIEVED_DOCUMENTS.observe(len(docs))
+    return docs
+
+
+async def avector_search(question: str, vector: Optional[list[float]] = None) -> list[Document]:
+    """Searches MVI or the local vector index, as `LOCAL_VECTOR_INDEX` says, for `question`,
+    embedding it unless its embedding `vector` is given."""
+    index_name = index_resolver.resolve()
+    if vector is None:
+        with stage("embed_query"):
+            vector = await embeddings().aembed_query(question)
+    if LOCAL_VECTOR_INDEX == "primary" and (docs := await asyncio.to_thread(local_search, vector)) is not None:
+        LOCAL_VECTOR_SEARCHES.inc(reason="primary")
+        return docs
+    fallback = LOCAL_VECTOR_INDEX == "fallback"
+    try:
+        with stage("search"):
+            response = await asyncio.wait_for(
+                async_vector_index_client().search(index_name, vector, top_k=RETRIEVAL_K, metadata_fields=ALL_METADATA),
+                LOCAL_VECTOR_FALLBACK_TIMEOUT_SECONDS if fallback else None,
+            )
+    except asyncio.TimeoutError as e:
+        if not fallback:
+            raise
+        logger.warning(f"Searching {index_name} timed out.")
+        reason, error = "timeout", e
+    except Exception as e:
+        if not fallback:
+            raise
+        logger.warning(f"Searching {index_name} failed.", exc_info=True)
+        reason, error = "error", e
+    else:
+        if isinstance(response, Search.Success):
+            return [
+                Document(page_content=hit.metadata.pop(TEXT_FIELD), metadata=hit.metadata) for hit in response.hits
+            ]
+        logger.warning(f"Searching {index_name} failed: {response}")
+        reason, error = "error", response.inner_exception
+    if fallback and (docs := await asyncio.to_thread(local_search, vector)) is not None:
+        LOCAL_VECTOR_SEARCHES.inc(reason=reason)
+        return docs
+    # Rather than answering from no context, and caching that answer for similar questions.
+    raise error
+
+
+async def ahybrid_search(question: str, vector: Optional[list[float]] = None) -> list[Document]:
+    # The lexical index is searched on a thread while the question is embedded and MVI searched.
+    vector_docs, lexical_docs = await asyncio.gather(
+        avector_search(question, vector), asyncio.to_thread(lexical_search, question)
+    )
+    if RERANKER == "none":
+        return fuse(question, vector_docs, lexical_docs)
+    return await asyncio.to_thread(fuse, question, vector_docs, lexical_docs)
+
+
+@timed("retrieve")
+async def asearch(question: str, vector: Optional[list[float]] = None) -> list[Document]:
+    docs = cached_documents(question)
+    if docs is None:
+        docs = await (ahybrid_search if HYBRID_RETRIEVAL else avector_search)(question, vector)
+        cache_documents(question, docs)
+    RETRIEVED_DOCUMENTS.observe(len(docs))
+    return docs
+
+
+async def aretrieve(question: str) -> list[Document]:
+    # Used by langserve's /invoke and /stream: embeds and searches without blocking the event loop.
+    return await asearch(question)
+
+
+retriever = RunnableLambda(retrieve, afunc=aretrieve)
+
+
+def inline(func: Callable[[Any], Any]) -> RunnableLambda:
+    """Wraps a cheap function so that async callers run it on the event loop rather than
+    handing it to the thread pool as `RunnableLambda` does for sync functions."""
+
+    async def afunc(input: Any) -> Any:
+        return func(input)
+
+    return RunnableLambda(func, afunc=afunc)
+
+
+def deferred(factory: Callable[[], Runnable]) -> RunnableLambda:
+    """Runs the runnable that `factory` returns, so that it is built on the first call."""
+    return inline(lambda _input: factory())
 
 
 # Vector store post-processing
+@timed("format_docs")
 def format_docs(docs: list[Document]) -> str:
+    # Overlapping chunks of a page are stitched together, near-duplicates dropped, and the rest
+    # packed into CONTEXT_TOKEN_BUDGET tokens.
     outputs = []
-    for doc in docs:
+    for doc in pack_context(docs):
         outputs.append(f"Content: {doc.page_content}\nSource: {doc.metadata['source']}")
     return "\n".join(outputs)
 
 
-def postprocess(response: str) -> str:
-    response = re.sub(r"SOURCES:\s*$", "", response)
-    response = re.sub(r"Source:(\s*-?\[.*?\]\(http)", "SOURCES:\\1", response)
-    response = re.sub(r"SOURCES:(\s)", "\n\n*SOURCES*:\\1", response)
-    return response
+@lru_cache(maxsize=None)
+def model() -> ChatOpenAI:
+    # The metrics callbacks record LLM latency, time to first token and token counts.
+    return ChatOpenAI(temperature=0, model="gpt-3.5-turbo", callbacks=llm_callbacks())  # type: ignore
+
+
+tier_models: list[ChatOpenAI] = []
+
+
+def chat_model(tier: str, model_name: str) -> ChatOpenAI:
+    llm = ChatOpenAI(  # type: ignore
+        temperature=0,
+        model=model_name,
+        request_timeout=LLM_TIMEOUT_SECONDS or None,
+        callbacks=llm_callbacks(tier, model_name),
+    )
+    tier_models.append(llm)
+    return llm
+
+
+@lru_cache(maxsize=None)
+def router() -> ModelRouter:
+    # Each question is answered by the model tier its context and wording call for, see routing.py.
+    return ModelRouter(build_tiers(chat_model))
+
+
+def select_tier(inputs: dict) -> Runnable[dict, str]:
+    return router().select(inputs)
+
+
+rag_chain = {"context": retriever | inline(format_docs), "question": RunnablePassthrough()} | inline(select_tier)
 
 
-model = ChatOpenAI(temperature=0, model="gpt-3.5-turbo")  # type: ignore
-chain = (
-    {"context": retriever | format_docs, "question": RunnablePassthrough()}
-    | QA_PROMPT
-    | model
-    | StrOutputParser()
-    | RunnableLambda(postprocess)
+@lru_cache(maxsize=None)
+def answer_cache() -> SemanticAnswerCache:
+    # Repeated questions are answered from the semantic answer cache, which is cleared on reindex.
+    return SemanticAnswerCache(embeddings(), index_version=index_resolver.version)
+
+
+# Concurrent requests for a question not in the cache yet share one run of the chain.
+flights = SingleFlight()
+
+
+@lru_cache(maxsize=None)
+def answer_chain() -> Runnable[str, str]:
+    chain = with_answer_cache(rag_chain, answer_cache()) if ANSWER_CACHE_ENABLED else rag_chain
+    return with_single_flight(chain, flights) if REQUEST_COALESCING_ENABLED else chain
+
+
+@lru_cache(maxsize=None)
+def batch_answerer() -> BatchAnswerer:
+    # Batches embed all their questions in a few requests, bound their searches and schedule their
+    # completions within the OpenAI rate limits, instead of running one pipeline per question.
+    return BatchAnswerer(
+        embeddings(),
+        search=asearch,
+        format_docs=format_docs,
+        router=router(),
+        answer_cache=answer_cache() if ANSWER_CACHE_ENABLED else None,
+    )
+
+
+chain = BatchedRunnable(deferred(answer_chain), batch_answerer)
+
+
+register_cache_stats(
+    "rag_answer_cache_lookups",
+    "Answer cache lookups by result.",
+    lambda: cache.stats() if (cache := built(answer_cache)) is not None else {},
+)
+register_cache_stats(
+    "rag_embedding_cache_lookups",
+    "Embedding cache lookups by result.",
+    lambda: embedding_stats(cache) if (cache := built(embeddings)) is not None else {},
+)
+register_cache_stats("rag_retrieval_cache_lookups", "Retrieval cache lookups by result.", retrieval_cache.stats)
+REGISTRY.register(
+    CallbackGauge(
+        "rag_retrieval_cache_size",
+        "Results and distinct chunks in the retrieval cache, and the bytes of chunk text and metadata.",
+        ("measure",),
+        lambda: {(measure,): value for measure, value in retrieval_cache.footprint().items()},
+    )
+)
+REGISTRY.register(
+    CallbackGauge(
+        "rag_coalesced_flights", "Distinct questions being answered right now.", (), lambda: {(): flights.in_flight()}
+    )
 )
 
 
@@ -68,4 +389,28 @@ class Question(BaseModel):
     __root__: str
 
 
-chain = chain.with_types(input_type=Question)
+chain = chain.with_types(input_type=Question, output_type=str)
+
+
+# Multi-turn chat keeps each session's recent turns and a summary of older ones on the server,
+# and only rewrites questions that refer back to the conversation before answering them.
+@lru_cache(maxsize=None)
+def conversation_memory() -> ConversationMemory:
+    return ConversationMemory(
+        create_conversation_store(API_KEY_ENV_VAR_NAME),
+        condense=CONDENSE_QUESTION_PROMPT | model() | StrOutputParser(),
+        summarize=SUMMARY_PROMPT | model() | StrOutputParser(),
+    )
+
+
+@lru_cache(maxsize=None)
+def conversation_chain() -> Runnable[dict, str]:
+    return with_conversation_memory(chain, conversation_memory())
+
+
+class ChatInput(BaseModel):
+    question: str
+    session_id: str
+
+
+chat_chain = deferred(conversation_chain).with_types(input_type=ChatInput, output_type=str)
@@ -0,0 +1,201 @@
+"""
+Checkpoints of an ingest in progress, so that a reindex that crashed or was cancelled resumes
+where it stopped instead of starting over.
+
+A checkpoint is a journal next to the manifest, `<alias>.checkpoint.jsonl`. Its first line names
+the index being ingested into and whether the ingest is incremental. After each upsert batch,
+every page whose new and changed chunks have all been upserted is appended to it: the page's
+manifest entry, the chunks that were upserted, with their embeddings if a local vector index is
+being built, and the ids of the chunks the page no longer has.
+
+A reindex of the same kind into the same index, the active one or the generation a full reindex
+was building, replays the journal into its manifest, lexical and local vector index builders,
+and only fetches again the pages that were done. Embeddings of chunks that were not upserted yet
+are usually still in the embedding cache. The journal is removed once the reindex completes.
+"""
+import base64
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from langchain.docstore.document import Document
+
+from .embedding_cache import decode_vector, encode_vector
+from .manifest import MANIFEST_DIR, PageEntry
+
+logger = logging.getLogger(__name__)
+
+REINDEX_CHECKPOINTS = os.environ.get("REINDEX_CHECKPOINTS", "true").lower() == "true"
+CHECKPOINT_VERSION = 1
+
+
+def checkpoint_path(alias: str, manifest_dir: str = MANIFEST_DIR) -> str:
+    return os.path.join(manifest_dir, f"{alias}.checkpoint.jsonl")
+
+
+@dataclass
+class CheckpointedPage:
+    """A page whose chunks were all upserted before the checkpoint was written."""
+
+    source: str
+    entry: PageEntry
+    upserted: list[Document] = field(default_factory=list)
+    vectors: Optional[list[list[float]]] = None
+    deleted: list[str] = field(default_factory=list)
+
+
+class IngestCheckpoint:
+    """The journal of the pages an ingest into `index_name` has completed.
+
+    Use `open` rather than the constructor, to pick up where a previous ingest stopped.
+
+    Args:
+        path (str): Where the journal is written.
+        index_name (str): The index being ingested into.
+        incremental (bool): Whether the ingest updates `index_name` in place, rather than
+            loading a new generation.
+        vectors (bool): Whether the embeddings of upserted chunks are kept, for a local vector index.
+        pages (Optional[dict[str, CheckpointedPage]]): The pages already in the journal.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        index_name: str,
+        incremental: bool,
+        vectors: bool,
+        pages: Optional[dict[str, CheckpointedPage]] = None,
+    ):
+        self.path = path
+        self.index_name = index_name
+        self.incremental = incremental
+        self.vectors = vectors
+        self.pages: dict[str, CheckpointedPage] = pages if pages is not None else {}
+        self._file: Any = None
+
+    @classmethod
+    def header(cls, path: str) -> Optional[dict[str, Any]]:
+        """Returns the header of the checkpoint at `path`, or None if there is none or it is unusable."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                header = json.loads(f.readline())
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable reindex checkpoint {path}: {e}")
+            return None
+        if header.get("version") != CHECKPOINT_VERSION:
+            logger.warning(f"Ignoring reindex checkpoint {path} with unsupported version {header.get('version')}.")
+            return None
+        return header
+
+    @classmethod
+    def load(cls, path: str) -> Optional["IngestCheckpoint"]:
+        """Reads the checkpoint at `path`, returning None if there is none or it is unusable.
+
+        A last line cut short by a crash is ignored.
+        """
+        header = cls.header(path)
+        if header is None:
+            return None
+        pages = {}
+        with open(path, encoding="utf-8") as f:
+            f.readline()
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                page = _decode_page(record)
+                pages[page.source] = page
+        return cls(path, header["index_name"], header["incremental"], header["vectors"], pages)
+
+    @classmethod
+    def open(cls, path: str, index_name: str, incremental: bool, vectors: bool) -> "IngestCheckpoint":
+        """Resumes the checkpoint at `path` if it is of an ingest of the same kind into
+        `index_name`, or starts a new one there."""
+        checkpoint = cls.load(path)
+        if checkpoint is not None and checkpoint.matches(index_name, incremental, vectors):
+            logger.info(f"Resuming ingest into {index_name} after {len(checkpoint.pages)} checkpointed pages.")
+        else:
+            checkpoint = cls(path, index_name, incremental, vectors)
+        checkpoint._start()
+        return checkpoint
+
+    def _start(self) -> None:
+        # The journal is rewritten rather than appended to, so that a line cut short by a crash
+        # does not hide the pages recorded after it.
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        header = {
+            "version": CHECKPOINT_VERSION,
+            "index_name": self.index_name,
+            "incremental": self.incremental,
+            "vectors": self.vectors,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(header) + "\n")
+            for page in self.pages.values():
+                f.write(json.dumps(_encode_page(page), ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def matches(self, index_name: str, incremental: bool, vectors: bool) -> bool:
+        return (self.index_name, self.incremental, self.vectors) == (index_name, incremental, vectors)
+
+    def record(
+        self,
+        source: str,
+        entry: PageEntry,
+        upserted: list[Document],
+        vectors: Optional[list[list[float]]],
+        deleted: list[str],
+    ) -> None:
+        """Appends a page whose `upserted` chunks, embedded as `vectors`, are in the index.
+        It is only durable once `commit` is called."""
+        page = CheckpointedPage(source, entry, upserted, vectors if self.vectors else None, deleted)
+        self.pages[source] = page
+        self._file.write(json.dumps(_encode_page(page), ensure_ascii=False) + "\n")
+
+    def commit(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self) -> None:
+        """Deletes the checkpoint, once the reindex it was for is complete."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _encode_page(page: CheckpointedPage) -> dict[str, Any]:
+    record: dict[str, Any] = {
+        "source": page.source,
+        "content_hash": page.entry.content_hash,
+        "chunks": page.entry.chunks,
+        "upserted": [{"text": chunk.page_content, "metadata": chunk.metadata} for chunk in page.upserted],
+        "deleted": page.deleted,
+    }
+    if page.vectors is not None:
+        record["vectors"] = [base64.b64encode(encode_vector(vector)).decode("ascii") for vector in page.vectors]
+    return record
+
+
+def _decode_page(record: dict[str, Any]) -> CheckpointedPage:
+    vectors = record.get("vectors")
+    return CheckpointedPage(
+        source=record["source"],
+        entry=PageEntry(content_hash=record["content_hash"], chunks=record["chunks"]),
+        upserted=[Document(page_content=chunk["text"], metadata=chunk["metadata"]) for chunk in record["upserted"]],
+        vectors=[decode_vector(base64.b64decode(vector)) for vector in vectors] if vectors is not None else None,
+        deleted=record["deleted"],
+    )
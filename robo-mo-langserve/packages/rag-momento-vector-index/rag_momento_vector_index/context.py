@@ -0,0 +1,119 @@
+"""
+Assembles the retrieved chunks into the context of the prompt.
+
+Chunks are split with a token overlap, so the retriever often returns neighbouring chunks of the
+same page that repeat each other. `pack_context` stitches overlapping and adjacent chunks of the
+same `source` back together by `start_index`, drops chunks that are near-duplicates of ones
+already kept, and packs what is left, best ranked first, into a token budget.
+"""
+import os
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+import tiktoken
+from langchain.schema import Document
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1024"))
+# Chunks sharing at least this fraction of their word shingles with a kept chunk are dropped.
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("CONTEXT_NEAR_DUPLICATE_THRESHOLD", "0.8"))
+SHINGLE_WORDS = 5
+# A chunk that does not fit the remaining budget is truncated rather than dropped if at least
+# this many tokens of it fit.
+MIN_TRUNCATED_TOKENS = 32
+ENCODING_MODEL = "gpt-3.5-turbo"
+
+
+@lru_cache(maxsize=None)
+def encoding() -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(ENCODING_MODEL)
+
+
+@dataclass
+class Span:
+    """Contiguous text of one page, stitched from one or more chunks."""
+
+    source: str
+    start: Optional[int]
+    text: str
+    metadata: dict
+    rank: int
+
+    @property
+    def end(self) -> Optional[int]:
+        return None if self.start is None else self.start + len(self.text)
+
+    def extend(self, document: Document, start: int, rank: int) -> bool:
+        """Appends `document`, which starts at `start`, if it overlaps or adjoins this span."""
+        end = self.end
+        if end is None or start > end:
+            return False
+        self.text += document.page_content[end - start :]
+        self.rank = min(self.rank, rank)
+        return True
+
+
+def merge_chunks(documents: list[Document]) -> list[Span]:
+    """Stitches overlapping and adjacent chunks of the same source, keeping the best rank."""
+    spans: list[Span] = []
+    by_source: dict[str, list[tuple[int, int, Document]]] = {}
+    for rank, document in enumerate(documents):
+        source = document.metadata.get("source")
+        start = document.metadata.get("start_index")
+        if source is None or not isinstance(start, (int, float)):
+            spans.append(Span(str(source), None, document.page_content, document.metadata, rank))
+            continue
+        by_source.setdefault(source, []).append((int(start), rank, document))
+
+    for source, chunks in by_source.items():
+        chunks.sort(key=lambda chunk: chunk[0])
+        span: Optional[Span] = None
+        for start, rank, document in chunks:
+            if span is not None and span.extend(document, start, rank):
+                continue
+            span = Span(source, start, document.page_content, document.metadata, rank)
+            spans.append(span)
+    return sorted(spans, key=lambda span: span.rank)
+
+
+def shingles(text: str) -> set[tuple[str, ...]]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= SHINGLE_WORDS:
+        return {tuple(words)}
+    return {tuple(words[i : i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def drop_near_duplicates(spans: list[Span], threshold: float = NEAR_DUPLICATE_THRESHOLD) -> list[Span]:
+    """Drops spans whose shingles are mostly contained in a better ranked span's."""
+    kept: list[tuple[Span, set]] = []
+    for span in spans:
+        span_shingles = shingles(span.text)
+        if any(
+            len(span_shingles & other) >= threshold * len(span_shingles) for _, other in kept if span_shingles
+        ):
+            continue
+        kept.append((span, span_shingles))
+    return [span for span, _ in kept]
+
+
+def pack_context(documents: list[Document], token_budget: int = CONTEXT_TOKEN_BUDGET) -> list[Document]:
+    """Merges, deduplicates and packs `documents`, in retrieval order, into `token_budget` tokens
+    of page content. A budget of 0 or less disables packing but still merges and deduplicates."""
+    packed: list[Document] = []
+    remaining = token_budget
+    for span in drop_near_duplicates(merge_chunks(documents)):
+        text = span.text
+        if token_budget > 0:
+            tokens = encoding().encode(text, disallowed_special=())
+            if len(tokens) > remaining:
+                if remaining < MIN_TRUNCATED_TOKENS:
+                    continue
+                text = encoding().decode(tokens[:remaining])
+                tokens = tokens[:remaining]
+            remaining -= len(tokens)
+        metadata = dict(span.metadata)
+        if span.start is not None:
+            metadata["start_index"] = span.start
+        packed.append(Document(page_content=text, metadata=metadata))
+    return packed
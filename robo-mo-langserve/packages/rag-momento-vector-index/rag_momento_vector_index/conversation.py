@@ -0,0 +1,288 @@
+"""
+Server-side conversation memory for multi-turn chat.
+
+Each session keeps its most recent turns verbatim, as many as fit in
+`CONVERSATION_HISTORY_TOKEN_BUDGET` tokens, and a rolling summary of the turns before them, so a
+turn costs about the same however long the conversation gets. Follow-up questions are rewritten
+into standalone questions from that history before retrieval, but questions that do not refer
+back to it are answered as they are, which saves an LLM call on most turns.
+
+Sessions are kept in memory, evicting the least recently used ones, or with
+`CONVERSATION_STORE=momento` in a Momento cache, so that any server can continue any session.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import timedelta
+from functools import cached_property
+from typing import Any, AsyncIterator, Iterator, Optional
+
+from langchain_core.runnables import Runnable, RunnableGenerator, RunnableLambda
+from momento import CacheClient
+from momento.responses import CacheGet, CacheSet
+
+from .context import encoding
+from .metrics import CONVERSATION_QUESTIONS, stage
+from .momento_cache import create_cache_client
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_STORE = os.environ.get("CONVERSATION_STORE", "local")
+CONVERSATION_CACHE_NAME = os.environ.get("CONVERSATION_CACHE_NAME", "robo-mo-conversations")
+CONVERSATION_MAX_SESSIONS = int(os.environ.get("CONVERSATION_MAX_SESSIONS", "10000"))
+CONVERSATION_TTL_SECONDS = float(os.environ.get("CONVERSATION_TTL_SECONDS", str(24 * 60 * 60)))
+CONVERSATION_HISTORY_TOKEN_BUDGET = int(os.environ.get("CONVERSATION_HISTORY_TOKEN_BUDGET", "1000"))
+
+# Words that usually refer back to something said earlier in the conversation.
+REFERRING_WORDS = set(
+    "it its it's they them their theirs this that these those he him his she her "
+    "above previous earlier former latter again else same instead".split()
+)
+FOLLOW_UP_OPENING = re.compile(r"^\s*(and|but|or|so|then|what about|how about|why not)\b", re.IGNORECASE)
+# Questions this short are rarely complete on their own, eg "in python?" or "why?".
+MIN_STANDALONE_WORDS = 4
+
+
+def needs_history(question: str) -> bool:
+    """Whether `question` looks like it refers to earlier turns and so must be rewritten from
+    the history before retrieval. Errs on the side of rewriting."""
+    words = re.findall(r"[a-z']+", question.lower())
+    return (
+        len(words) < MIN_STANDALONE_WORDS
+        or not REFERRING_WORDS.isdisjoint(words)
+        or FOLLOW_UP_OPENING.match(question) is not None
+    )
+
+
+@dataclass
+class Conversation:
+    """The history of one session: a summary of the earlier turns and the recent turns verbatim."""
+
+    summary: str = ""
+    turns: list[tuple[str, str]] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.summary or self.turns)
+
+    def history(self) -> str:
+        lines = [f"Summary of the earlier conversation: {self.summary}"] if self.summary else []
+        for question, answer in self.turns:
+            lines.extend([f"Human: {question}", f"Assistant: {answer}"])
+        return "\n".join(lines)
+
+    def to_json(self) -> str:
+        return json.dumps({"summary": self.summary, "turns": self.turns})
+
+    @classmethod
+    def from_json(cls, data: str) -> "Conversation":
+        value = json.loads(data)
+        return cls(value["summary"], [(question, answer) for question, answer in value["turns"]])
+
+
+def turn_tokens(question: str, answer: str) -> int:
+    return len(encoding().encode(f"Human: {question}\nAssistant: {answer}", disallowed_special=()))
+
+
+class ConversationStore(ABC):
+    """Where conversations are kept between turns."""
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[Conversation]:
+        """Returns the conversation of `session_id`, or None if there is none."""
+
+    @abstractmethod
+    def set(self, session_id: str, conversation: Conversation) -> None:
+        pass
+
+
+class LocalConversationStore(ConversationStore):
+    """Keeps conversations in memory, expiring them after `ttl_seconds` of inactivity and evicting
+    the least recently used ones beyond `max_sessions`. Only suitable for a single server."""
+
+    def __init__(self, max_sessions: int = CONVERSATION_MAX_SESSIONS, ttl_seconds: float = CONVERSATION_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._sessions: OrderedDict[str, tuple[float, Conversation]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[Conversation]:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            expires_at, conversation = entry
+            if expires_at <= time.monotonic():
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return conversation
+
+    def set(self, session_id: str, conversation: Conversation) -> None:
+        with self._lock:
+            self._sessions[session_id] = (time.monotonic() + self.ttl_seconds, conversation)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+
+class MomentoConversationStore(ConversationStore):
+    """Keeps conversations in a Momento cache, so every server shares them. Sessions expire
+    after `ttl_seconds` of inactivity."""
+
+    KEY_PREFIX = "conversation:"
+
+    def __init__(
+        self,
+        cache_name: str = CONVERSATION_CACHE_NAME,
+        ttl_seconds: float = CONVERSATION_TTL_SECONDS,
+        momento_env_var_name: str = "MOMENTO_API_KEY",
+    ):
+        self.cache_name = cache_name
+        self.ttl_seconds = ttl_seconds
+        self.momento_env_var_name = momento_env_var_name
+
+    @cached_property
+    def client(self) -> CacheClient:
+        return create_cache_client(self.cache_name, timedelta(seconds=self.ttl_seconds), self.momento_env_var_name)
+
+    def get(self, session_id: str) -> Optional[Conversation]:
+        response = self.client.get(self.cache_name, self.KEY_PREFIX + session_id)
+        if isinstance(response, CacheGet.Hit):
+            return Conversation.from_json(response.value_string)
+        if isinstance(response, CacheGet.Error):
+            # The question is still answered, just without its history.
+            logger.warning(f"Conversation lookup failed: {response.message}")
+        return None
+
+    def set(self, session_id: str, conversation: Conversation) -> None:
+        response = self.client.set(self.cache_name, self.KEY_PREFIX + session_id, conversation.to_json())
+        if isinstance(response, CacheSet.Error):
+            logger.warning(f"Conversation write failed: {response.message}")
+
+
+def create_conversation_store(momento_env_var_name: str = "MOMENTO_API_KEY") -> ConversationStore:
+    if CONVERSATION_STORE == "momento":
+        return MomentoConversationStore(momento_env_var_name=momento_env_var_name)
+    if CONVERSATION_STORE == "local":
+        return LocalConversationStore()
+    raise ValueError(f"Unknown CONVERSATION_STORE {CONVERSATION_STORE!r}, expected local or momento.")
+
+
+class ConversationMemory:
+    """Loads and updates conversations, keeping each within a token budget.
+
+    Args:
+        store (ConversationStore): Where conversations are kept.
+        condense (Runnable[dict, str]): Rewrites the `question` into a standalone question
+            given the `history`.
+        summarize (Runnable[dict, str]): Extends the `summary` with the `new_lines` of turns
+            that no longer fit in the budget.
+        token_budget (int): How many tokens of recent turns are kept verbatim.
+    """
+
+    def __init__(
+        self,
+        store: ConversationStore,
+        condense: Runnable[dict, str],
+        summarize: Runnable[dict, str],
+        token_budget: int = CONVERSATION_HISTORY_TOKEN_BUDGET,
+    ):
+        self.store = store
+        self.condense = condense
+        self.summarize = summarize
+        self.token_budget = token_budget
+
+    def load(self, session_id: str) -> Conversation:
+        return self.store.get(session_id) or Conversation()
+
+    async def aload(self, session_id: str) -> Conversation:
+        return await asyncio.to_thread(self.load, session_id)
+
+    def _should_condense(self, question: str, conversation: Conversation) -> bool:
+        condense = bool(conversation) and needs_history(question)
+        CONVERSATION_QUESTIONS.inc(kind="follow_up" if condense else "standalone")
+        return condense
+
+    def standalone_question(self, question: str, conversation: Conversation) -> str:
+        if not self._should_condense(question, conversation):
+            return question
+        with stage("condense"):
+            return self.condense.invoke({"history": conversation.history(), "question": question})
+
+    async def astandalone_question(self, question: str, conversation: Conversation) -> str:
+        if not self._should_condense(question, conversation):
+            return question
+        with stage("condense"):
+            return await self.condense.ainvoke({"history": conversation.history(), "question": question})
+
+    def _add_turn(self, conversation: Conversation, question: str, answer: str) -> list[tuple[str, str]]:
+        """Appends the turn, and removes and returns the oldest turns that exceed the budget.
+        The latest turn is always kept."""
+        conversation.turns.append((question, answer))
+        tokens = [turn_tokens(*turn) for turn in conversation.turns]
+        dropped = 0
+        while dropped < len(tokens) - 1 and sum(tokens[dropped:]) > self.token_budget:
+            dropped += 1
+        evicted, conversation.turns = conversation.turns[:dropped], conversation.turns[dropped:]
+        return evicted
+
+    @staticmethod
+    def _summary_inputs(conversation: Conversation, evicted: list[tuple[str, str]]) -> dict[str, Any]:
+        return {"summary": conversation.summary, "new_lines": Conversation(turns=evicted).history()}
+
+    def remember(self, session_id: str, conversation: Conversation, question: str, answer: str) -> None:
+        if evicted := self._add_turn(conversation, question, answer):
+            with stage("summarize"):
+                conversation.summary = self.summarize.invoke(self._summary_inputs(conversation, evicted))
+        self.store.set(session_id, conversation)
+
+    async def aremember(self, session_id: str, conversation: Conversation, question: str, answer: str) -> None:
+        if evicted := self._add_turn(conversation, question, answer):
+            with stage("summarize"):
+                conversation.summary = await self.summarize.ainvoke(self._summary_inputs(conversation, evicted))
+        await asyncio.to_thread(self.store.set, session_id, conversation)
+
+
+def with_conversation_memory(chain: Runnable, memory: ConversationMemory) -> Runnable:
+    """Wraps `chain`, which answers a standalone question, to answer a `question` asked in the
+    session `session_id`, taking the earlier turns of the session into account."""
+
+    def answer_in(session_id: str, conversation: Conversation, question: str, standalone: str) -> Runnable:
+        def remember(chunks: Iterator[str]) -> Iterator[str]:
+            response = []
+            for chunk in chunks:
+                response.append(chunk)
+                yield chunk
+            memory.remember(session_id, conversation, question, "".join(response))
+
+        async def aremember(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+            response = []
+            async for chunk in chunks:
+                response.append(chunk)
+                yield chunk
+            await memory.aremember(session_id, conversation, question, "".join(response))
+
+        async def astandalone(_inputs: dict) -> str:
+            return standalone
+
+        question_runnable = RunnableLambda(lambda _inputs: standalone, afunc=astandalone)
+        return question_runnable | chain | RunnableGenerator(remember, aremember)
+
+    def answer(inputs: dict) -> Runnable:
+        conversation = memory.load(inputs["session_id"])
+        standalone = memory.standalone_question(inputs["question"], conversation)
+        return answer_in(inputs["session_id"], conversation, inputs["question"], standalone)
+
+    async def aanswer(inputs: dict) -> Runnable:
+        conversation = await memory.aload(inputs["session_id"])
+        standalone = await memory.astandalone_question(inputs["question"], conversation)
+        return answer_in(inputs["session_id"], conversation, inputs["question"], standalone)
+
+    return RunnableLambda(answer, afunc=aanswer)
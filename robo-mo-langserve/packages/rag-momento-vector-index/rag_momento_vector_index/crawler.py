@@ -0,0 +1,374 @@
+"""
+An async crawler for the sitemaps we index.
+
+All sitemaps are crawled concurrently over a shared connection pool. Requests to each host
+are bounded both in concurrency and in rate, and are retried with exponential backoff on
+connection errors, timeouts, 429s and 5xxs (honoring `Retry-After`).
+
+Pages are kept in a local crawl cache together with their `ETag`, `Last-Modified` and sitemap
+`lastmod`. A page whose sitemap `lastmod` did not change is not requested at all, and other
+cached pages are requested conditionally, so an unchanged page costs at most a 304.
+
+Only a 404 or 410 means a page is gone. A page that still fails after its retries, eg because
+its host is rate limiting or down, is served from the crawl cache if it is there, and otherwise
+reported as unavailable, so that reindexing keeps what it indexed of the page before rather than
+deleting it.
+"""
+import asyncio
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Mapping, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+from bs4 import BeautifulSoup
+from langchain.docstore.document import Document
+
+logger = logging.getLogger(__name__)
+
+CRAWL_CACHE_PATH = os.environ.get("CRAWL_CACHE_PATH", os.path.join("cache", "crawl.sqlite3"))
+CRAWL_MAX_CONNECTIONS = int(os.environ.get("CRAWL_MAX_CONNECTIONS", "32"))
+CRAWL_CONCURRENCY_PER_HOST = int(os.environ.get("CRAWL_CONCURRENCY_PER_HOST", "8"))
+CRAWL_REQUESTS_PER_SECOND_PER_HOST = float(os.environ.get("CRAWL_REQUESTS_PER_SECOND_PER_HOST", "10"))
+CRAWL_MAX_RETRIES = int(os.environ.get("CRAWL_MAX_RETRIES", "4"))
+CRAWL_BACKOFF_SECONDS = float(os.environ.get("CRAWL_BACKOFF_SECONDS", "0.5"))
+CRAWL_TIMEOUT_SECONDS = float(os.environ.get("CRAWL_TIMEOUT_SECONDS", "30"))
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+GONE_STATUSES = {404, 410}
+
+
+class CrawlError(Exception):
+    pass
+
+
+def default_meta_fn(meta: dict, _content: BeautifulSoup) -> dict:
+    return {"source": meta["loc"], **meta}
+
+
+def default_parsing_fn(content: BeautifulSoup) -> str:
+    return str(content.get_text())
+
+
+def parse_page(
+    html: str,
+    entry: dict,
+    parsing_function: Callable[[BeautifulSoup], str],
+    meta_function: Callable[[dict, BeautifulSoup], dict],
+) -> Document:
+    """Turns a fetched page into a document. Runs in the parse executor, so the functions
+    must be picklable (defined at module level) when that is a process pool."""
+    soup = BeautifulSoup(html, "html.parser")
+    return Document(page_content=parsing_function(soup), metadata=meta_function(entry, soup))
+
+
+@dataclass
+class SitemapSource:
+    """A sitemap to crawl and how to turn its pages into documents.
+
+    Args:
+        sitemap_url (str): The URL of the sitemap. Nested sitemap indexes are followed.
+        filter_urls (Optional[list[str]]): If set, only page URLs matching one of these
+            regular expressions are crawled.
+        parsing_function (Callable[[BeautifulSoup], str]): Extracts the page content.
+        meta_function (Callable[[dict, BeautifulSoup], dict]): Builds the document metadata
+            from the sitemap entry of the page. It must set `source`.
+        restrict_to_same_domain (bool): Only crawl pages on the sitemap's scheme and domain.
+    """
+
+    sitemap_url: str
+    filter_urls: Optional[list[str]] = None
+    parsing_function: Callable[[BeautifulSoup], str] = default_parsing_fn
+    meta_function: Callable[[dict, BeautifulSoup], dict] = default_meta_fn
+    restrict_to_same_domain: bool = True
+
+
+@dataclass
+class CachedPage:
+    url: str
+    html: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    lastmod: Optional[str] = None
+
+
+class CrawlCache:
+    """Keeps the last fetched version of each page, compressed, in a SQLite file."""
+
+    def __init__(self, path: str = CRAWL_CACHE_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS pages "
+            "(url TEXT PRIMARY KEY, html BLOB NOT NULL, etag TEXT, last_modified TEXT, lastmod TEXT)"
+        )
+        self._connection.commit()
+
+    def get(self, url: str) -> Optional[CachedPage]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT html, etag, last_modified, lastmod FROM pages WHERE url = ?", [url]
+            ).fetchone()
+        if row is None:
+            return None
+        html, etag, last_modified, lastmod = row
+        return CachedPage(url, zlib.decompress(html).decode("utf-8"), etag, last_modified, lastmod)
+
+    def put(self, page: CachedPage) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pages (url, html, etag, last_modified, lastmod) VALUES (?, ?, ?, ?, ?)",
+                [page.url, zlib.compress(page.html.encode("utf-8")), page.etag, page.last_modified, page.lastmod],
+            )
+            self._connection.commit()
+
+
+class HostLimiter:
+    """Bounds the number of in-flight requests to a host and spaces out their start times."""
+
+    def __init__(self, concurrency: int, requests_per_second: float):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._interval = 1.0 / requests_per_second if requests_per_second > 0 else 0.0
+        self._next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[None]:
+        async with self._semaphore:
+            async with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start)
+                self._next_start = start + self._interval
+            if start > now:
+                await asyncio.sleep(start - now)
+            yield
+
+
+@dataclass
+class CrawlStats:
+    """What a crawl did. `failed` lists the URLs of all pages that could not be fetched, and
+    `unavailable` the sitemap `loc` of those among them that are not known to be gone and were
+    not in the crawl cache either."""
+
+    fetched: int = 0
+    not_modified: int = 0
+    skipped_by_lastmod: int = 0
+    served_from_cache: int = 0
+    retries: int = 0
+    failed: list[str] = field(default_factory=list)
+    unavailable: list[str] = field(default_factory=list)
+
+
+class SitemapCrawler:
+    """Crawls sitemaps concurrently and returns one document per page.
+
+    Pages are parsed on `parse_executor`, which should be a process pool for large crawls since
+    parsing is CPU bound. If None, they are parsed on the event loop's default thread pool.
+    """
+
+    def __init__(
+        self,
+        cache: Optional[CrawlCache] = None,
+        max_connections: int = CRAWL_MAX_CONNECTIONS,
+        concurrency_per_host: int = CRAWL_CONCURRENCY_PER_HOST,
+        requests_per_second_per_host: float = CRAWL_REQUESTS_PER_SECOND_PER_HOST,
+        max_retries: int = CRAWL_MAX_RETRIES,
+        backoff_seconds: float = CRAWL_BACKOFF_SECONDS,
+        timeout_seconds: float = CRAWL_TIMEOUT_SECONDS,
+        parse_executor: Optional[Executor] = None,
+    ):
+        self.cache = cache
+        self.max_connections = max_connections
+        self.concurrency_per_host = concurrency_per_host
+        self.requests_per_second_per_host = requests_per_second_per_host
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout_seconds = timeout_seconds
+        self.parse_executor = parse_executor
+        self.stats = CrawlStats()
+        self._limiters: dict[str, HostLimiter] = {}
+
+    async def crawl(self, sources: list[SitemapSource]) -> list[Document]:
+        return [document async for document in self.iter_documents(sources)]
+
+    def unavailable_sources(self) -> list[str]:
+        """The sources of the pages that could not be fetched in the last crawl but may still
+        exist, which `default_meta_fn` and the other meta functions take from the sitemap `loc`."""
+        return list(self.stats.unavailable)
+
+    async def iter_documents(self, sources: list[SitemapSource]) -> AsyncIterator[Document]:
+        """Yields pages as they are fetched.
+
+        At most `max_connections` fetched pages wait for the consumer; beyond that, fetching
+        pauses until the consumer catches up.
+        """
+        connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.concurrency_per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout_seconds)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            documents: asyncio.Queue[Optional[Document]] = asyncio.Queue(maxsize=self.max_connections)
+            producer = asyncio.create_task(self._produce(session, sources, documents))
+            try:
+                while (document := await documents.get()) is not None:
+                    yield document
+                await producer
+            finally:
+                producer.cancel()
+        logger.info(f"Crawl complete: {self.stats}")
+
+    async def _produce(
+        self, session: aiohttp.ClientSession, sources: list[SitemapSource], documents: asyncio.Queue
+    ) -> None:
+        try:
+            await asyncio.gather(*(self._produce_source(session, source, documents) for source in sources))
+        finally:
+            await documents.put(None)
+
+    async def _produce_source(
+        self, session: aiohttp.ClientSession, source: SitemapSource, documents: asyncio.Queue
+    ) -> None:
+        entries = await self.read_sitemap(session, source.sitemap_url, source)
+        logger.info(f"Found {len(entries)} pages in {source.sitemap_url}.")
+        pending = iter(entries)
+        loop = asyncio.get_running_loop()
+
+        # Each source gets its own workers so that one sitemap does not starve the other.
+        async def worker() -> None:
+            for entry in pending:
+                html = await self.fetch_page(session, entry)
+                if html is not None:
+                    document = await loop.run_in_executor(
+                        self.parse_executor, parse_page, html, entry, source.parsing_function, source.meta_function
+                    )
+                    await documents.put(document)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency_per_host)))
+
+    async def read_sitemap(self, session: aiohttp.ClientSession, url: str, source: SitemapSource) -> list[dict]:
+        status, body, _headers = await self.get(session, url)
+        if status != 200:
+            raise CrawlError(f"Fetching sitemap {url} failed with status {status}.")
+        soup = BeautifulSoup(body, "xml")
+
+        entries = []
+        for url_element in soup.find_all("url"):
+            loc = url_element.find("loc")
+            if not loc:
+                continue
+            loc_text = loc.text.strip()
+            if source.restrict_to_same_domain and not same_origin(loc_text, source.sitemap_url):
+                continue
+            if source.filter_urls and not any(re.match(pattern, loc_text) for pattern in source.filter_urls):
+                continue
+            entries.append(
+                {
+                    tag: prop.text
+                    for tag in ["loc", "lastmod", "changefreq", "priority"]
+                    if (prop := url_element.find(tag))
+                }
+            )
+
+        nested = [loc.text.strip() for sitemap in soup.find_all("sitemap") if (loc := sitemap.find("loc"))]
+        for nested_entries in await asyncio.gather(*(self.read_sitemap(session, loc, source) for loc in nested)):
+            entries.extend(nested_entries)
+        return entries
+
+    async def fetch_page(self, session: aiohttp.ClientSession, entry: dict) -> Optional[str]:
+        """Returns the HTML of the page, from the crawl cache if it has not changed."""
+        url = entry["loc"].strip()
+        lastmod = entry["lastmod"].strip() if "lastmod" in entry else None
+        cached = self.cache.get(url) if self.cache is not None else None
+        if cached is not None and lastmod is not None and cached.lastmod == lastmod:
+            self.stats.skipped_by_lastmod += 1
+            return cached.html
+
+        headers = {}
+        if cached is not None and cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached is not None and cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+
+        try:
+            status, body, response_headers = await self.get(session, url, headers)
+        except CrawlError as e:
+            logger.warning(f"{e} Keeping the page as it was.")
+            return self._unavailable(entry, cached)
+        if status == 304 and cached is not None:
+            self.stats.not_modified += 1
+            if self.cache is not None and lastmod != cached.lastmod:
+                cached.lastmod = lastmod
+                self.cache.put(cached)
+            return cached.html
+        if status in GONE_STATUSES:
+            logger.warning(f"Skipping {url}, which returned status {status}.")
+            self.stats.failed.append(url)
+            return None
+        if status >= 400:
+            logger.warning(f"GET {url} returned status {status}. Keeping the page as it was.")
+            return self._unavailable(entry, cached)
+
+        self.stats.fetched += 1
+        if self.cache is not None:
+            self.cache.put(
+                CachedPage(url, body, response_headers.get("ETag"), response_headers.get("Last-Modified"), lastmod)
+            )
+        return body
+
+    def _unavailable(self, entry: dict, cached: Optional[CachedPage]) -> Optional[str]:
+        """Returns the cached HTML of a page that could not be fetched, or records it as unavailable."""
+        self.stats.failed.append(entry["loc"].strip())
+        if cached is not None:
+            self.stats.served_from_cache += 1
+            return cached.html
+        self.stats.unavailable.append(entry["loc"])
+        return None
+
+    async def get(
+        self, session: aiohttp.ClientSession, url: str, headers: Optional[dict[str, str]] = None
+    ) -> tuple[int, str, Mapping[str, str]]:
+        """GETs `url` within the limits of its host, retrying transient failures."""
+        limiter = self.limiter(urlparse(url).netloc)
+        for attempt in range(self.max_retries + 1):
+            delay = self.backoff_seconds * (2**attempt) * (0.5 + random.random() / 2)
+            try:
+                async with limiter.acquire():
+                    async with session.get(url, headers=headers) as response:
+                        if response.status not in RETRYABLE_STATUSES or attempt == self.max_retries:
+                            return response.status, await response.text(), response.headers
+                        delay = max(delay, retry_after_seconds(response.headers))
+                        logger.info(f"GET {url} returned {response.status}, retrying in {delay:.1f}s.")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    raise CrawlError(f"GET {url} failed after {attempt + 1} attempts.") from e
+                logger.info(f"GET {url} failed with {e!r}, retrying in {delay:.1f}s.")
+            self.stats.retries += 1
+            await asyncio.sleep(delay)
+        raise CrawlError(f"GET {url} failed after {self.max_retries + 1} attempts.")
+
+    def limiter(self, host: str) -> HostLimiter:
+        if host not in self._limiters:
+            self._limiters[host] = HostLimiter(self.concurrency_per_host, self.requests_per_second_per_host)
+        return self._limiters[host]
+
+
+def same_origin(url: str, other: str) -> bool:
+    parsed, parsed_other = urlparse(url), urlparse(other)
+    return (parsed.scheme, parsed.netloc) == (parsed_other.scheme, parsed_other.netloc)
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> float:
+    try:
+        return float(headers.get("Retry-After", 0))
+    except ValueError:
+        return 0.0
@@ -0,0 +1,305 @@
+"""
+A cache in front of the embeddings API, shared by ingest and query paths.
+
+Embeddings are keyed by the model name and a hash of the text, so boilerplate chunks that
+show up on every reindex and popular questions are only ever embedded once. The cache is
+stored on local disk (SQLite, with TTL and LRU eviction) by default, or in a Momento cache
+when `EMBEDDING_CACHE=momento`.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import cached_property, lru_cache
+from typing import Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+from momento import CacheClient
+from momento.responses import CacheGet, CacheSet
+
+from .momento_cache import create_cache_client
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# One of "local", "momento" or "none".
+EMBEDDING_CACHE = os.environ.get("EMBEDDING_CACHE", "local")
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", os.path.join("cache", "embeddings.sqlite3"))
+EMBEDDING_CACHE_NAME = os.environ.get("EMBEDDING_CACHE_NAME", "robo-mo-embeddings")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+EMBEDDING_CACHE_TTL_SECONDS = float(os.environ.get("EMBEDDING_CACHE_TTL_SECONDS", str(30 * 24 * 60 * 60)))
+# Requests to the Momento embedding cache in flight per lookup or write.
+EMBEDDING_CACHE_CONCURRENCY = int(os.environ.get("EMBEDDING_CACHE_CONCURRENCY", "16"))
+# The local cache expires and evicts entries after this many written entries or seconds,
+# whichever comes first, rather than on every write.
+PRUNE_EVERY_ENTRIES = 1000
+PRUNE_INTERVAL_SECONDS = 60.0
+# Access times of the local cache are only updated once they are this much out of date, and
+# written in batches with the next write, or by a lookup once a minute has passed or many are
+# pending, so that lookups rarely write to the database.
+ACCESS_TIME_RESOLUTION_SECONDS = 60 * 60.0
+ACCESS_FLUSH_INTERVAL_SECONDS = 60.0
+MAX_PENDING_ACCESSES = 10000
+
+
+def embedding_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def encode_vector(vector: list[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def decode_vector(data: bytes) -> list[float]:
+    return array("f", data).tolist()
+
+
+class EmbeddingStore(ABC):
+    """Where cached embeddings are kept."""
+
+    @abstractmethod
+    def mget(self, keys: list[str]) -> list[Optional[list[float]]]:
+        pass
+
+    @abstractmethod
+    def mset(self, items: list[tuple[str, list[float]]]) -> None:
+        pass
+
+
+class LocalEmbeddingStore(EmbeddingStore):
+    """Keeps embeddings in a SQLite file, expiring them after `ttl_seconds` and evicting the
+    least recently used ones beyond `max_entries`. Safe to share between processes.
+
+    Lookups rarely write. Expiry and eviction run every `PRUNE_EVERY_ENTRIES` written entries or
+    `PRUNE_INTERVAL_SECONDS`, so the cache may briefly hold a few more than `max_entries`, and
+    access times are recorded to within `ACCESS_TIME_RESOLUTION_SECONDS`.
+    """
+
+    def __init__(
+        self,
+        path: str = EMBEDDING_CACHE_PATH,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = EMBEDDING_CACHE_TTL_SECONDS,
+    ):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed_at ON embeddings (accessed_at)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_created_at ON embeddings (created_at)")
+        self._connection.commit()
+        # Keys looked up whose stored access time is out of date, and when they were looked up.
+        self._accessed: dict[str, float] = {}
+        self._accesses_recorded_at = time.monotonic()
+        self._written_since_prune = 0
+        self._pruned_at = time.monotonic()
+
+    def mget(self, keys: list[str]) -> list[Optional[list[float]]]:
+        if not keys:
+            return []
+        now = time.time()
+        found: dict[str, list[float]] = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT key, vector, accessed_at FROM embeddings WHERE key IN ({placeholders}) AND created_at > ?",
+                    [*batch, now - self.ttl_seconds],
+                ).fetchall()
+                for key, vector, accessed_at in rows:
+                    found[key] = decode_vector(vector)
+                    if accessed_at < now - ACCESS_TIME_RESOLUTION_SECONDS:
+                        self._accessed[key] = now
+            if self._accessed and (
+                len(self._accessed) >= MAX_PENDING_ACCESSES
+                or time.monotonic() - self._accesses_recorded_at >= ACCESS_FLUSH_INTERVAL_SECONDS
+            ):
+                self._record_accesses()
+                self._connection.commit()
+        return [found.get(key) for key in keys]
+
+    def _record_accesses(self) -> None:
+        if self._accessed:
+            self._connection.executemany(
+                "UPDATE embeddings SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._accessed.items()],
+            )
+            self._accessed.clear()
+        self._accesses_recorded_at = time.monotonic()
+
+    def _prune(self, now: float) -> None:
+        self._connection.execute("DELETE FROM embeddings WHERE created_at <= ?", [now - self.ttl_seconds])
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY accessed_at ASC LIMIT ?)",
+                [count - self.max_entries],
+            )
+        self._written_since_prune = 0
+        self._pruned_at = time.monotonic()
+
+    def mset(self, items: list[tuple[str, list[float]]]) -> None:
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                [(key, encode_vector(vector), now, now) for key, vector in items],
+            )
+            self._record_accesses()
+            self._written_since_prune += len(items)
+            if (
+                self._written_since_prune >= PRUNE_EVERY_ENTRIES
+                or time.monotonic() - self._pruned_at >= PRUNE_INTERVAL_SECONDS
+            ):
+                self._prune(now)
+            self._connection.commit()
+
+
+class MomentoEmbeddingStore(EmbeddingStore):
+    """Keeps embeddings in a Momento cache, so all servers and reindex runs share them.
+    Entries expire after `ttl_seconds` and Momento evicts the least recently used ones.
+
+    Momento has no batch get, so the keys of a lookup or write are sent concurrently, at most
+    `EMBEDDING_CACHE_CONCURRENCY` at a time, over the client's shared channel.
+    """
+
+    def __init__(
+        self,
+        cache_name: str = EMBEDDING_CACHE_NAME,
+        ttl_seconds: float = EMBEDDING_CACHE_TTL_SECONDS,
+        momento_env_var_name: str = "MOMENTO_API_KEY",
+    ):
+        self.cache_name = cache_name
+        self.ttl_seconds = ttl_seconds
+        self.momento_env_var_name = momento_env_var_name
+
+    @cached_property
+    def client(self) -> CacheClient:
+        return create_cache_client(self.cache_name, timedelta(seconds=self.ttl_seconds), self.momento_env_var_name)
+
+    @cached_property
+    def _executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=max(1, EMBEDDING_CACHE_CONCURRENCY), thread_name_prefix="embedding-cache")
+
+    def _get(self, key: str) -> Optional[list[float]]:
+        response = self.client.get(self.cache_name, key)
+        if isinstance(response, CacheGet.Hit):
+            return decode_vector(response.value_bytes)
+        if isinstance(response, CacheGet.Error):
+            logger.warning(f"Embedding cache lookup failed: {response.message}")
+        return None
+
+    def _set(self, item: tuple[str, list[float]]) -> None:
+        key, vector = item
+        response = self.client.set(self.cache_name, key, encode_vector(vector))
+        if isinstance(response, CacheSet.Error):
+            logger.warning(f"Embedding cache write failed: {response.message}")
+
+    def mget(self, keys: list[str]) -> list[Optional[list[float]]]:
+        if len(keys) <= 1:
+            return [self._get(key) for key in keys]
+        return list(self._executor.map(self._get, keys))
+
+    def mset(self, items: list[tuple[str, list[float]]]) -> None:
+        if len(items) <= 1:
+            for item in items:
+                self._set(item)
+            return
+        list(self._executor.map(self._set, items))
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings that consult an `EmbeddingStore` before calling the underlying model.
+
+    Identical texts within a single call are embedded once as well. `hits` and `misses`
+    count texts served from the cache and texts sent to the model respectively.
+    """
+
+    def __init__(self, underlying: Embeddings, store: EmbeddingStore, model: str = EMBEDDING_MODEL):
+        self.underlying = underlying
+        self.store = store
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+
+    def _split_hits(
+        self, keys: list[str], texts: list[str], unique_keys: list[str], cached: list[Optional[list[float]]]
+    ) -> tuple[dict[str, list[float]], dict[str, str]]:
+        """Returns the cached vectors by key and the texts that still need embedding by key."""
+        vectors = {key: vector for key, vector in zip(unique_keys, cached) if vector is not None}
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        return vectors, missing
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [embedding_key(self.model, text) for text in texts]
+        unique_keys = list(dict.fromkeys(keys))
+        vectors, missing = self._split_hits(keys, texts, unique_keys, self.store.mget(unique_keys))
+        if missing:
+            new_items = list(zip(missing.keys(), self.underlying.embed_documents(list(missing.values()))))
+            self.store.mset(new_items)
+            vectors.update(new_items)
+        return [vectors[key] for key in keys]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        # The store is consulted on a thread, the model with its native async client.
+        keys = [embedding_key(self.model, text) for text in texts]
+        unique_keys = list(dict.fromkeys(keys))
+        cached = await asyncio.to_thread(self.store.mget, unique_keys)
+        vectors, missing = self._split_hits(keys, texts, unique_keys, cached)
+        if missing:
+            new_items = list(zip(missing.keys(), await self.underlying.aembed_documents(list(missing.values()))))
+            await asyncio.to_thread(self.store.mset, new_items)
+            vectors.update(new_items)
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+def embedding_stats(embeddings: Embeddings) -> dict[str, float]:
+    """Returns the hit/miss counters of `embeddings`, or nothing if they are not cached."""
+    return embeddings.stats() if isinstance(embeddings, CachedEmbeddings) else {}
+
+
+@lru_cache(maxsize=None)
+def get_embeddings(model: str = EMBEDDING_MODEL, momento_env_var_name: str = "MOMENTO_API_KEY") -> Embeddings:
+    """Returns the process-wide embeddings for `model`, cached as configured by `EMBEDDING_CACHE`."""
+    embeddings = OpenAIEmbeddings(model=model)  # type: ignore
+    if EMBEDDING_CACHE == "none":
+        return embeddings
+    store: EmbeddingStore
+    if EMBEDDING_CACHE == "momento":
+        store = MomentoEmbeddingStore(momento_env_var_name=momento_env_var_name)
+    elif EMBEDDING_CACHE == "local":
+        store = LocalEmbeddingStore()
+    else:
+        raise ValueError(f"Unknown EMBEDDING_CACHE {EMBEDDING_CACHE!r}, expected local, momento or none.")
+    return CachedEmbeddings(embeddings, store, model)
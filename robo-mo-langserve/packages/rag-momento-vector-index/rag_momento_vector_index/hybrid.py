@@ -0,0 +1,79 @@
+"""
+Fuses lexical and vector search results, optionally re-ranking them with a local model.
+
+With `HYBRID_RETRIEVAL=true`, reindexing builds a `LexicalIndex` for every index generation and
+the chain searches it alongside the vector index. The two rankings are combined by reciprocal
+rank fusion, which needs no score calibration between BM25 and cosine similarity.
+
+`RERANKER=cross-encoder` re-scores the fused candidates with the `sentence-transformers`
+cross-encoder `RERANKER_MODEL`, if that package is installed.
+"""
+import logging
+import os
+from functools import lru_cache
+from typing import Any, Optional
+
+from langchain.docstore.document import Document
+
+from .lexical import LexicalIndex, lexical_index_path
+from .manifest import chunk_id
+
+logger = logging.getLogger(__name__)
+
+HYBRID_RETRIEVAL = os.environ.get("HYBRID_RETRIEVAL", "false").lower() == "true"
+RRF_K = 60
+RERANKER = os.environ.get("RERANKER", "none")
+RERANKER_MODEL = os.environ.get("RERANKER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+
+
+def document_key(document: Document) -> str:
+    metadata = document.metadata
+    if "source" in metadata and "start_index" in metadata:
+        return chunk_id(document)
+    return document.page_content
+
+
+def reciprocal_rank_fusion(rankings: list[list[Document]], k: int = RRF_K) -> list[Document]:
+    """Merges `rankings`, best first, scoring each document by the sum of 1 / (k + rank)."""
+    scores: dict[str, float] = {}
+    documents: dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = document_key(document)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            documents.setdefault(key, document)
+    return [documents[key] for key in sorted(scores, key=scores.__getitem__, reverse=True)]
+
+
+@lru_cache(maxsize=2)
+def lexical_index_for(index_name: str, version: str) -> Optional[LexicalIndex]:
+    """Memory-maps the lexical index of `index_name`, reloading it whenever `version` changes."""
+    index = LexicalIndex.load(lexical_index_path(index_name))
+    if index is None:
+        logger.warning(f"No lexical index for {index_name}, retrieving from the vector index only.")
+    return index
+
+
+@lru_cache(maxsize=None)
+def _cross_encoder() -> Optional[Any]:
+    if RERANKER == "none":
+        return None
+    if RERANKER != "cross-encoder":
+        raise ValueError(f"Unknown RERANKER {RERANKER!r}, expected cross-encoder or none.")
+    try:
+        from sentence_transformers import CrossEncoder
+    except ImportError:
+        logger.warning("RERANKER is set but sentence-transformers is not installed; not re-ranking.")
+        return None
+    return CrossEncoder(RERANKER_MODEL)
+
+
+def rerank(question: str, documents: list[Document], k: int) -> list[Document]:
+    """Returns the `k` best of `documents` for `question`, re-scored by the cross-encoder if
+    one is configured and in their given order otherwise."""
+    model = _cross_encoder()
+    if model is None or len(documents) <= 1:
+        return documents[:k]
+    scores = model.predict([(question, document.page_content) for document in documents])
+    ranked = sorted(zip(scores, range(len(documents))), reverse=True)
+    return [documents[i] for _, i in ranked[:k]]
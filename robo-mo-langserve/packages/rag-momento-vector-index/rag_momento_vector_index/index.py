@@ -1,59 +1,326 @@
 """
 Code related to indexing and re-indexing Momento content.
 """
-import itertools
+import asyncio
 import logging
+import os
+import re
+import time
+from contextlib import nullcontext
+from functools import lru_cache
+from typing import Callable, Optional
+from urllib.parse import urlparse
 
 import nest_asyncio
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 from langchain.docstore.document import Document
 from langchain.text_splitter import TokenTextSplitter
-from langchain_community.document_loaders import SitemapLoader
 from langchain_community.vectorstores import MomentoVectorIndex
-from langchain_openai import OpenAIEmbeddings
+from langchain_core.embeddings import Embeddings
 from momento import CredentialProvider, PreviewVectorIndexClient, VectorIndexConfigurations
+from momento.responses.vector_index import DeleteIndex, GetItemMetadataBatch, ListIndexes
+
+from .aliases import get_index_resolver, is_generation_of, new_generation_name
+from .checkpoint import REINDEX_CHECKPOINTS, IngestCheckpoint, checkpoint_path
+from .crawler import CrawlCache, SitemapCrawler, SitemapSource
+from .embedding_cache import embedding_stats, get_embeddings
+from .hybrid import HYBRID_RETRIEVAL
+from .lexical import LexicalIndexBuilder, lexical_index_path
+from .local_index import LOCAL_VECTOR_INDEX, LocalVectorIndexBuilder, local_vector_index_path
+from .manifest import IndexManifest, manifest_path
+from .metrics import REINDEX_STAGE_SECONDS, stage
+from .pipeline import IngestPipeline, IngestResult, create_process_pool
+from .snapshot import (
+    CORPUS_SNAPSHOT,
+    CORPUS_SNAPSHOT_RECORD,
+    CorpusSnapshot,
+    SnapshotWriter,
+    new_snapshot_path,
+    resolve_snapshot_path,
+    split_params,
+)
 
 nest_asyncio.apply()
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+TECH_DOCS_SITEMAP_URL = os.environ.get("TECH_DOCS_SITEMAP_URL", "https://docs.momentohq.com/sitemap.xml")
+BLOGS_SITEMAP_URL = os.environ.get("BLOGS_SITEMAP_URL", "https://www.gomomento.com/sitemap.xml")
+SPLIT_CHUNK_SIZE = int(os.environ.get("SPLIT_CHUNK_SIZE", "128"))
+SPLIT_CHUNK_OVERLAP = int(os.environ.get("SPLIT_CHUNK_OVERLAP", "32"))
+
+# A new index generation must pass these checks before the alias is flipped to it.
+VALIDATION_QUERIES = [
+    q.strip()
+    for q in os.environ.get(
+        "REINDEX_VALIDATION_QUERIES", "What is Momento Cache?|How do I create a Momento Vector Index?"
+    ).split("|")
+    if q.strip()
+]
+VALIDATION_SAMPLE_SIZE = 20
+VALIDATION_ATTEMPTS = 5
+VALIDATION_RETRY_SECONDS = 2.0
+# Refuse a generation that shrank to less than this fraction of the chunks in the active one.
+MIN_CHUNK_RATIO = float(os.environ.get("REINDEX_MIN_CHUNK_RATIO", "0.5"))
+
+
+class IndexValidationError(Exception):
+    pass
+
+
+def reindex_content(
+    index_name: str,
+    momento_env_var_name: str = "MOMENTO_API_KEY",
+    incremental: bool = True,
+    snapshot: Optional[str] = None,
+    on_progress: Optional[Callable[[dict[str, int]], None]] = None,
+) -> None:
+    """Reindexes the Momento docs and blogs into the index aliased by `index_name`.
 
-def reindex_content(index_name: str, momento_env_var_name: str = "MOMENTO_API_KEY") -> None:
+    When `incremental` is set and a manifest for the active index generation exists, only the
+    chunks of pages that changed are embedded and upserted in place, and the chunks of removed
+    pages are deleted. Otherwise a new generation is built next to the active one, validated,
+    and the alias is flipped to it before the old generation is deleted, so queries never see
+    an empty or partially populated index.
+
+    With `HYBRID_RETRIEVAL` set, the lexical index of the generation is updated or built as well.
+    So is its local vector index, unless `LOCAL_VECTOR_INDEX` is `none`.
+
+    Pages are read from the corpus snapshot `snapshot`, a path or `latest`, instead of crawled if
+    it or `CORPUS_SNAPSHOT` is set. Otherwise, with `CORPUS_SNAPSHOT_RECORD` set, the crawled pages
+    are recorded in a new snapshot.
+
+    With `REINDEX_CHECKPOINTS` set, the ingest is checkpointed after each upsert batch, and a
+    reindex of the same kind that stopped before it completed is resumed rather than restarted:
+    in place, or into the generation it was loading. `on_progress` is called with the progress
+    of the ingest, and can stop it by raising.
+    """
     logger.info(f"Reindexing {index_name} and using {momento_env_var_name} as the API key.")
 
-    documents = load_content()
-    chunked_documents = split_documents(documents)
-    load_into_mvi(chunked_documents, index_name, momento_env_var_name)
+    snapshot = snapshot or CORPUS_SNAPSHOT
+    corpus = CorpusSnapshot(resolve_snapshot_path(snapshot)) if snapshot else None
+    if corpus is not None:
+        logger.info(f"Reading the pages from the corpus snapshot {corpus.path} instead of crawling.")
+
+    resolver = get_index_resolver(index_name, momento_env_var_name)
+    active_index_name = resolver.refresh()
+    path = manifest_path(index_name)
+    previous_manifest = IndexManifest.load(path)
+
+    client = create_vector_index_client(momento_env_var_name)
+    embeddings = get_embeddings(momento_env_var_name=momento_env_var_name)
+    lexical = LexicalIndexBuilder.load(lexical_index_path(active_index_name)) if HYBRID_RETRIEVAL else None
+    local_vectors = (
+        LocalVectorIndexBuilder.load(local_vector_index_path(active_index_name))
+        if LOCAL_VECTOR_INDEX != "none"
+        else None
+    )
+    if (
+        incremental
+        and previous_manifest is not None
+        and previous_manifest.index_name == active_index_name
+        and (lexical is not None or not HYBRID_RETRIEVAL)
+        and (local_vectors is not None or LOCAL_VECTOR_INDEX == "none")
+        and index_exists(client, active_index_name)
+    ):
+        checkpoint = open_checkpoint(index_name, active_index_name, True, local_vectors is not None)
+        with stage("ingest", REINDEX_STAGE_SECONDS):
+            result = ingest(
+                active_index_name,
+                client,
+                embeddings,
+                previous_manifest,
+                lexical,
+                local_vectors,
+                snapshot=corpus,
+                record_snapshot=CORPUS_SNAPSHOT_RECORD,
+                checkpoint=checkpoint,
+                on_progress=on_progress,
+            )
+        if lexical is not None and (result.upserted or result.deleted):
+            lexical.save(lexical_index_path(active_index_name))
+        if local_vectors is not None and (result.upserted or result.deleted):
+            local_vectors.save(local_vector_index_path(active_index_name))
+        if result.upserted or result.deleted:
+            resolver.bump_version()
+        result.manifest.save(path)
+        if checkpoint is not None:
+            checkpoint.remove()
+    else:
+        generation = resumable_generation(client, index_name, active_index_name) or new_generation_name(index_name)
+        lexical = LexicalIndexBuilder() if HYBRID_RETRIEVAL else None
+        local_vectors = LocalVectorIndexBuilder() if LOCAL_VECTOR_INDEX != "none" else None
+        checkpoint = open_checkpoint(index_name, generation, False, local_vectors is not None)
+        try:
+            with stage("ingest", REINDEX_STAGE_SECONDS):
+                result = ingest(
+                    generation,
+                    client,
+                    embeddings,
+                    lexical=lexical,
+                    local_vectors=local_vectors,
+                    snapshot=corpus,
+                    record_snapshot=CORPUS_SNAPSHOT_RECORD,
+                    checkpoint=checkpoint,
+                    on_progress=on_progress,
+                )
+        except Exception:
+            if checkpoint is not None:
+                logger.exception(f"Loading index generation {generation} stopped, the next full reindex resumes it.")
+            else:
+                logger.exception(f"Loading index generation {generation} failed, keeping {active_index_name}.")
+                client.delete_index(generation)
+            raise
+        try:
+            vectorstore = MomentoVectorIndex(embedding=embeddings, client=client, index_name=generation)
+            with stage("validate", REINDEX_STAGE_SECONDS):
+                validate_index(vectorstore, client, result.manifest, previous_manifest)
+        except Exception:
+            logger.exception(f"Index generation {generation} is not fit to serve, keeping {active_index_name}.")
+            client.delete_index(generation)
+            if checkpoint is not None:
+                checkpoint.remove()
+            raise
+        if lexical is not None:
+            lexical.save(lexical_index_path(generation))
+        if local_vectors is not None:
+            local_vectors.save(local_vector_index_path(generation))
+        result.manifest.save(path)
+        resolver.set(generation)
+        if checkpoint is not None:
+            checkpoint.remove()
+        with stage("cleanup", REINDEX_STAGE_SECONDS):
+            delete_old_generations(client, index_name, keep=generation)
+
+    logger.info(f"Reindexing {index_name} complete. Embedding cache: {embedding_stats(embeddings)}")
+
+
+def ingest(
+    index_name: str,
+    client: PreviewVectorIndexClient,
+    embeddings: Embeddings,
+    manifest: Optional[IndexManifest] = None,
+    lexical: Optional[LexicalIndexBuilder] = None,
+    local_vectors: Optional[LocalVectorIndexBuilder] = None,
+    snapshot: Optional[CorpusSnapshot] = None,
+    record_snapshot: bool = False,
+    checkpoint: Optional[IngestCheckpoint] = None,
+    on_progress: Optional[Callable[[dict[str, int]], None]] = None,
+) -> IngestResult:
+    """Streams the docs and blogs into `index_name`, updating `manifest`, `lexical` and
+    `local_vectors` incrementally if given.
+
+    Pages are crawled, or read from `snapshot` if given, and parsed and split on a process pool
+    of `INGEST_WORKERS` processes. The chunks recorded in `snapshot` are reused if they were split
+    with the current `SPLIT_CHUNK_SIZE` and `SPLIT_CHUNK_OVERLAP`. With `record_snapshot`, the
+    crawled pages and their chunks are written to a new snapshot once the ingest succeeds.
+    Completed pages are recorded in `checkpoint`, which is closed when the ingest ends.
+    """
+    sources = [tech_docs_source(), blogs_source()]
+    reuse_chunks = snapshot is not None and snapshot.reuses_chunks(SPLIT_CHUNK_SIZE, SPLIT_CHUNK_OVERLAP)
+    if snapshot is not None and not reuse_chunks:
+        logger.info(f"{snapshot.path} was split with {snapshot.split}, splitting its pages again.")
+    recording = (
+        SnapshotWriter(
+            new_snapshot_path(),
+            split_params(SPLIT_CHUNK_SIZE, SPLIT_CHUNK_OVERLAP),
+            [source.sitemap_url for source in sources],
+        )
+        if record_snapshot and snapshot is None
+        else None
+    )
+    # Recorded chunks are only looked up, which needs no process pool.
+    pool = create_process_pool() if not reuse_chunks else None
+    try:
+        with recording if recording is not None else nullcontext():
+            pipeline = IngestPipeline(
+                sources=sources,
+                crawler=snapshot if snapshot is not None else SitemapCrawler(CrawlCache(), parse_executor=pool),
+                split=snapshot.splitter(split_documents) if snapshot is not None and reuse_chunks else split_documents,
+                embeddings=embeddings,
+                client=client,
+                index_name=index_name,
+                manifest=manifest,
+                executor=pool,
+                lexical=lexical,
+                local_vectors=local_vectors,
+                snapshot=recording,
+                checkpoint=checkpoint,
+                on_progress=on_progress,
+            )
+            return pipeline.run()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+def open_checkpoint(alias: str, index_name: str, incremental: bool, vectors: bool) -> Optional[IngestCheckpoint]:
+    """Resumes or starts the checkpoint of a reindex of `alias` into `index_name`, unless
+    `REINDEX_CHECKPOINTS` is off."""
+    if not REINDEX_CHECKPOINTS:
+        return None
+    return IngestCheckpoint.open(checkpoint_path(alias), index_name, incremental, vectors)
+
 
-    logger.info(f"Reindexing {index_name} complete.")
+def resumable_generation(client: PreviewVectorIndexClient, alias: str, active_index_name: str) -> Optional[str]:
+    """Returns the generation of `alias` a full reindex that stopped was loading, if it can be resumed."""
+    header = IngestCheckpoint.header(checkpoint_path(alias)) if REINDEX_CHECKPOINTS else None
+    if header is None or header["incremental"]:
+        return None
+    generation = header["index_name"]
+    if generation == active_index_name or not is_generation_of(alias, generation):
+        return None
+    return generation if index_exists(client, generation) else None
 
 
-def load_content() -> list[Document]:
+def load_content(snapshot_path: Optional[str] = None) -> list[Document]:
+    """Crawls the docs and blogs. With `snapshot_path`, also splits the pages and writes them
+    with their chunks to a corpus snapshot there."""
     logger.info("Loading content from Momento.")
-    content = load_tech_docs() + load_blogs()
+    sources = [tech_docs_source(), blogs_source()]
+    # Both sitemaps are crawled concurrently, sharing one connection pool and the crawl cache.
+    crawler = SitemapCrawler(CrawlCache())
+    content = asyncio.run(crawler.crawl(sources))
     logger.info(f"Loaded {len(content)} documents.")
+    if snapshot_path is not None:
+        split = split_params(SPLIT_CHUNK_SIZE, SPLIT_CHUNK_OVERLAP)
+        with SnapshotWriter(snapshot_path, split, [source.sitemap_url for source in sources]) as snapshot:
+            split_documents(content, snapshot=snapshot)
+            snapshot.mark_unavailable(crawler.unavailable_sources())
     return content
 
 
+# Elements stripped from pages before indexing: navigation, page chrome, newsletter and
+# social widgets, related posts and FAQs.
+BOILERPLATE_TAGS = frozenset(["title", "nav", "button", "aside", "header", "footer"])
+BOILERPLATE_DIV_CLASSES = frozenset(["page-wrapper", "blog-post_newsletter", "blog-post-social-wrapper"])
+BOILERPLATE_SECTION_CLASSES = frozenset(["section-more-blog-posts"])
+
+
+def is_boilerplate(element: Tag) -> bool:
+    if element.name in BOILERPLATE_TAGS or element.get("id") == "faqs":
+        return True
+    if element.name == "div":
+        return element.get("role") == "region" or not BOILERPLATE_DIV_CLASSES.isdisjoint(element.get("class") or ())
+    if element.name == "section":
+        return not BOILERPLATE_SECTION_CLASSES.isdisjoint(element.get("class") or ())
+    return False
+
+
 def parse_content_fn(content: BeautifulSoup) -> str:
-    # Strip irrelevant elements from the content
-    to_remove = list(
-        itertools.chain(
-            content.find_all("title"),
-            content.find_all("nav"),
-            content.find_all("div", role="region"),
-            content.find_all("div", class_="page-wrapper"),
-            content.find_all("div", class_="blog-post_newsletter"),
-            content.find_all("div", class_="blog-post-social-wrapper"),
-            content.find_all("section", class_="section-more-blog-posts"),
-            content.find_all("button"),
-            content.find_all("aside"),
-            content.find_all(id="faqs"),
-            content.find_all("header"),
-            content.find_all("footer"),
-        )
-    )
+    # Strip irrelevant elements from the content in a single walk of the tree, without
+    # descending into elements that are removed anyway.
+    to_remove = []
+    stack = [child for child in content.contents if isinstance(child, Tag)]
+    while stack:
+        element = stack.pop()
+        if is_boilerplate(element):
+            to_remove.append(element)
+        else:
+            stack.extend(child for child in element.contents if isinstance(child, Tag))
 
     for element in to_remove:
         element.decompose()
@@ -61,11 +328,8 @@ def parse_content_fn(content: BeautifulSoup) -> str:
     return str(content.get_text()).strip()
 
 
-def load_tech_docs() -> list[Document]:
-    tech_docs_loader = SitemapLoader(
-        web_path="https://docs.momentohq.com/sitemap.xml", parsing_function=parse_content_fn
-    )
-    return tech_docs_loader.load()
+def tech_docs_source() -> SitemapSource:
+    return SitemapSource(sitemap_url=TECH_DOCS_SITEMAP_URL, parsing_function=parse_content_fn)
 
 
 def trim_metadata_fn(meta: dict, _content: BeautifulSoup) -> dict:
@@ -73,35 +337,120 @@ def trim_metadata_fn(meta: dict, _content: BeautifulSoup) -> dict:
     return {"source": meta["loc"], **meta}
 
 
-def load_blogs() -> list[Document]:
-    blog_docs_loader = SitemapLoader(
-        web_path="https://www.gomomento.com/sitemap.xml",
-        filter_urls=[r"https://www.gomomento.com/blog.*"],
+def blogs_source() -> SitemapSource:
+    origin = "{0.scheme}://{0.netloc}".format(urlparse(BLOGS_SITEMAP_URL))
+    return SitemapSource(
+        sitemap_url=BLOGS_SITEMAP_URL,
+        filter_urls=[rf"{re.escape(origin)}/blog.*"],
         meta_function=trim_metadata_fn,
     )
-    return blog_docs_loader.load()
 
 
-def split_documents(documents: list[Document], chunk_size: int = 128, chunk_overlap: int = 32) -> list[Document]:
-    text_splitter = TokenTextSplitter(
+def load_tech_docs() -> list[Document]:
+    return asyncio.run(SitemapCrawler(CrawlCache()).crawl([tech_docs_source()]))
+
+
+def load_blogs() -> list[Document]:
+    return asyncio.run(SitemapCrawler(CrawlCache()).crawl([blogs_source()]))
+
+
+@lru_cache(maxsize=None)
+def token_text_splitter(chunk_size: int, chunk_overlap: int) -> TokenTextSplitter:
+    return TokenTextSplitter(
         chunk_size=chunk_size, chunk_overlap=chunk_overlap, model_name="text-embedding-ada-002", add_start_index=True
     )
-    return text_splitter.split_documents(documents)
 
 
-def load_into_mvi(documents: list[Document], index_name: str, momento_env_var_name: str) -> None:
-    client = PreviewVectorIndexClient(
+def split_documents(
+    documents: list[Document],
+    chunk_size: int = SPLIT_CHUNK_SIZE,
+    chunk_overlap: int = SPLIT_CHUNK_OVERLAP,
+    snapshot: Optional[SnapshotWriter] = None,
+) -> list[Document]:
+    """Splits `documents` into chunks, also writing each document and its chunks to `snapshot`
+    if given."""
+    splitter = token_text_splitter(chunk_size, chunk_overlap)
+    if snapshot is None:
+        return splitter.split_documents(documents)
+    chunks = []
+    for document in documents:
+        document_chunks = splitter.split_documents([document])
+        snapshot.write(document, document_chunks)
+        chunks.extend(document_chunks)
+    return chunks
+
+
+def create_vector_index_client(momento_env_var_name: str) -> PreviewVectorIndexClient:
+    return PreviewVectorIndexClient(
         configuration=VectorIndexConfigurations.Default.latest(),
         credential_provider=CredentialProvider.from_environment_variable(momento_env_var_name),
     )
 
-    # We are re-indexing all of the data.
-    # There can be a small availability window where the index is not available or not fully populated.
-    logger.info(f"Deleting index {index_name} if it exists.")
-    client.delete_index(index_name)
 
-    logger.info(f"Creating index {index_name} and indexing {len(documents)} document chunks.")
-    embeddings = OpenAIEmbeddings(model="text-embedding-ada-002")  # type: ignore
-    ids = [f"{document.metadata['source']}, chunk={document.metadata['start_index']}" for document in documents]
-    MomentoVectorIndex.from_documents(documents, embedding=embeddings, client=client, index_name=index_name, ids=ids)
-    logger.info(f"Indexing {len(documents)} document chunks complete.")
+def index_exists(client: PreviewVectorIndexClient, index_name: str) -> bool:
+    response = client.list_indexes()
+    if isinstance(response, ListIndexes.Success):
+        return any(index.name == index_name for index in response.indexes)
+    elif isinstance(response, ListIndexes.Error):
+        raise response.inner_exception
+    raise Exception(f"Unexpected response: {response}")
+
+
+def validate_index(
+    vectorstore: MomentoVectorIndex,
+    client: PreviewVectorIndexClient,
+    manifest: IndexManifest,
+    previous_manifest: Optional[IndexManifest],
+) -> None:
+    """Checks that a freshly loaded index generation is fit to serve.
+
+    The generation must hold a sensible number of chunks compared to the previous one, a sample
+    of the upserted chunks must be readable back, and every validation query must return hits.
+    Reads are retried for a short while since upserts may take a moment to become visible.
+
+    Raises:
+        IndexValidationError: If any of the checks fail.
+    """
+    index_name = vectorstore.index_name
+    ids = manifest.chunk_ids()
+    if not ids:
+        raise IndexValidationError(f"No document chunks were loaded into {index_name}.")
+    if previous_manifest is not None:
+        previous_count = previous_manifest.chunk_count()
+        if len(ids) < previous_count * MIN_CHUNK_RATIO:
+            raise IndexValidationError(f"{index_name} has {len(ids)} document chunks, down from {previous_count}.")
+
+    step = max(1, len(ids) // VALIDATION_SAMPLE_SIZE)
+    sample_ids = ids[::step][:VALIDATION_SAMPLE_SIZE]
+    for attempt in range(1, VALIDATION_ATTEMPTS + 1):
+        response = client.get_item_metadata_batch(index_name, sample_ids)
+        if isinstance(response, GetItemMetadataBatch.Error):
+            raise IndexValidationError(f"Could not read back from {index_name}: {response.message}")
+        found = len(response.values) if isinstance(response, GetItemMetadataBatch.Success) else 0
+        empty_queries = [query for query in VALIDATION_QUERIES if not vectorstore.similarity_search(query, k=1)]
+        if found == len(sample_ids) and not empty_queries:
+            logger.info(f"{index_name} passed validation.")
+            return
+        logger.info(
+            f"Validation attempt {attempt} of {index_name}: found {found} of {len(sample_ids)} sampled chunks, "
+            f"{len(empty_queries)} queries without hits."
+        )
+        time.sleep(VALIDATION_RETRY_SECONDS)
+    raise IndexValidationError(f"{index_name} did not pass validation after {VALIDATION_ATTEMPTS} attempts.")
+
+
+def delete_old_generations(client: PreviewVectorIndexClient, alias: str, keep: str) -> None:
+    """Deletes every generation of `alias` other than `keep`, including ones left by failed runs."""
+    response = client.list_indexes()
+    if not isinstance(response, ListIndexes.Success):
+        logger.warning(f"Could not list indexes to clean up old generations of {alias}: {response}")
+        return
+    for index in response.indexes:
+        if index.name != keep and is_generation_of(alias, index.name):
+            logger.info(f"Deleting old index generation {index.name}.")
+            if isinstance(client.delete_index(index.name), DeleteIndex.Error):
+                logger.warning(f"Could not delete old index generation {index.name}.")
+            for path in [lexical_index_path(index.name), local_vector_index_path(index.name)]:
+                if os.path.exists(path):
+                    os.remove(path)
+
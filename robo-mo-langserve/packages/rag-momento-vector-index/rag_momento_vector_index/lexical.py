@@ -0,0 +1,165 @@
+"""
+A local BM25 index of the indexed chunks, for hybrid lexical + vector retrieval.
+
+Vector search does poorly on exact identifiers such as SDK method names and error codes, which
+a lexical index matches directly. The index is built alongside each index generation during
+reindexing and written next to its manifest as a single file: a JSON header followed by the
+postings, document lengths and chunk records as raw arrays. Servers memory-map the file, so
+loading it is cheap and its pages are shared between processes.
+
+Identifiers are indexed whole and by their parts, so `CacheClient.setIfNotExists` matches
+queries for `setIfNotExists`, `set_if_not_exists` as well as `set if not exists`.
+"""
+import logging
+import math
+import os
+import re
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from .arrayfile import pack_chunks, read_array_file, unpack_chunk, write_array_file
+from .manifest import MANIFEST_DIR, chunk_id
+
+logger = logging.getLogger(__name__)
+
+LEXICAL_INDEX_VERSION = 1
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+IDENTIFIER = re.compile(r"\w+(?:[.\-:/]\w+)*")
+CAMEL_CASE_BOUNDARY = re.compile(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])")
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased words, with compound identifiers also split into their parts."""
+    tokens = []
+    for match in IDENTIFIER.finditer(text):
+        identifier = match.group()
+        parts = [
+            part
+            for segment in re.split(r"[.\-:/_]", identifier)
+            for part in CAMEL_CASE_BOUNDARY.split(segment)
+            if part
+        ]
+        tokens.append(identifier.lower())
+        if len(parts) > 1 or parts and parts[0] != identifier:
+            tokens.extend(part.lower() for part in parts)
+    return tokens
+
+
+def lexical_index_path(index_name: str, manifest_dir: str = MANIFEST_DIR) -> str:
+    return os.path.join(manifest_dir, f"{index_name}.bm25")
+
+
+class LexicalIndex:
+    """A read-only, memory-mapped BM25 index over the chunks of one index generation."""
+
+    def __init__(self, terms: dict[str, int], avg_length: float, arrays: dict[str, np.ndarray]):
+        self.terms = terms
+        self.avg_length = avg_length
+        self.postings_offsets = arrays["postings_offsets"]
+        self.postings_docs = arrays["postings_docs"]
+        self.postings_tf = arrays["postings_tf"]
+        self.doc_lengths = arrays["doc_lengths"]
+        self.arrays = arrays
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["LexicalIndex"]:
+        """Memory-maps the index at `path`, returning None if there is none or it is unusable."""
+        loaded = read_array_file(path, LEXICAL_INDEX_VERSION)
+        if loaded is None:
+            return None
+        header, arrays = loaded
+        return cls({term: i for i, term in enumerate(header["terms"])}, header["avg_length"], arrays)
+
+    def document(self, doc: int) -> tuple[str, Document]:
+        """Returns the chunk id and the chunk stored for `doc`."""
+        return unpack_chunk(self.arrays, doc)
+
+    def documents(self) -> dict[str, Document]:
+        return dict(self.document(doc) for doc in range(len(self)))
+
+    def search(self, query: str, k: int) -> list[Document]:
+        """Returns the `k` chunks that best match `query` by BM25, best first."""
+        if not len(self):
+            return []
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(tokenize(query)):
+            index = self.terms.get(term)
+            if index is None:
+                continue
+            start, end = int(self.postings_offsets[index]), int(self.postings_offsets[index + 1])
+            docs = self.postings_docs[start:end]
+            tf = self.postings_tf[start:end].astype(np.float32)
+            idf = math.log(1 + (len(self) - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[docs] / self.avg_length)
+            scores[docs] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [self.document(int(doc))[1] for doc in best]
+
+
+class LexicalIndexBuilder:
+    """Collects the chunks of an index generation and writes its `LexicalIndex`.
+
+    Args:
+        chunks (Optional[dict[str, Document]]): The chunks already in the generation by chunk
+            id, eg from the lexical index being updated incrementally.
+    """
+
+    def __init__(self, chunks: Optional[dict[str, Document]] = None):
+        self.chunks: dict[str, Document] = dict(chunks or {})
+
+    @classmethod
+    def load(cls, path: str) -> Optional["LexicalIndexBuilder"]:
+        """Starts from the lexical index at `path`, or returns None if there is none."""
+        index = LexicalIndex.load(path)
+        return cls(index.documents()) if index is not None else None
+
+    def add(self, documents: list[Document]) -> None:
+        for document in documents:
+            self.chunks[chunk_id(document)] = document
+
+    def remove(self, ids: list[str]) -> None:
+        for id_ in ids:
+            self.chunks.pop(id_, None)
+
+    def save(self, path: str) -> None:
+        """Builds the index and atomically writes it to `path`."""
+        postings: dict[str, list[tuple[int, int]]] = {}
+        doc_lengths = []
+        chunks = sorted(self.chunks.items())
+        for doc, (_, document) in enumerate(chunks):
+            tokens = tokenize(document.page_content)
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc, tf))
+
+        terms = sorted(postings)
+        postings_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        postings_offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        flat = [posting for term in terms for posting in postings[term]]
+        arrays = {
+            "postings_offsets": postings_offsets,
+            "postings_docs": np.array([doc for doc, _ in flat], dtype=np.int32),
+            "postings_tf": np.array([min(tf, 65535) for _, tf in flat], dtype=np.uint16),
+            "doc_lengths": np.array(doc_lengths, dtype=np.int32),
+            **pack_chunks(chunks),
+        }
+        header = {
+            "version": LEXICAL_INDEX_VERSION,
+            "avg_length": float(np.mean(doc_lengths)) if doc_lengths else 0.0,
+            "terms": terms,
+        }
+        write_array_file(path, header, arrays)
+        logger.info(f"Wrote lexical index of {len(chunks)} chunks and {len(terms)} terms to {path}.")
+
@@ -0,0 +1,159 @@
+"""
+An in-process copy of the vector index, searched by brute force on each server.
+
+The corpus is small enough, tens of thousands of chunks, that a matrix of its embeddings fits in
+memory and a top-k search over it is a single matrix-vector product, faster than a round trip
+to MVI. With `LOCAL_VECTOR_INDEX` set to `primary` or `fallback`, reindexing writes the
+embeddings of every chunk of the generation next to its manifest, together with the chunks
+themselves, in the same memory-mapped file format as the lexical index. `primary` answers every
+search from it; `fallback` only searches it when MVI errors or takes longer than
+`LOCAL_VECTOR_FALLBACK_TIMEOUT_SECONDS`.
+
+Vectors are normalized, so the dot product is the cosine similarity MVI ranks by, and stored as
+float32 or, with `LOCAL_VECTOR_DTYPE=int8`, quantized per row to a quarter of the size.
+"""
+import logging
+import os
+from functools import lru_cache
+from typing import Optional
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from .arrayfile import pack_chunks, read_array_file, unpack_chunk, write_array_file
+from .manifest import MANIFEST_DIR, chunk_id
+
+logger = logging.getLogger(__name__)
+
+LOCAL_VECTOR_INDEX = os.environ.get("LOCAL_VECTOR_INDEX", "none").lower()
+LOCAL_VECTOR_DTYPE = os.environ.get("LOCAL_VECTOR_DTYPE", "float32").lower()
+LOCAL_VECTOR_FALLBACK_TIMEOUT_SECONDS = float(os.environ.get("LOCAL_VECTOR_FALLBACK_TIMEOUT_SECONDS", "1.0"))
+LOCAL_VECTOR_INDEX_VERSION = 1
+# Rows of an int8 matrix converted to float32 at a time, which bounds the memory a search takes.
+BLOCK_ROWS = 4096
+
+if LOCAL_VECTOR_INDEX not in ("none", "fallback", "primary"):
+    raise ValueError(f"Unknown LOCAL_VECTOR_INDEX {LOCAL_VECTOR_INDEX!r}, expected none, fallback or primary.")
+
+
+def local_vector_index_path(index_name: str, manifest_dir: str = MANIFEST_DIR) -> str:
+    return os.path.join(manifest_dir, f"{index_name}.vectors")
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> tuple[np.ndarray, np.ndarray]:
+    """Returns `vectors` as `dtype` and the per-row scales that restore them."""
+    if dtype == "float32":
+        return vectors.astype(np.float32), np.ones(len(vectors), dtype=np.float32)
+    if dtype != "int8":
+        raise ValueError(f"Unknown LOCAL_VECTOR_DTYPE {dtype!r}, expected float32 or int8.")
+    scales = np.abs(vectors).max(axis=1, initial=0.0) / 127
+    scales[scales == 0] = 1.0
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+class LocalVectorIndex:
+    """A read-only, memory-mapped matrix of the embeddings of one index generation's chunks."""
+
+    def __init__(self, arrays: dict[str, np.ndarray]):
+        self.vectors = arrays["vectors"]
+        self.scales = arrays["scales"]
+        self.arrays = arrays
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["LocalVectorIndex"]:
+        """Memory-maps the index at `path`, returning None if there is none or it is unusable."""
+        loaded = read_array_file(path, LOCAL_VECTOR_INDEX_VERSION)
+        return cls(loaded[1]) if loaded is not None else None
+
+    def document(self, row: int) -> tuple[str, Document]:
+        """Returns the chunk id and the chunk stored for `row`."""
+        return unpack_chunk(self.arrays, row)
+
+    def documents(self) -> dict[str, tuple[Document, np.ndarray]]:
+        """Every chunk by chunk id, with its normalized vector."""
+        vectors = self.vectors.astype(np.float32) * self.scales[:, None]
+        chunks = {}
+        for row in range(len(self)):
+            id_, document = self.document(row)
+            chunks[id_] = (document, vectors[row])
+        return chunks
+
+    def scores(self, vector: list[float]) -> np.ndarray:
+        """The cosine similarity of `vector` to every chunk."""
+        query = normalize(np.asarray(vector, dtype=np.float32))
+        if self.vectors.dtype == np.float32:
+            return self.vectors @ query
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), BLOCK_ROWS):
+            end = start + BLOCK_ROWS
+            scores[start:end] = self.vectors[start:end].astype(np.float32) @ query
+        return scores * self.scales
+
+    def search(self, vector: list[float], k: int) -> list[Document]:
+        """Returns the `k` chunks most similar to the embedding `vector`, best first."""
+        k = min(k, len(self))
+        if k == 0:
+            return []
+        scores = self.scores(vector)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [self.document(int(row))[1] for row in best]
+
+
+class LocalVectorIndexBuilder:
+    """Collects the chunks of an index generation with their embeddings and writes its
+    `LocalVectorIndex`.
+
+    Args:
+        chunks (Optional[dict[str, tuple[Document, np.ndarray]]]): The chunks already in the
+            generation and their vectors by chunk id, eg from the index being updated incrementally.
+    """
+
+    def __init__(self, chunks: Optional[dict[str, tuple[Document, np.ndarray]]] = None):
+        self.chunks: dict[str, tuple[Document, np.ndarray]] = dict(chunks or {})
+
+    @classmethod
+    def load(cls, path: str) -> Optional["LocalVectorIndexBuilder"]:
+        """Starts from the local vector index at `path`, or returns None if there is none."""
+        index = LocalVectorIndex.load(path)
+        return cls(index.documents()) if index is not None else None
+
+    def add(self, documents: list[Document], vectors: list[list[float]]) -> None:
+        normalized = normalize(np.asarray(vectors, dtype=np.float32))
+        for document, vector in zip(documents, normalized):
+            self.chunks[chunk_id(document)] = (document, vector)
+
+    def remove(self, ids: list[str]) -> None:
+        for id_ in ids:
+            self.chunks.pop(id_, None)
+
+    def save(self, path: str, dtype: str = LOCAL_VECTOR_DTYPE) -> None:
+        """Builds the index with vectors of `dtype` and atomically writes it to `path`."""
+        chunks = sorted(self.chunks.items())
+        dimensions = len(chunks[0][1][1]) if chunks else 0
+        matrix = np.array([vector for _, (_, vector) in chunks], dtype=np.float32).reshape(len(chunks), dimensions)
+        vectors, scales = quantize(matrix, dtype)
+        arrays = {
+            "vectors": vectors,
+            "scales": scales,
+            **pack_chunks([(id_, document) for id_, (document, _) in chunks]),
+        }
+        write_array_file(path, {"version": LOCAL_VECTOR_INDEX_VERSION}, arrays)
+        logger.info(f"Wrote {dtype} local vector index of {len(chunks)} chunks to {path}.")
+
+
+@lru_cache(maxsize=2)
+def local_vector_index_for(index_name: str, version: str) -> Optional[LocalVectorIndex]:
+    """Memory-maps the local vector index of `index_name`, reloading it whenever `version` changes."""
+    index = LocalVectorIndex.load(local_vector_index_path(index_name))
+    if index is None:
+        logger.warning(f"No local vector index for {index_name}, searching MVI only.")
+    return index
@@ -0,0 +1,138 @@
+"""
+A persisted record of what has been indexed, used to reindex incrementally.
+
+The manifest maps each page URL to a hash of its parsed content and to the ids and
+content hashes of the chunks that were upserted for it. Comparing a fresh crawl against
+the manifest tells us which pages changed, which chunks need to be (re-)embedded and
+which chunks should be deleted from the index.
+"""
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+from langchain.docstore.document import Document
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+MANIFEST_DIR = os.environ.get("REINDEX_MANIFEST_DIR", "manifests")
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_id(document: Document) -> str:
+    return f"{document.metadata['source']}, chunk={document.metadata['start_index']}"
+
+
+def manifest_path(index_name: str, manifest_dir: str = MANIFEST_DIR) -> str:
+    return os.path.join(manifest_dir, f"{index_name}.json")
+
+
+@dataclass
+class PageEntry:
+    content_hash: str
+    # chunk id -> hash of the chunk content
+    chunks: dict[str, str] = field(default_factory=dict)
+
+
+class IndexManifest:
+    """Per-page content hashes and per-chunk ids for a single index."""
+
+    def __init__(self, index_name: str, pages: Optional[dict[str, PageEntry]] = None):
+        self.index_name = index_name
+        self.pages: dict[str, PageEntry] = pages if pages is not None else {}
+
+    @classmethod
+    def build(cls, index_name: str, documents: list[Document], chunks: list[Document]) -> "IndexManifest":
+        """Builds a manifest from the pages and the chunks that were split from them."""
+        manifest = cls(index_name)
+        chunks_by_source: dict[str, list[Document]] = {}
+        for chunk in chunks:
+            chunks_by_source.setdefault(chunk.metadata["source"], []).append(chunk)
+        for document in documents:
+            manifest.update_page(document, chunks_by_source.get(document.metadata["source"], []))
+        return manifest
+
+    @classmethod
+    def load(cls, path: str) -> Optional["IndexManifest"]:
+        """Loads a manifest from disk, returning None if there is none or it is unusable."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable manifest {path}: {e}")
+            return None
+        if data.get("version") != MANIFEST_VERSION:
+            logger.warning(f"Ignoring manifest {path} with unsupported version {data.get('version')}.")
+            return None
+        pages = {
+            source: PageEntry(content_hash=entry["content_hash"], chunks=entry["chunks"])
+            for source, entry in data["pages"].items()
+        }
+        return cls(data["index_name"], pages)
+
+    def save(self, path: str) -> None:
+        """Atomically writes the manifest to disk."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        data = {
+            "version": MANIFEST_VERSION,
+            "index_name": self.index_name,
+            "pages": {
+                source: {"content_hash": page.content_hash, "chunks": page.chunks}
+                for source, page in sorted(self.pages.items())
+            },
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def chunk_count(self) -> int:
+        return sum(len(page.chunks) for page in self.pages.values())
+
+    def chunk_ids(self) -> list[str]:
+        return [id_ for page in self.pages.values() for id_ in page.chunks]
+
+    def page_changed(self, document: Document) -> bool:
+        """Whether the page is new or its content differs from the manifest."""
+        page = self.pages.get(document.metadata["source"])
+        return page is None or page.content_hash != content_hash(document.page_content)
+
+    def update_page(self, document: Document, chunks: list[Document]) -> tuple[list[Document], list[str]]:
+        """Records the fresh content of a page and returns the index changes needed for it.
+
+        Args:
+            document (Document): The page.
+            chunks (list[Document]): The chunks split from the page.
+
+        Returns:
+            tuple[list[Document], list[str]]: The chunks that are new or changed and need to be
+                upserted, and the ids of chunks the page no longer has.
+        """
+        source = document.metadata["source"]
+        old_chunks = self.pages[source].chunks if source in self.pages else {}
+        page = PageEntry(content_hash=content_hash(document.page_content))
+        upsert = []
+        for chunk in chunks:
+            id_, hash_ = chunk_id(chunk), content_hash(chunk.page_content)
+            page.chunks[id_] = hash_
+            if old_chunks.get(id_) != hash_:
+                upsert.append(chunk)
+        self.pages[source] = page
+        return upsert, [id_ for id_ in old_chunks if id_ not in page.chunks]
+
+    def remove_pages_not_in(self, sources: set[str]) -> list[str]:
+        """Forgets pages that are no longer crawled and returns the ids of their chunks."""
+        delete = []
+        for source in [source for source in self.pages if source not in sources]:
+            delete.extend(self.pages.pop(source).chunks)
+        return delete
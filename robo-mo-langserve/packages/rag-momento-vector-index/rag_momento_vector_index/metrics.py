@@ -0,0 +1,391 @@
+"""
+Timings and counters for the RAG chain and reindexing, exposed in the Prometheus text format.
+
+Stages are timed with `stage()` or `@timed()`, which also open an OpenTelemetry span when
+`OTEL_TRACING=true` and `opentelemetry-api` is installed; spans go to whatever tracer provider
+the application configures. With `METRICS=false` and tracing off, `@timed()` returns functions
+unchanged and `stage()` does nothing, so instrumentation costs nothing.
+
+Metrics live in a per-process registry. The reindex worker process hands what it recorded back
+to the server with `REGISTRY.drain()` and `REGISTRY.merge()`, so `/metrics` covers both.
+"""
+import bisect
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Iterator, Optional
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+from .context import encoding
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.environ.get("METRICS", "true").lower() == "true"
+OTEL_TRACING = os.environ.get("OTEL_TRACING", "false").lower() == "true"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+LabelValues = tuple[str, ...]
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}", *self._samples()]
+
+    @abstractmethod
+    def _samples(self) -> list[str]:
+        pass
+
+    @abstractmethod
+    def drain(self) -> Any:
+        """Returns what was recorded since the last drain, picklable, and forgets it."""
+
+    @abstractmethod
+    def merge(self, state: Any) -> None:
+        """Adds what another process `drain`ed to this metric."""
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        super().__init__(name, help, label_names)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in sorted(values.items())]
+
+    def drain(self) -> list:
+        with self._lock:
+            state, self._values = list(self._values.items()), {}
+        return state
+
+    def merge(self, state: list) -> None:
+        with self._lock:
+            for key, value in state:
+                key = tuple(key)
+                self._values[key] = self._values.get(key, 0.0) + value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name: str, help: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, help, label_names)
+        self.buckets = buckets
+        # label values -> (count per bucket, with a final +Inf bucket, sum)
+        self._values: dict[LabelValues, tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip([*map(str, self.buckets), "+Inf"], counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, key, 'le="' + bound + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+    def drain(self) -> list:
+        with self._lock:
+            state, self._values = list(self._values.items()), {}
+        return state
+
+    def merge(self, state: list) -> None:
+        with self._lock:
+            for key, (counts, total) in state:
+                key = tuple(key)
+                current, current_total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+                self._values[key] = ([a + b for a, b in zip(current, counts)], current_total + total)
+
+
+class CallbackGauge(Metric):
+    """A gauge whose values are read from `collect` at scrape time, e.g. cache counters."""
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple[str, ...],
+        collect: Callable[[], dict[LabelValues, float]],
+    ):
+        super().__init__(name, help, label_names)
+        self.collect = collect
+
+    def _samples(self) -> list[str]:
+        try:
+            values = self.collect()
+        except Exception:
+            logger.exception(f"Could not collect {self.name}.")
+            return []
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in sorted(values.items())]
+
+    def drain(self) -> None:
+        return None
+
+    def merge(self, state: None) -> None:
+        pass
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+    def drain(self) -> dict[str, Any]:
+        """Returns what was recorded since the last drain and resets it."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.drain() for metric in metrics}
+
+    def merge(self, state: dict[str, Any]) -> None:
+        """Adds what another process drained to this registry."""
+        for name, metric_state in state.items():
+            metric = self._metrics.get(name)
+            if metric is not None and metric_state:
+                metric.merge(metric_state)
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(
+    Histogram("rag_stage_seconds", "Time spent in each stage of answering a question.", ("stage",))
+)
+LLM_TIME_TO_FIRST_TOKEN_SECONDS = REGISTRY.register(
+    Histogram("rag_llm_time_to_first_token_seconds", "Time from calling the LLM to its first streamed token.")
+)
+LLM_TOKENS = REGISTRY.register(
+    Counter("rag_llm_tokens_total", "Tokens sent to and generated by the LLM, where reported.", ("kind",))
+)
+RETRIEVED_DOCUMENTS = REGISTRY.register(
+    Histogram("rag_retrieved_documents", "Document chunks retrieved per question.", buckets=COUNT_BUCKETS)
+)
+ROUTED_QUESTIONS = REGISTRY.register(
+    Counter("rag_routed_questions_total", "Questions by the model tier they were routed to.", ("tier", "reason"))
+)
+LLM_TIER_SECONDS = REGISTRY.register(
+    Histogram("rag_llm_tier_seconds", "LLM latency by model tier and model.", ("tier", "model"))
+)
+LLM_TIER_TOKENS = REGISTRY.register(
+    Counter("rag_llm_tier_tokens_total", "Tokens sent to and generated by model tier.", ("tier", "model", "kind"))
+)
+LLM_FALLBACKS = REGISTRY.register(
+    Counter("rag_llm_fallbacks_total", "Answers handed to the fallback model, by tier and why.", ("tier", "reason"))
+)
+LOCAL_VECTOR_SEARCHES = REGISTRY.register(
+    Counter("rag_local_vector_searches_total", "Searches answered from the local vector index, by why.", ("reason",))
+)
+CONVERSATION_QUESTIONS = REGISTRY.register(
+    Counter("rag_conversation_questions_total", "Chat questions by whether they were rewritten.", ("kind",))
+)
+COALESCED_REQUESTS = REGISTRY.register(
+    Counter("rag_coalesced_requests_total", "Questions that started or joined an in-flight answer.", ("role",))
+)
+ADMISSION_REQUESTS = REGISTRY.register(
+    Counter("rag_admission_requests_total", "Requests to the chain endpoints by admission outcome.", ("outcome",))
+)
+ADMISSION_WAIT_SECONDS = REGISTRY.register(
+    Histogram("rag_admission_wait_seconds", "Time requests to the chain endpoints queued before being admitted.")
+)
+REINDEX_STAGE_SECONDS = REGISTRY.register(
+    Histogram("reindex_stage_seconds", "Time spent in each stage of a reindex.", ("stage",))
+)
+REINDEX_ITEMS = REGISTRY.register(
+    Counter("reindex_items_total", "Items produced by each stage of the ingest pipeline.", ("stage",))
+)
+REINDEX_BUSY_SECONDS = REGISTRY.register(
+    Counter("reindex_busy_seconds_total", "Time each stage of the ingest pipeline spent working.", ("stage",))
+)
+REINDEX_RUNS = REGISTRY.register(Counter("reindex_runs_total", "Reindex jobs by outcome.", ("outcome",)))
+
+
+def register_cache_stats(name: str, help: str, stats: Callable[[], dict[str, float]]) -> None:
+    """Exposes the `hits` and `misses` of a cache's `stats()` as `name{result=...}`."""
+    REGISTRY.register(
+        CallbackGauge(
+            name,
+            help,
+            ("result",),
+            lambda: {(result,): value for result, value in stats().items() if result in ("hits", "misses")},
+        )
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _tracer() -> Optional[Any]:
+    if not OTEL_TRACING:
+        return None
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        logger.warning("OTEL_TRACING is set but opentelemetry-api is not installed; not tracing.")
+        return None
+    return trace.get_tracer("rag_momento_vector_index")
+
+
+@contextmanager
+def stage(name: str, histogram: Histogram = STAGE_SECONDS) -> Iterator[None]:
+    """Times the enclosed block as stage `name`, in a span of the same name if tracing."""
+    tracer = _tracer()
+    if not METRICS_ENABLED and tracer is None:
+        yield
+        return
+    start = time.perf_counter()
+    with tracer.start_as_current_span(name) if tracer is not None else nullcontext():
+        try:
+            yield
+        finally:
+            if METRICS_ENABLED:
+                histogram.observe(time.perf_counter() - start, stage=name)
+
+
+def timed(name: str, histogram: Histogram = STAGE_SECONDS) -> Callable[[Callable], Callable]:
+    """Decorates a sync or async function to run as `stage(name)`."""
+
+    def decorate(func: Callable) -> Callable:
+        if not METRICS_ENABLED and _tracer() is None:
+            return func
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                with stage(name, histogram):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with stage(name, histogram):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """Records LLM latency, time to first token and token usage from LangChain callbacks, also
+    by model tier if the model serves one.
+
+    Args:
+        tier (str): The model tier the model serves, if any.
+        model (str): The name of the model.
+    """
+
+    run_inline = True
+
+    def __init__(self, tier: str = "", model: str = "") -> None:
+        self.tier = tier
+        self.model = model
+        # run id -> (start time, whether a token has been streamed yet)
+        self._runs: dict[UUID, list] = {}
+
+    def _count_completion_tokens(self, tokens: float) -> None:
+        LLM_TOKENS.inc(tokens, kind="completion")
+        if self.tier:
+            LLM_TIER_TOKENS.inc(tokens, tier=self.tier, model=self.model, kind="completion")
+
+    def on_chat_model_start(self, serialized: dict, messages: list, *, run_id: UUID, **kwargs: Any) -> None:
+        self._runs[run_id] = [time.perf_counter(), False]
+        if self.tier:
+            # Counted as the prompt is sent, since streamed responses do not report their usage.
+            tokens = sum(
+                len(encoding().encode(message.content, disallowed_special=()))
+                for prompt in messages
+                for message in prompt
+                if isinstance(message.content, str)
+            )
+            LLM_TIER_TOKENS.inc(tokens, tier=self.tier, model=self.model, kind="prompt")
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.get(run_id)
+        if run is None:
+            return
+        if not run[1]:
+            run[1] = True
+            LLM_TIME_TO_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - run[0])
+        self._count_completion_tokens(1)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        elapsed = time.perf_counter() - run[0]
+        STAGE_SECONDS.observe(elapsed, stage="llm")
+        if self.tier:
+            LLM_TIER_SECONDS.observe(elapsed, tier=self.tier, model=self.model)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if usage.get("prompt_tokens"):
+            LLM_TOKENS.inc(usage["prompt_tokens"], kind="prompt")
+        # Streamed tokens were counted as they arrived.
+        if usage.get("completion_tokens") and not run[1]:
+            self._count_completion_tokens(usage["completion_tokens"])
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._runs.pop(run_id, None)
+
+
+def llm_callbacks(tier: str = "", model: str = "") -> list[BaseCallbackHandler]:
+    """Callbacks to attach to the LLM `model` serving `tier`, or none if metrics are disabled."""
+    return [LLMMetricsHandler(tier, model)] if METRICS_ENABLED else []
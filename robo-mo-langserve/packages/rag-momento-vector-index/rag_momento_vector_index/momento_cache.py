@@ -0,0 +1,26 @@
+"""
+Helpers for the Momento caches used alongside the vector index.
+"""
+from datetime import timedelta
+
+from momento import CacheClient, Configurations, CredentialProvider
+from momento.responses import CreateCache
+
+
+def create_cache_client(
+    cache_name: str, default_ttl: timedelta, momento_env_var_name: str = "MOMENTO_API_KEY"
+) -> CacheClient:
+    """Creates a cache client and makes sure `cache_name` exists.
+
+    This connects to Momento, so the stores that use a cache call it from a `cached_property` on
+    first use rather than when they are constructed, which keeps importing the chain fast.
+    """
+    client = CacheClient(
+        Configurations.InRegion.Default.latest(),
+        CredentialProvider.from_environment_variable(momento_env_var_name),
+        default_ttl,
+    )
+    response = client.create_cache(cache_name)
+    if isinstance(response, CreateCache.Error):
+        raise response.inner_exception
+    return client
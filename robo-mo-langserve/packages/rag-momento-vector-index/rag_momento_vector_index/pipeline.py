@@ -0,0 +1,445 @@
+"""
+A streaming ingest pipeline: fetch → split → embed → upsert.
+
+Each stage runs concurrently with the others and hands work to the next one through a bounded
+queue, so a slow stage applies backpressure upstream and memory stays flat no matter how many
+pages are crawled. Chunks are embedded and upserted in batches as soon as enough of them have
+arrived, rather than after the whole crawl.
+
+When given the manifest of the index being updated, only pages whose content changed are split,
+only new or changed chunks are embedded and upserted, and chunks of pages that changed shape or
+disappeared are deleted once the crawl is complete. Pages the crawler could not fetch but that
+may still exist, eg because their host was down, are kept as they were.
+
+When given a checkpoint, each page is recorded in it once all of its chunks are upserted, and
+the pages it already holds from an earlier run that stopped are skipped as if they were in the
+manifest.
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional, Union
+
+from langchain.docstore.document import Document
+from langchain_core.embeddings import Embeddings
+from momento import PreviewVectorIndexClient
+from momento.requests.vector_index import Item, SimilarityMetric
+from momento.responses.vector_index import CreateIndex, DeleteItemBatch, UpsertItemBatch
+
+from .checkpoint import IngestCheckpoint
+from .crawler import SitemapCrawler, SitemapSource
+from .lexical import LexicalIndexBuilder
+from .local_index import LocalVectorIndexBuilder
+from .manifest import IndexManifest, PageEntry, chunk_id
+from .metrics import REINDEX_BUSY_SECONDS, REINDEX_ITEMS, REINDEX_STAGE_SECONDS, stage
+from .snapshot import CorpusSnapshot, SnapshotWriter
+
+logger = logging.getLogger(__name__)
+
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", "64"))
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "256"))
+EMBED_CONCURRENCY = int(os.environ.get("EMBED_CONCURRENCY", "2"))
+UPSERT_BATCH_SIZE = int(os.environ.get("UPSERT_BATCH_SIZE", "128"))
+UPSERT_CONCURRENCY = int(os.environ.get("UPSERT_CONCURRENCY", "2"))
+# Processes used to parse and split pages. 0 parses and splits on threads instead.
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", str(os.cpu_count() or 1)))
+INGEST_PROGRESS_INTERVAL_SECONDS = float(os.environ.get("INGEST_PROGRESS_INTERVAL_SECONDS", "30"))
+TEXT_FIELD = "text"
+
+
+@dataclass
+class StageStats:
+    """Progress of a single pipeline stage."""
+
+    name: str
+    items_in: int = 0
+    items_out: int = 0
+    busy_seconds: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Items produced per second spent working."""
+        return self.items_out / self.busy_seconds if self.busy_seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: {self.items_in} in, {self.items_out} out, "
+            f"{self.busy_seconds:.1f}s busy, {self.throughput:.1f}/s"
+        )
+
+
+def create_process_pool(workers: int = INGEST_WORKERS) -> Optional[ProcessPoolExecutor]:
+    """Returns a pool for the CPU bound parse and split work, or None if `workers` is 0."""
+    if workers <= 0:
+        return None
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def reap(tasks: set[asyncio.Task]) -> None:
+    """Drops finished tasks from `tasks`, re-raising the first failure."""
+    for task in [task for task in tasks if task.done()]:
+        tasks.discard(task)
+        task.result()
+
+
+@dataclass
+class UnfinishedPage:
+    """A split page, some of whose chunks are not upserted yet."""
+
+    entry: PageEntry
+    deleted: list[str]
+    remaining: int
+    upserted: list[Document] = field(default_factory=list)
+    vectors: list[list[float]] = field(default_factory=list)
+
+
+@dataclass
+class IngestResult:
+    manifest: IndexManifest
+    upserted: int
+    deleted: int
+    stats: dict[str, StageStats] = field(default_factory=dict)
+
+
+class IngestPipeline:
+    """Streams the pages of `sources` into the vector index `index_name`.
+
+    Args:
+        sources (list[SitemapSource]): The sitemaps to crawl.
+        crawler (Union[SitemapCrawler, CorpusSnapshot]): Fetches the pages, or replays them from
+            a snapshot.
+        split (Callable[[list[Document]], list[Document]]): Splits pages into chunks carrying
+            `source` and `start_index` metadata. Must be picklable if `executor` is a process pool.
+        embeddings (Embeddings): Embeds the chunks.
+        client (PreviewVectorIndexClient): The vector index client.
+        index_name (str): The index to upsert into. It is created if it does not exist.
+        manifest (Optional[IndexManifest]): The manifest of `index_name` to update
+            incrementally. If None, every chunk is upserted into what is assumed to be a fresh
+            index and a new manifest is built.
+        executor (Optional[Executor]): Where pages are split, typically the process pool the
+            crawler parses on. If None, the event loop's default thread pool is used.
+        lexical (Optional[LexicalIndexBuilder]): If given, collects the upserted chunks and
+            forgets the deleted ones, to build the lexical index of `index_name`.
+        local_vectors (Optional[LocalVectorIndexBuilder]): If given, collects the upserted chunks
+            with their embeddings and forgets the deleted ones, to build the local vector index
+            of `index_name`.
+        snapshot (Optional[SnapshotWriter]): If given, records every fetched page, with its
+            chunks if it was split, and the pages that could not be fetched.
+        checkpoint (Optional[IngestCheckpoint]): If given, the pages it holds are skipped unless
+            they changed, and every page is recorded in it once its chunks are upserted.
+        on_progress (Optional[Callable[[dict[str, int]], None]]): Called with the `progress` of
+            the pipeline as pages are fetched and batches embedded and upserted. Whatever it
+            raises stops the ingest.
+    """
+
+    def __init__(
+        self,
+        sources: list[SitemapSource],
+        crawler: Union[SitemapCrawler, CorpusSnapshot],
+        split: Callable[[list[Document]], list[Document]],
+        embeddings: Embeddings,
+        client: PreviewVectorIndexClient,
+        index_name: str,
+        manifest: Optional[IndexManifest] = None,
+        executor: Optional[Executor] = None,
+        lexical: Optional[LexicalIndexBuilder] = None,
+        local_vectors: Optional[LocalVectorIndexBuilder] = None,
+        snapshot: Optional[SnapshotWriter] = None,
+        checkpoint: Optional[IngestCheckpoint] = None,
+        on_progress: Optional[Callable[[dict[str, int]], None]] = None,
+    ):
+        self.sources = sources
+        self.crawler = crawler
+        self.split = split
+        self.embeddings = embeddings
+        self.client = client
+        self.index_name = index_name
+        self.executor = executor
+        self.lexical = lexical
+        self.local_vectors = local_vectors
+        self.snapshot = snapshot
+        self.checkpoint = checkpoint
+        self.on_progress = on_progress
+        # Pages a checkpoint holds are skipped as if they were in the manifest of a partial index.
+        self.incremental = manifest is not None or bool(checkpoint is not None and checkpoint.pages)
+        self.manifest = manifest if manifest is not None else IndexManifest(index_name)
+        self.stats = {name: StageStats(name) for name in ["fetch", "split", "embed", "upsert"]}
+        self._seen_sources: set[str] = set()
+        self._pending_deletes: list[str] = []
+        self._unfinished: dict[str, UnfinishedPage] = {}
+        self._resumed_pages = 0
+        self._deleted = 0
+        self._index_ready = False
+
+    def run(self) -> IngestResult:
+        return asyncio.run(self.arun())
+
+    async def arun(self) -> IngestResult:
+        if self.checkpoint is not None:
+            self._resume(self.checkpoint)
+        pages: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+        chunks: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+        batches: asyncio.Queue = asyncio.Queue(maxsize=max(1, EMBED_CONCURRENCY))
+
+        tasks = [
+            asyncio.create_task(self._fetch(pages)),
+            asyncio.create_task(self._split(pages, chunks)),
+            asyncio.create_task(self._embed(chunks, batches)),
+            asyncio.create_task(self._upsert(batches)),
+        ]
+        reporter = asyncio.create_task(self._report_progress())
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            reporter.cancel()
+        if self.checkpoint is not None:
+            self.checkpoint.commit()
+
+        if self.incremental:
+            self._pending_deletes.extend(self.manifest.remove_pages_not_in(self._seen_sources))
+        # After resuming, a page may have gotten back a chunk it lost in the earlier run.
+        live = set(self.manifest.chunk_ids())
+        self._pending_deletes = [id_ for id_ in dict.fromkeys(self._pending_deletes) if id_ not in live]
+        with stage("delete", REINDEX_STAGE_SECONDS):
+            await self._delete(self._pending_deletes)
+        self._notify_progress()
+        if self.lexical is not None:
+            self.lexical.remove(self._pending_deletes)
+        if self.local_vectors is not None:
+            self.local_vectors.remove(self._pending_deletes)
+
+        logger.info(f"Ingest into {self.index_name} complete: {'; '.join(map(str, self.stats.values()))}")
+        for stats in self.stats.values():
+            REINDEX_ITEMS.inc(stats.items_out, stage=stats.name)
+            REINDEX_BUSY_SECONDS.inc(stats.busy_seconds, stage=stats.name)
+        return IngestResult(
+            manifest=self.manifest,
+            upserted=self.stats["upsert"].items_out,
+            deleted=len(self._pending_deletes),
+            stats=self.stats,
+        )
+
+    def _resume(self, checkpoint: IngestCheckpoint) -> None:
+        """Restores what an earlier run recorded in `checkpoint` before it stopped."""
+        for page in checkpoint.pages.values():
+            self.manifest.pages[page.source] = page.entry
+            self._pending_deletes.extend(page.deleted)
+            if self.lexical is not None:
+                self.lexical.add(page.upserted)
+            if self.local_vectors is not None and page.upserted:
+                self.local_vectors.add(page.upserted, page.vectors or [])
+        self._resumed_pages = len(checkpoint.pages)
+
+    def progress(self) -> dict[str, int]:
+        return {
+            "pages_fetched": self.stats["fetch"].items_out,
+            "pages_resumed": self._resumed_pages,
+            "chunks_split": self.stats["split"].items_out,
+            "chunks_embedded": self.stats["embed"].items_out,
+            "chunks_upserted": self.stats["upsert"].items_out,
+            "chunks_deleted": self._deleted,
+        }
+
+    def _notify_progress(self) -> None:
+        if self.on_progress is not None:
+            self.on_progress(self.progress())
+
+    async def _report_progress(self) -> None:
+        while True:
+            await asyncio.sleep(INGEST_PROGRESS_INTERVAL_SECONDS)
+            logger.info(f"Ingest into {self.index_name}: {'; '.join(map(str, self.stats.values()))}")
+
+    async def _timed(self, stage: str, work: Awaitable[Any]) -> Any:
+        start = time.perf_counter()
+        try:
+            return await work
+        finally:
+            self.stats[stage].busy_seconds += time.perf_counter() - start
+
+    async def _fetch(self, pages: asyncio.Queue) -> None:
+        stats = self.stats["fetch"]
+        start = time.perf_counter()
+        try:
+            async for document in self.crawler.iter_documents(self.sources):
+                stats.items_out += 1
+                stats.busy_seconds = time.perf_counter() - start
+                self._seen_sources.add(document.metadata["source"])
+                self._notify_progress()
+                await pages.put(document)
+            # Pages that could not be fetched may still exist, so they are kept rather than deleted.
+            unavailable = self.crawler.unavailable_sources()
+            if unavailable:
+                logger.warning(f"Keeping {len(unavailable)} pages that could not be fetched as they were.")
+            self._seen_sources.update(unavailable)
+            if self.snapshot is not None:
+                self.snapshot.mark_unavailable(unavailable)
+        finally:
+            await pages.put(None)
+
+    async def _split(self, pages: asyncio.Queue, chunks: asyncio.Queue) -> None:
+        stats = self.stats["split"]
+        loop = asyncio.get_running_loop()
+        in_flight: set[asyncio.Task] = set()
+        slots = asyncio.Semaphore(max(1, INGEST_WORKERS))
+
+        async def split_page(document: Document) -> None:
+            try:
+                page_chunks = await self._timed("split", loop.run_in_executor(self.executor, self.split, [document]))
+                if self.snapshot is not None:
+                    self.snapshot.write(document, page_chunks)
+                upsert, delete = self.manifest.update_page(document, page_chunks)
+                self._pending_deletes.extend(delete)
+                if self.checkpoint is not None:
+                    self._track(self.checkpoint, document.metadata["source"], upsert, delete)
+                for chunk in upsert:
+                    stats.items_out += 1
+                    await chunks.put(chunk)
+            finally:
+                slots.release()
+
+        try:
+            while (document := await pages.get()) is not None:
+                stats.items_in += 1
+                if self.incremental and not self.manifest.page_changed(document):
+                    if self.snapshot is not None:
+                        self.snapshot.write(document)
+                    continue
+                await slots.acquire()
+                reap(in_flight)
+                in_flight.add(asyncio.create_task(split_page(document)))
+            await asyncio.gather(*in_flight)
+        finally:
+            for task in in_flight:
+                task.cancel()
+            await chunks.put(None)
+
+    async def _embed(self, chunks: asyncio.Queue, batches: asyncio.Queue) -> None:
+        stats = self.stats["embed"]
+        in_flight: set[asyncio.Task] = set()
+        slots = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+        async def embed_batch(batch: list[Document]) -> None:
+            try:
+                vectors = await self._timed(
+                    "embed",
+                    asyncio.to_thread(self.embeddings.embed_documents, [chunk.page_content for chunk in batch]),
+                )
+                stats.items_out += len(batch)
+                self._notify_progress()
+                await batches.put((batch, vectors))
+            finally:
+                slots.release()
+
+        async def dispatch(batch: list[Document]) -> None:
+            await slots.acquire()
+            reap(in_flight)
+            in_flight.add(asyncio.create_task(embed_batch(batch)))
+
+        try:
+            batch: list[Document] = []
+            while (chunk := await chunks.get()) is not None:
+                stats.items_in += 1
+                batch.append(chunk)
+                if len(batch) >= EMBED_BATCH_SIZE:
+                    await dispatch(batch)
+                    batch = []
+            if batch:
+                await dispatch(batch)
+            await asyncio.gather(*in_flight)
+        finally:
+            for task in in_flight:
+                task.cancel()
+            await batches.put(None)
+
+    async def _upsert(self, batches: asyncio.Queue) -> None:
+        stats = self.stats["upsert"]
+        in_flight: set[asyncio.Task] = set()
+        slots = asyncio.Semaphore(UPSERT_CONCURRENCY)
+
+        async def upsert_batch(items: list[Item], documents: list[Document], vectors: list[list[float]]) -> None:
+            try:
+                response = await self._timed(
+                    "upsert", asyncio.to_thread(self.client.upsert_item_batch, self.index_name, items)
+                )
+                if isinstance(response, UpsertItemBatch.Error):
+                    raise response.inner_exception
+                stats.items_out += len(items)
+                if self.checkpoint is not None:
+                    self._checkpoint(self.checkpoint, documents, vectors)
+                self._notify_progress()
+            finally:
+                slots.release()
+
+        try:
+            while (batch := await batches.get()) is not None:
+                documents, vectors = batch
+                stats.items_in += len(documents)
+                if not self._index_ready:
+                    await self._create_index(len(vectors[0]))
+                if self.lexical is not None:
+                    self.lexical.add(documents)
+                if self.local_vectors is not None:
+                    self.local_vectors.add(documents, vectors)
+                items = [
+                    Item(
+                        id=chunk_id(document),
+                        vector=vector,
+                        metadata={**document.metadata, TEXT_FIELD: document.page_content},
+                    )
+                    for document, vector in zip(documents, vectors)
+                ]
+                for i in range(0, len(items), UPSERT_BATCH_SIZE):
+                    await slots.acquire()
+                    reap(in_flight)
+                    end = i + UPSERT_BATCH_SIZE
+                    in_flight.add(asyncio.create_task(upsert_batch(items[i:end], documents[i:end], vectors[i:end])))
+            await asyncio.gather(*in_flight)
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    def _track(self, checkpoint: IngestCheckpoint, source: str, upsert: list[Document], delete: list[str]) -> None:
+        """Starts waiting for the `upsert` chunks of a split page, to checkpoint it once they are in."""
+        page = UnfinishedPage(self.manifest.pages[source], delete, remaining=len(upsert))
+        if page.remaining:
+            self._unfinished[source] = page
+        else:
+            checkpoint.record(source, page.entry, [], [], delete)
+
+    def _checkpoint(self, checkpoint: IngestCheckpoint, documents: list[Document], vectors: list[list[float]]) -> None:
+        """Records the pages whose chunks are all upserted now that `documents` are."""
+        for document, vector in zip(documents, vectors):
+            source = document.metadata["source"]
+            page = self._unfinished.get(source)
+            if page is None:
+                continue
+            page.upserted.append(document)
+            page.vectors.append(vector)
+            page.remaining -= 1
+            if page.remaining == 0:
+                del self._unfinished[source]
+                checkpoint.record(source, page.entry, page.upserted, page.vectors, page.deleted)
+        checkpoint.commit()
+
+    async def _create_index(self, num_dimensions: int) -> None:
+        response = await asyncio.to_thread(
+            self.client.create_index, self.index_name, num_dimensions, SimilarityMetric.COSINE_SIMILARITY
+        )
+        if isinstance(response, CreateIndex.Error):
+            raise response.inner_exception
+        self._index_ready = True
+
+    async def _delete(self, ids: list[str]) -> None:
+        for i in range(0, len(ids), UPSERT_BATCH_SIZE):
+            batch = ids[i : i + UPSERT_BATCH_SIZE]
+            response = await asyncio.to_thread(self.client.delete_item_batch, self.index_name, batch)
+            if isinstance(response, DeleteItemBatch.Error):
+                raise response.inner_exception
+            self._deleted += len(batch)
@@ -0,0 +1,110 @@
+"""
+Formats the SOURCES section of answers, including while they stream.
+
+The LLM is asked to end its answers with a `SOURCES:` line, which it sometimes writes as
+`Source: [title](url)` and sometimes leaves empty. `rewrite_sources` normalizes a complete answer.
+`SourcesRewriter` applies the same rewrites to an answer as its tokens arrive, holding back only
+a marker that is not decided yet, eg `Sour` at the end of a token or `Source: [Momento` before
+its link, and releasing everything before it. `/stream` therefore starts with the LLM's first
+token instead of waiting for the whole answer.
+"""
+import re
+import time
+from typing import AsyncIterator, Iterator
+
+from langchain_core.runnables import RunnableGenerator
+
+from .metrics import STAGE_SECONDS
+
+TRAILING_SOURCES = re.compile(r"SOURCES:\s*$")
+SOURCE_LINK = re.compile(r"Source:(\s*-?\[.*?\]\(http)")
+SOURCES_HEADING = re.compile(r"SOURCES:(\s)")
+
+MARKERS = ("Source:", "SOURCES:")
+MARKER_START = re.compile(r"Source:|SOURCES:")
+# What may follow `Source:` while it can still turn out to start a SOURCE_LINK.
+UNDECIDED_SOURCE_LINK = re.compile(r"\s*(?:-|-?\[[^\n]*)?")
+
+
+def rewrite_sources(response: str) -> str:
+    """Formats the SOURCES section of a complete answer."""
+    return _rewrite_markers(TRAILING_SOURCES.sub("", response))
+
+
+def _rewrite_markers(text: str) -> str:
+    text = SOURCE_LINK.sub("SOURCES:\\1", text)
+    return SOURCES_HEADING.sub("\n\n*SOURCES*:\\1", text)
+
+
+def _undecided_from(text: str) -> int:
+    """Returns where the first marker whose rewrite depends on text yet to come starts, or
+    the length of `text` if there is none."""
+    position = 0
+    while (marker := MARKER_START.search(text, position)) is not None:
+        start, rest = marker.start(), text[marker.end() :]
+        if marker.group() == "SOURCES:":
+            # Either removed, if nothing but whitespace follows it, or made a heading.
+            if not rest.strip():
+                return start
+            position = marker.end()
+        elif (link := SOURCE_LINK.match(text, start)) is not None:
+            position = link.end()
+        elif UNDECIDED_SOURCE_LINK.fullmatch(rest):
+            return start
+        else:
+            position = marker.end()
+    # The text may end with the beginning of a marker.
+    for length in range(min(len(text), max(map(len, MARKERS)) - 1), 0, -1):
+        if any(marker.startswith(text[-length:]) for marker in MARKERS):
+            return len(text) - length
+    return len(text)
+
+
+class SourcesRewriter:
+    """Applies `rewrite_sources` to an answer as it streams in, with the same result."""
+
+    def __init__(self) -> None:
+        self.pending = ""
+
+    def feed(self, text: str) -> str:
+        """Adds the next `text` of the answer and returns the rewritten text that is now final."""
+        self.pending += text
+        end = _undecided_from(self.pending)
+        ready, self.pending = self.pending[:end], self.pending[end:]
+        return _rewrite_markers(ready) if ready else ""
+
+    def finish(self) -> str:
+        """Returns the rest of the rewritten answer, once it is complete."""
+        rest, self.pending = self.pending, ""
+        return rewrite_sources(rest)
+
+
+def _transform(chunks: Iterator[str]) -> Iterator[str]:
+    rewriter, seconds = SourcesRewriter(), 0.0
+    for chunk in chunks:
+        start = time.perf_counter()
+        output = rewriter.feed(chunk)
+        seconds += time.perf_counter() - start
+        if output:
+            yield output
+    # Always yields, so that a whole answer is returned even if it is empty.
+    yield rewriter.finish()
+    STAGE_SECONDS.observe(seconds, stage="postprocess")
+
+
+async def _atransform(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    rewriter, seconds = SourcesRewriter(), 0.0
+    async for chunk in chunks:
+        start = time.perf_counter()
+        output = rewriter.feed(chunk)
+        seconds += time.perf_counter() - start
+        if output:
+            yield output
+    yield rewriter.finish()
+    STAGE_SECONDS.observe(seconds, stage="postprocess")
+
+
+def sources_rewriter() -> RunnableGenerator:
+    """A runnable that formats the SOURCES section of a streamed answer, passing the rest of it
+    through as it arrives."""
+    return RunnableGenerator(_transform, _atransform)
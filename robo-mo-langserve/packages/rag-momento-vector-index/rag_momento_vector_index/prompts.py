@@ -1,6 +1,16 @@
-from langchain.prompts import PromptTemplate
+import os
 
-template = """Given the following extracted parts of a long document and a question, create a final answer with references ("SOURCES").
+from langchain.prompts import ChatPromptTemplate, PromptTemplate
+
+# "full" uses the few-shot QA_PROMPT, "compact" the much shorter COMPACT_QA_PROMPT.
+PROMPT_VARIANT = os.environ.get("PROMPT_VARIANT", "full")
+
+# The QA prompts are laid out so that everything that is the same for every question, the
+# instructions and examples, is a system message of its own, followed by the question and its
+# context. Every prompt of a variant then starts with the same bytes, which the provider's
+# prompt cache serves at a discount and with less latency. Nothing per request, not even a
+# date, may go into the system messages.
+instructions = """Given the following extracted parts of a long document and a question, create a final answer with references ("SOURCES").
 If you don't know the answer, just say that you don't know. Don't try to make up an answer.
 ALWAYS return a "SOURCES" part in your answer. "SOURCES" will include the URLs of the documents that you used to find the answer.
 The answer will be rendered in markdown, so use any markdown formatting as appropriate.
@@ -31,11 +41,47 @@ Content: More support for patients and families. \n\nTo get there, I call on Con
 Source: 34-pl
 =========
 FINAL ANSWER: The president did not mention Michael Jackson.
-SOURCES:
+SOURCES:"""
 
-QUESTION: {question}
+question_template = """QUESTION: {question}
 =========
 {context}
 =========
 FINAL ANSWER:"""
-QA_PROMPT = PromptTemplate(template=template, input_variables=["context", "question"])
+QA_PROMPT = ChatPromptTemplate.from_messages([("system", instructions), ("human", question_template)])
+
+# The instructions of QA_PROMPT without its few-shot examples, for a fraction of the input tokens.
+compact_instructions = """Answer the question using only the extracted parts of the documents below, with references ("SOURCES").
+If you don't know the answer, just say that you don't know. Don't try to make up an answer.
+End with a "SOURCES:" line listing the URLs of the documents you used.
+Use markdown. Code blocks must name their language, and links must have link text."""
+COMPACT_QA_PROMPT = ChatPromptTemplate.from_messages([("system", compact_instructions), ("human", question_template)])
+
+
+def get_qa_prompt(variant: str = PROMPT_VARIANT) -> ChatPromptTemplate:
+    if variant == "full":
+        return QA_PROMPT
+    if variant == "compact":
+        return COMPACT_QA_PROMPT
+    raise ValueError(f"Unknown PROMPT_VARIANT {variant!r}, expected full or compact.")
+
+
+condense_question_template = """Given the following conversation and a follow up question, rephrase the follow up question to be a standalone question, in its original language.
+
+Chat History:
+{history}
+Follow Up Input: {question}
+Standalone question:"""
+CONDENSE_QUESTION_PROMPT = PromptTemplate(template=condense_question_template, input_variables=["history", "question"])
+
+summary_template = """Progressively summarize the lines of conversation provided, adding onto the previous summary and returning a new summary.
+Keep the names, products and API calls discussed, as later questions may refer to them.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:"""
+SUMMARY_PROMPT = PromptTemplate(template=summary_template, input_variables=["summary", "new_lines"])
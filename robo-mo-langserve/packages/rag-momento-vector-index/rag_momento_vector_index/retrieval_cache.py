@@ -0,0 +1,140 @@
+"""
+A cache of retrieval results, consulted before embedding the question and searching.
+
+Questions repeat heavily, often differing only in case, spacing or punctuation. Results are
+keyed by the normalized question and the retrieval parameters, such as `k` and whether hybrid
+retrieval is on, and hold only the ids of the retrieved chunks. The chunks themselves are kept
+once in a shared store, however many results they appear in. Entries expire after
+`RETRIEVAL_CACHE_TTL_SECONDS`, the least recently used beyond `RETRIEVAL_CACHE_MAX_ENTRIES`
+are evicted, and the cache is cleared whenever the index version changes, ie after every reindex.
+"""
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from langchain.schema import Document
+
+from .hybrid import document_key
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_CACHE_ENABLED = os.environ.get("RETRIEVAL_CACHE", "true").lower() == "true"
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.environ.get("RETRIEVAL_CACHE_MAX_ENTRIES", "10000"))
+RETRIEVAL_CACHE_TTL_SECONDS = float(os.environ.get("RETRIEVAL_CACHE_TTL_SECONDS", str(60 * 60)))
+
+
+def normalize_query(question: str) -> str:
+    """Lowercases `question`, collapses its whitespace and drops leading and trailing punctuation."""
+    return re.sub(r"\s+", " ", question.lower()).strip(" ?!.,;:'\"")
+
+
+class RetrievalCache:
+    """An in-memory LRU cache of retrieved documents by normalized question and parameters.
+
+    Args:
+        index_version (Callable[[], str]): Returns the version of the index documents are
+            retrieved from. The cache is cleared whenever it changes.
+        max_entries (int): How many results are kept.
+        ttl_seconds (float): How long a result is served for.
+    """
+
+    def __init__(
+        self,
+        index_version: Callable[[], str],
+        max_entries: int = RETRIEVAL_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = RETRIEVAL_CACHE_TTL_SECONDS,
+    ):
+        self.index_version = index_version
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> (expiry, chunk ids in rank order)
+        self._entries: OrderedDict[Hashable, tuple[float, tuple[str, ...]]] = OrderedDict()
+        # chunk id -> (chunk, number of entries referring to it)
+        self._chunks: dict[str, tuple[Document, int]] = {}
+        self._chunk_bytes = 0
+        self._version = ""
+
+    @staticmethod
+    def key(question: str, **params: Any) -> Hashable:
+        return (normalize_query(question), tuple(sorted(params.items())))
+
+    def _check_version(self) -> None:
+        version = self.index_version()
+        if version != self._version:
+            if self._version:
+                logger.info(f"Index changed to {version}, clearing the retrieval cache.")
+            self.clear()
+            self._version = version
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._chunks.clear()
+            self._chunk_bytes = 0
+
+    def get(self, question: str, **params: Any) -> Optional[list[Document]]:
+        """Returns the documents retrieved for `question` with `params`, if they are cached."""
+        self._check_version()
+        key = self.key(question, **params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self._evict(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            chunks = [self._chunks[id_][0] for id_ in entry[1]]
+        # Copies, so that callers cannot change what is cached.
+        return [Document(page_content=chunk.page_content, metadata=dict(chunk.metadata)) for chunk in chunks]
+
+    def put(self, question: str, documents: list[Document], **params: Any) -> None:
+        self._check_version()
+        key = self.key(question, **params)
+        ids = tuple(document_key(document) for document in documents)
+        with self._lock:
+            if key in self._entries:
+                self._evict(key)
+            for id_, document in zip(ids, documents):
+                chunk, references = self._chunks.get(id_) or (None, 0)
+                if chunk is None:
+                    chunk = Document(page_content=document.page_content, metadata=dict(document.metadata))
+                    self._chunk_bytes += _size(chunk)
+                self._chunks[id_] = (chunk, references + 1)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, ids)
+            while len(self._entries) > self.max_entries:
+                self._evict(next(iter(self._entries)))
+
+    def _evict(self, key: Hashable) -> None:
+        _, ids = self._entries.pop(key)
+        for id_ in ids:
+            chunk, references = self._chunks[id_]
+            if references > 1:
+                self._chunks[id_] = (chunk, references - 1)
+            else:
+                del self._chunks[id_]
+                self._chunk_bytes -= _size(chunk)
+
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def footprint(self) -> dict[str, float]:
+        """The number of cached results and chunks, and the approximate bytes of chunk text and
+        metadata they hold."""
+        with self._lock:
+            return {"entries": len(self._entries), "chunks": len(self._chunks), "chunk_bytes": self._chunk_bytes}
+
+
+def _size(document: Document) -> int:
+    return sys.getsizeof(document.page_content) + len(json.dumps(document.metadata, default=str))
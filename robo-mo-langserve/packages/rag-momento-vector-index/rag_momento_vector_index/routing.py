@@ -0,0 +1,211 @@
+"""
+Routes each question to a model tier, and hands answers to a fallback model when the tier's
+model is slow or failing.
+
+Most questions look up a fact that the retrieved context states almost verbatim, and a cheap
+model with the compact prompt answers them as well as the standard one. With
+`MODEL_ROUTING=true`, each question is routed from signals that cost nothing next to the
+completion, once its context has been retrieved:
+
+- What kind of question it is: code, comparison, troubleshooting or a plain lookup, from its
+  wording.
+- How well the context supports it: the share of the question's terms that occur in the
+  context. The retrieval cache shares documents between questions without their search scores,
+  so this stands in for them.
+- How long the context is, in tokens.
+
+Short lookups that the context supports go to the `fast` tier, code, comparison and
+troubleshooting questions and long contexts to the `strong` tier if there is one, and the rest
+to the `standard` tier. Without routing, everything goes to `standard`.
+
+With `LLM_FALLBACK_MODEL` set, a tier whose model fails or streams no token within
+`LLM_FIRST_TOKEN_TIMEOUT_SECONDS` answers with the fallback model instead. Once the first token
+has been streamed, the answer is not retried.
+"""
+import asyncio
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable
+
+from langchain.schema import StrOutputParser
+from langchain_core.language_models import BaseChatModel
+from langchain_core.prompt_values import PromptValue
+from langchain_core.prompts import BasePromptTemplate
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableGenerator, RunnableLambda
+
+from .context import encoding
+from .lexical import tokenize
+from .metrics import LLM_FALLBACKS, ROUTED_QUESTIONS, timed
+from .postprocess import sources_rewriter
+from .prompts import PROMPT_VARIANT, get_qa_prompt
+
+logger = logging.getLogger(__name__)
+
+MODEL_ROUTING = os.environ.get("MODEL_ROUTING", "false").lower() == "true"
+ROUTING_FAST_MODEL = os.environ.get("ROUTING_FAST_MODEL", "gpt-3.5-turbo")
+ROUTING_STANDARD_MODEL = os.environ.get("ROUTING_STANDARD_MODEL", "gpt-3.5-turbo")
+# Without a strong model, the questions it would get go to the standard tier.
+ROUTING_STRONG_MODEL = os.environ.get("ROUTING_STRONG_MODEL", "")
+# Questions with less of their terms in the context than this never go to the fast tier.
+ROUTING_MIN_SUPPORT = float(os.environ.get("ROUTING_MIN_SUPPORT", "0.6"))
+ROUTING_FAST_MAX_CONTEXT_TOKENS = int(os.environ.get("ROUTING_FAST_MAX_CONTEXT_TOKENS", "600"))
+ROUTING_LONG_CONTEXT_TOKENS = int(os.environ.get("ROUTING_LONG_CONTEXT_TOKENS", "800"))
+LLM_FALLBACK_MODEL = os.environ.get("LLM_FALLBACK_MODEL", "")
+LLM_FIRST_TOKEN_TIMEOUT_SECONDS = float(os.environ.get("LLM_FIRST_TOKEN_TIMEOUT_SECONDS", "10"))
+# The timeout of each OpenAI request. 0 leaves the client's default.
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", "0"))
+
+FAST = "fast"
+STANDARD = "standard"
+STRONG = "strong"
+
+# Checked in order; a question matching none of them is a lookup.
+QUESTION_KINDS = [
+    ("troubleshooting", re.compile(r"\b(errors?|exceptions?|fail\w*|broken|debug\w*|not working)\b", re.IGNORECASE)),
+    ("comparison", re.compile(r"\b(vs\.?|versus|compare\w*|difference\w*|instead of)\b", re.IGNORECASE)),
+    ("code", re.compile(r"`|\w\(|\b(code|snippets?|examples?|implement\w*|functions?)\b", re.IGNORECASE)),
+]
+STOPWORDS = frozenset(
+    "a an and are can do does for from how i in is it my of on or the to what when where which who why with you".split()
+)
+
+
+def question_kind(question: str) -> str:
+    for kind, pattern in QUESTION_KINDS:
+        if pattern.search(question):
+            return kind
+    return "lookup"
+
+
+def term_support(question: str, context: str) -> float:
+    """The share of the question's terms, other than stopwords, that occur in `context`."""
+    terms = set(tokenize(question)) - STOPWORDS
+    if not terms:
+        return 1.0
+    return len(terms & set(tokenize(context))) / len(terms)
+
+
+def route(question: str, context: str) -> tuple[str, str]:
+    """Returns the tier to answer `question` from `context` with, and why."""
+    if term_support(question, context) < ROUTING_MIN_SUPPORT:
+        return STANDARD, "weak_support"
+    if (kind := question_kind(question)) != "lookup":
+        return STRONG, kind
+    context_tokens = len(encoding().encode(context, disallowed_special=()))
+    if context_tokens > ROUTING_LONG_CONTEXT_TOKENS:
+        return STRONG, "long_context"
+    if context_tokens <= ROUTING_FAST_MAX_CONTEXT_TOKENS:
+        return FAST, "lookup"
+    return STANDARD, "lookup"
+
+
+def with_fallback(
+    primary: Runnable[PromptValue, str],
+    secondary: Runnable[PromptValue, str],
+    tier: str,
+    first_token_timeout_seconds: float = LLM_FIRST_TOKEN_TIMEOUT_SECONDS,
+) -> Runnable[PromptValue, str]:
+    """Streams `primary`, or `secondary` if `primary` fails or streams nothing within
+    `first_token_timeout_seconds`. Sync calls only fall back on errors."""
+    timeout = first_token_timeout_seconds or None
+
+    def answer(_prompt: PromptValue) -> Runnable:
+        return primary.with_fallbacks([secondary])
+
+    async def aanswer(prompt: PromptValue, config: RunnableConfig) -> Runnable:
+        async def stream(_input: AsyncIterator[Any]) -> AsyncIterator[str]:
+            chunks = primary.astream(prompt, config)
+            try:
+                first = await asyncio.wait_for(chunks.__anext__(), timeout)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                logger.warning(f"The {tier} model streamed nothing within {timeout}s, falling back.")
+                reason = "timeout"
+            except Exception:
+                logger.warning(f"The {tier} model failed, falling back.", exc_info=True)
+                reason = "error"
+            else:
+                yield first
+                async for chunk in chunks:
+                    yield chunk
+                return
+            await chunks.aclose()
+            LLM_FALLBACKS.inc(tier=tier, reason=reason)
+            async for chunk in secondary.astream(prompt, config):
+                yield chunk
+
+        return RunnableGenerator(stream)
+
+    return RunnableLambda(answer, afunc=aanswer)
+
+
+@dataclass
+class ModelTier:
+    """A prompt and the model answering it.
+
+    Args:
+        name (str): The tier, fast, standard or strong.
+        model (str): The name of the model.
+        prompt (BasePromptTemplate): Builds the prompt from the `context` and `question`.
+        llm (Runnable[PromptValue, str]): Generates the final answer from the prompt.
+    """
+
+    name: str
+    model: str
+    prompt: BasePromptTemplate
+    llm: Runnable[PromptValue, str]
+    chain: Runnable[dict, str] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.chain = RunnableLambda(self.build_prompt, afunc=self.abuild_prompt) | self.llm
+
+    @timed("prompt")
+    def build_prompt(self, inputs: dict) -> PromptValue:
+        return self.prompt.invoke(inputs)
+
+    async def abuild_prompt(self, inputs: dict) -> PromptValue:
+        # Cheap enough to run on the event loop rather than the thread pool.
+        return self.build_prompt(inputs)
+
+
+def build_tiers(chat_model: Callable[[str, str], BaseChatModel]) -> dict[str, ModelTier]:
+    """Builds the tiers in use, with the models `chat_model` creates given a tier and a model name."""
+    tiers = {}
+    for name, model, variant in [
+        (STANDARD, ROUTING_STANDARD_MODEL, PROMPT_VARIANT),
+        (FAST, ROUTING_FAST_MODEL, "compact"),
+        (STRONG, ROUTING_STRONG_MODEL, PROMPT_VARIANT),
+    ]:
+        if not model or (name != STANDARD and not MODEL_ROUTING):
+            continue
+        llm: Runnable[PromptValue, str] = chat_model(name, model) | StrOutputParser()
+        if LLM_FALLBACK_MODEL and LLM_FALLBACK_MODEL != model:
+            llm = with_fallback(llm, chat_model(name, LLM_FALLBACK_MODEL) | StrOutputParser(), name)
+        # The SOURCES section is formatted as the answer streams, so /stream starts with the first token.
+        tiers[name] = ModelTier(name, model, get_qa_prompt(variant), llm | sources_rewriter())
+    return tiers
+
+
+class ModelRouter:
+    """Picks the tier to answer each question with.
+
+    Args:
+        tiers (dict[str, ModelTier]): The tiers by name. There must be a standard tier, which
+            answers whatever would go to a missing one.
+    """
+
+    def __init__(self, tiers: dict[str, ModelTier]):
+        self.tiers = tiers
+
+    def choose(self, question: str, context: str) -> ModelTier:
+        name, reason = route(question, context) if len(self.tiers) > 1 else (STANDARD, "single_tier")
+        tier = self.tiers.get(name, self.tiers[STANDARD])
+        ROUTED_QUESTIONS.inc(tier=tier.name, reason=reason)
+        return tier
+
+    def select(self, inputs: dict) -> Runnable[dict, str]:
+        """The chain of the tier for `inputs`, a `question` and its `context`, to run on them."""
+        return self.choose(inputs["question"], inputs["context"]).chain
@@ -0,0 +1,129 @@
+"""
+Coalesces concurrent requests for the same question into one run of the chain.
+
+After an announcement, many users ask the same question within seconds, before the first answer
+is in the answer cache. Instead of running retrieval and the LLM for each of them, the first
+request for a normalized question starts a flight and later ones join it while it is in the
+air, each receiving the whole answer: the chunks streamed so far, then the rest as they arrive.
+The flight runs in a task of its own, so it survives the request that started it disconnecting
+as long as anyone is still listening, and is cancelled once no one is.
+"""
+import asyncio
+import logging
+import os
+from typing import Any, AsyncIterator, Callable, Hashable, Optional
+
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableGenerator, RunnableLambda
+
+from .metrics import COALESCED_REQUESTS
+from .retrieval_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+REQUEST_COALESCING_ENABLED = os.environ.get("REQUEST_COALESCING", "true").lower() == "true"
+
+
+class Flight:
+    """One run of the chain, whose output chunks are kept for everyone following it."""
+
+    def __init__(self, key: Hashable, produce: Callable[[], AsyncIterator[str]], on_done: Callable[["Flight"], None]):
+        self.key = key
+        self.chunks: list[str] = []
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.followers = 0
+        self._changed = asyncio.Event()
+        self._on_done = on_done
+        self._task = asyncio.create_task(self._run(produce))
+
+    async def _run(self, produce: Callable[[], AsyncIterator[str]]) -> None:
+        try:
+            async for chunk in produce():
+                self.chunks.append(chunk)
+                self._notify()
+        except BaseException as e:
+            self.error = e
+            if not isinstance(e, asyncio.CancelledError):
+                logger.warning(f"Coalesced answer to {self.key!r} failed: {e}")
+        finally:
+            self.done = True
+            self._on_done(self)
+            self._notify()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def follow(self) -> AsyncIterator[str]:
+        """Yields every chunk of the answer, from the first, and raises what the run raised."""
+        self.followers += 1
+        try:
+            position = 0
+            while True:
+                changed = self._changed
+                if position < len(self.chunks):
+                    chunks = self.chunks[position:]
+                    position += len(chunks)
+                    for chunk in chunks:
+                        yield chunk
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    await changed.wait()
+        finally:
+            self.followers -= 1
+            if self.followers == 0 and not self.done:
+                # Landed right away rather than once the task unwinds, so no one joins it meanwhile.
+                self._on_done(self)
+                self._task.cancel()
+
+
+class SingleFlight:
+    """Runs at most one answer per normalized question at a time, shared by all who ask it."""
+
+    def __init__(self) -> None:
+        self._flights: dict[Hashable, Flight] = {}
+
+    @staticmethod
+    def key(question: str) -> Hashable:
+        return normalize_query(question)
+
+    def join(self, question: str, produce: Callable[[], AsyncIterator[str]]) -> Flight:
+        """Returns the flight answering `question`, starting one with `produce` if there is none."""
+        key = self.key(question)
+        flight = self._flights.get(key)
+        if flight is None or flight.done:
+            flight = Flight(key, produce, self._land)
+            self._flights[key] = flight
+            COALESCED_REQUESTS.inc(role="leader")
+        else:
+            COALESCED_REQUESTS.inc(role="follower")
+        return flight
+
+    def _land(self, flight: Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+
+def with_single_flight(chain: Runnable, flights: SingleFlight) -> Runnable:
+    """Wraps `chain`, which takes a question and streams the final answer, so that concurrent
+    async calls with the same question share one run of it. Sync calls are not coalesced."""
+
+    def answer(_question: str) -> Runnable:
+        return chain
+
+    async def aanswer(question: str, config: RunnableConfig) -> Runnable:
+        flight = flights.join(question, lambda: chain.astream(question, config))
+
+        async def follow(_input: AsyncIterator[Any]) -> AsyncIterator[str]:
+            async for chunk in flight.follow():
+                yield chunk
+
+        return RunnableGenerator(follow)
+
+    return RunnableLambda(answer, afunc=aanswer)
@@ -0,0 +1,268 @@
+"""
+Versioned snapshots of the crawled corpus, to reindex from without crawling.
+
+A snapshot is a gzipped JSONL file, `corpus-<UTC timestamp>.jsonl.gz` in `CORPUS_SNAPSHOT_DIR`.
+Its first line is a header with the format version, when it was taken, the sitemaps crawled and
+the chunk size and overlap pages were split with. Every other line is a parsed page with its
+metadata and the `start_index` of each of its chunks. A chunk's text is only stored when it is
+not simply the slice of the page at its `start_index`, which, for the token splitter, it almost
+always is. Since version 2, the last line lists the pages the crawl could not fetch but that may
+still exist, which reindexing from the snapshot keeps as they were rather than deleting them.
+Files are written and read a page at a time, so neither side holds the corpus in memory.
+
+With `CORPUS_SNAPSHOT_RECORD=true`, reindexing writes a snapshot of what it crawled. With
+`CORPUS_SNAPSHOT` set to the path of a snapshot, or `latest`, reindexing reads the pages from it
+instead of crawling, and reuses its chunks unless the chunk size or overlap changed since.
+
+Snapshots can also be taken and inspected without indexing:
+
+    python -m rag_momento_vector_index.snapshot write
+    python -m rag_momento_vector_index.snapshot info [<path>]
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+from langchain.docstore.document import Document
+
+logger = logging.getLogger(__name__)
+
+CORPUS_SNAPSHOT_DIR = os.environ.get("CORPUS_SNAPSHOT_DIR", "snapshots")
+CORPUS_SNAPSHOT = os.environ.get("CORPUS_SNAPSHOT", "")
+CORPUS_SNAPSHOT_RECORD = os.environ.get("CORPUS_SNAPSHOT_RECORD", "false").lower() == "true"
+SNAPSHOT_FORMAT_VERSION = 2
+READABLE_FORMAT_VERSIONS = (1, 2)
+SNAPSHOT_PREFIX = "corpus-"
+SNAPSHOT_SUFFIX = ".jsonl.gz"
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def new_snapshot_path(snapshot_dir: str = CORPUS_SNAPSHOT_DIR) -> str:
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    return os.path.join(snapshot_dir, f"{SNAPSHOT_PREFIX}{timestamp}{SNAPSHOT_SUFFIX}")
+
+
+def latest_snapshot_path(snapshot_dir: str = CORPUS_SNAPSHOT_DIR) -> Optional[str]:
+    if not os.path.isdir(snapshot_dir):
+        return None
+    names = sorted(
+        name for name in os.listdir(snapshot_dir) if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX)
+    )
+    return os.path.join(snapshot_dir, names[-1]) if names else None
+
+
+def resolve_snapshot_path(snapshot: str, snapshot_dir: str = CORPUS_SNAPSHOT_DIR) -> str:
+    """Returns the path of `snapshot`, which is a path or `latest` for the newest one in `snapshot_dir`.
+
+    Raises:
+        SnapshotError: If there is no such snapshot.
+    """
+    path = latest_snapshot_path(snapshot_dir) if snapshot == "latest" else snapshot
+    if path is None or not os.path.exists(path):
+        raise SnapshotError(f"No corpus snapshot {snapshot!r} in {snapshot_dir}.")
+    return path
+
+
+def split_params(chunk_size: int, chunk_overlap: int) -> dict[str, int]:
+    return {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+
+
+class SnapshotWriter:
+    """Writes a corpus snapshot a page at a time. Used as a context manager, the snapshot only
+    appears at `path` once the block completes without an error.
+
+    Args:
+        path (str): Where to write the snapshot.
+        split (Optional[dict[str, int]]): The chunk size and overlap chunks were split with, or
+            None if only pages are written.
+        sources (Optional[list[str]]): The sitemaps that were crawled.
+    """
+
+    def __init__(self, path: str, split: Optional[dict[str, int]] = None, sources: Optional[list[str]] = None):
+        self.path = path
+        self.pages = 0
+        self.chunks = 0
+        self.unavailable: list[str] = []
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._tmp_path = f"{path}.tmp"
+        self._file = gzip.open(self._tmp_path, "wt", encoding="utf-8")
+        header = {
+            "version": SNAPSHOT_FORMAT_VERSION,
+            "created": datetime.now(timezone.utc).isoformat(),
+            "sources": sources or [],
+            "split": split,
+        }
+        self._file.write(json.dumps(header) + "\n")
+
+    def __enter__(self) -> "SnapshotWriter":
+        return self
+
+    def __exit__(self, exc_type: Any, *_: Any) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, page: Document, chunks: Optional[list[Document]] = None) -> None:
+        """Adds `page` and, if they are known, its `chunks`."""
+        record: dict[str, Any] = {"text": page.page_content, "metadata": page.metadata}
+        if chunks is not None:
+            record["chunks"] = [_encode_chunk(page, chunk) for chunk in chunks]
+            self.chunks += len(chunks)
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.pages += 1
+
+    def mark_unavailable(self, sources: list[str]) -> None:
+        """Records the sources of pages that could not be fetched, to be kept when replaying."""
+        self.unavailable.extend(sources)
+
+    def close(self) -> None:
+        self._file.write(json.dumps({"unavailable": self.unavailable}, ensure_ascii=False) + "\n")
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+        logger.info(f"Wrote corpus snapshot of {self.pages} pages and {self.chunks} chunks to {self.path}.")
+
+    def discard(self) -> None:
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+def _encode_chunk(page: Document, chunk: Document) -> list[Any]:
+    start = chunk.metadata["start_index"]
+    text = chunk.page_content
+    return [start, len(text)] if page.page_content[start : start + len(text)] == text else [start, text]
+
+
+def _decode_chunk(page: Document, encoded: list[Any]) -> Document:
+    start, text = encoded
+    if isinstance(text, int):
+        text = page.page_content[start : start + text]
+    return Document(page_content=text, metadata={**page.metadata, "start_index": start})
+
+
+class CorpusSnapshot:
+    """Reads a corpus snapshot a page at a time.
+
+    It can stand in for the crawler of an `IngestPipeline`, with `splitter` as its split function
+    if its chunks are reused.
+
+    Raises:
+        SnapshotError: If the file is not a snapshot of a supported version.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                self.header = json.loads(f.readline())
+        except (OSError, ValueError) as e:
+            raise SnapshotError(f"Unreadable corpus snapshot {path}: {e}") from e
+        if self.header.get("version") not in READABLE_FORMAT_VERSIONS:
+            raise SnapshotError(f"Corpus snapshot {path} has unsupported version {self.header.get('version')}.")
+        # Chunks of the pages yielded by `iter_documents` and not split yet, by source.
+        self._chunks: dict[str, list[Any]] = {}
+        self._unavailable: list[str] = []
+
+    @property
+    def split(self) -> Optional[dict[str, int]]:
+        return self.header.get("split")
+
+    def _records(self) -> Iterator[tuple[Document, Optional[list[Any]]]]:
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            f.readline()
+            for line in f:
+                record = json.loads(line)
+                if "unavailable" in record:
+                    self._unavailable = record["unavailable"]
+                    continue
+                yield Document(page_content=record["text"], metadata=record["metadata"]), record.get("chunks")
+
+    def pages(self) -> Iterator[tuple[Document, Optional[list[Document]]]]:
+        """Yields each page with its chunks, or None if they were not recorded."""
+        for page, encoded in self._records():
+            yield page, [_decode_chunk(page, chunk) for chunk in encoded] if encoded is not None else None
+
+    def documents(self) -> list[Document]:
+        return [page for page, _ in self.pages()]
+
+    async def iter_documents(self, _sources: Any = None) -> AsyncIterator[Document]:
+        """Yields the pages, like `SitemapCrawler.iter_documents`, whatever sources are asked for."""
+        for page, encoded in self._records():
+            if encoded is not None:
+                # Only offsets, so holding those of pages that are never split costs little.
+                self._chunks[page.metadata["source"]] = encoded
+            yield page
+
+    def unavailable_sources(self) -> list[str]:
+        """The sources of the pages the recorded crawl could not fetch, like
+        `SitemapCrawler.unavailable_sources`, once `iter_documents` has read them all."""
+        return list(self._unavailable)
+
+    def reuses_chunks(self, chunk_size: int, chunk_overlap: int) -> bool:
+        """Whether the recorded chunks were split with `chunk_size` and `chunk_overlap`."""
+        return self.split == split_params(chunk_size, chunk_overlap)
+
+    def splitter(self, split: Callable[[list[Document]], list[Document]]) -> Callable[[list[Document]], list[Document]]:
+        """Returns a split function for the pages yielded by `iter_documents` that returns their
+        recorded chunks, and calls `split` for pages without any."""
+
+        def split_pages(pages: list[Document]) -> list[Document]:
+            chunks = []
+            for page in pages:
+                encoded = self._chunks.pop(page.metadata["source"], None)
+                if encoded is not None:
+                    chunks.extend(_decode_chunk(page, chunk) for chunk in encoded)
+                else:
+                    chunks.extend(split([page]))
+            return chunks
+
+        return split_pages
+
+    def stats(self) -> dict[str, Any]:
+        pages = chunks = characters = 0
+        for page, page_chunks in self.pages():
+            pages += 1
+            chunks += len(page_chunks or [])
+            characters += len(page.page_content)
+        size = os.path.getsize(self.path)
+        return {
+            **self.header,
+            "pages": pages,
+            "chunks": chunks,
+            "characters": characters,
+            "unavailable_pages": len(self._unavailable),
+            "bytes": size,
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Takes or inspects snapshots of the crawled corpus.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    write = commands.add_parser("write", help="Crawl and split the docs and blogs into a new snapshot.")
+    write.add_argument("--snapshot-dir", default=CORPUS_SNAPSHOT_DIR)
+    info = commands.add_parser("info", help="Describe a snapshot.")
+    info.add_argument("path", nargs="?", default="latest", help="A snapshot path, or latest.")
+    info.add_argument("--snapshot-dir", default=CORPUS_SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    if args.command == "write":
+        # Imported here since the crawler and splitter are only needed to take a snapshot.
+        from .index import load_content
+
+        load_content(snapshot_path=new_snapshot_path(args.snapshot_dir))
+    else:
+        print(json.dumps(CorpusSnapshot(resolve_snapshot_path(args.path, args.snapshot_dir)).stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+Runs reindexing outside the serving process.
+
+Crawling, parsing and embedding would otherwise compete with request handling for the event
+loop and the GIL. `ReindexWorker` hands reindex jobs to a dedicated process that runs them one
+at a time, and the servers pick up the new index generation through the index alias. What the
+process records in `metrics.REGISTRY` is merged into the server's registry after each job.
+
+Each job has an id, a status and the progress of its ingest, which the worker process reports
+back over a queue. There is at most one queued or running job per index: submitting another
+returns the one already there. A job is cancelled before it starts, or stopped at the next
+progress report if it is running, and with reindex checkpoints the next job of the same kind
+resumes where it stopped.
+
+Reindexing can also be run as a standalone job, e.g. from cron or a job queue:
+
+    python -m rag_momento_vector_index.worker <index_name> [--full] [--snapshot <path>|latest]
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from .metrics import REGISTRY, REINDEX_RUNS
+
+logger = logging.getLogger(__name__)
+
+# Finished jobs whose status is kept.
+REINDEX_JOB_HISTORY = int(os.environ.get("REINDEX_JOB_HISTORY", "100"))
+REINDEX_PROGRESS_INTERVAL_SECONDS = float(os.environ.get("REINDEX_PROGRESS_INTERVAL_SECONDS", "1.0"))
+# Numbers of the most recently cancelled jobs, shared with the worker process.
+CANCELLED_JOB_SLOTS = 64
+
+ProgressCallback = Callable[[dict[str, int]], None]
+
+
+class ReindexCancelled(Exception):
+    pass
+
+
+def run_reindex(
+    index_name: str,
+    momento_env_var_name: str,
+    incremental: bool,
+    snapshot: Optional[str] = None,
+    on_progress: Optional[ProgressCallback] = None,
+) -> dict[str, Any]:
+    """Reindexes `index_name`, from the corpus snapshot `snapshot` if given, and returns the
+    metrics recorded while doing so."""
+    # Imported here so that only the worker process loads the crawler and ingest pipeline.
+    from .index import reindex_content
+
+    reindex_content(
+        index_name, momento_env_var_name, incremental=incremental, snapshot=snapshot, on_progress=on_progress
+    )
+    return REGISTRY.drain()
+
+
+# Set in the worker process by `_init_worker_process`.
+_events: Any = None
+_cancelled: Any = None
+
+
+def _init_worker_process(events: Any, cancelled: Any) -> None:
+    global _events, _cancelled
+    _events, _cancelled = events, cancelled
+
+
+def _run_job(target: Callable[..., Optional[dict]], number: int, index_name: str, *args: Any) -> Optional[dict]:
+    """Runs `target` in the worker process, reporting its progress as job `number` and stopping
+    it once the job is cancelled."""
+
+    def check_cancelled() -> None:
+        if number in _cancelled[:]:
+            raise ReindexCancelled(f"Reindexing {index_name} was cancelled.")
+
+    last_report = 0.0
+    latest: dict[str, int] = {}
+
+    def on_progress(progress: dict[str, int]) -> None:
+        nonlocal last_report, latest
+        check_cancelled()
+        latest = progress
+        if time.monotonic() - last_report >= REINDEX_PROGRESS_INTERVAL_SECONDS:
+            last_report = time.monotonic()
+            _events.put((number, "progress", progress))
+
+    check_cancelled()
+    _events.put((number, "started", None))
+    try:
+        return target(index_name, *args, on_progress=on_progress)
+    finally:
+        _events.put((number, "progress", latest))
+
+
+@dataclass
+class ReindexJob:
+    """A reindex submitted to a `ReindexWorker`.
+
+    `status` is one of queued, running, cancelling, succeeded, failed or cancelled, and
+    `progress` the latest progress of its ingest, eg the pages fetched and chunks upserted.
+    """
+
+    id: str
+    number: int
+    index_name: str
+    incremental: bool
+    status: str = "queued"
+    progress: dict[str, int] = field(default_factory=dict)
+    error: Optional[str] = None
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    future: Optional[Future] = field(default=None, repr=False)
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "index_name": self.index_name,
+            "incremental": self.incremental,
+            "status": self.status,
+            "progress": self.progress,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class ReindexWorker:
+    """Runs reindex jobs one at a time in a separate, long lived process, and tracks them.
+
+    The process is spawned rather than forked from the server, which runs an event loop and
+    client threads, and is replaced if it dies.
+
+    Args:
+        target (Callable[..., Optional[dict]]): Runs a reindex given the index name, the API key
+            environment variable name, whether to reindex incrementally and an `on_progress`
+            keyword argument to report progress to, and returns the drained metrics registry of
+            the worker process, if any. It must be picklable.
+    """
+
+    def __init__(self, target: Callable[..., Optional[dict]] = run_reindex) -> None:
+        self.target = target
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._context = multiprocessing.get_context("spawn")
+        self._events: Any = self._context.Queue()
+        self._cancelled: Any = self._context.Array("q", CANCELLED_JOB_SLOTS)
+        self._cancellations = 0
+        self._listener: Optional[threading.Thread] = None
+        self._jobs: dict[str, ReindexJob] = {}
+        self._jobs_by_number: dict[int, ReindexJob] = {}
+        self._active: dict[str, ReindexJob] = {}
+        self._submitted = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=self._context,
+                    initializer=_init_worker_process,
+                    initargs=(self._events, self._cancelled),
+                )
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name="reindex-events", daemon=True)
+                self._listener.start()
+            return self._executor
+
+    def _discard_executor(self, executor: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _listen(self) -> None:
+        while (event := self._events.get()) is not None:
+            number, kind, payload = event
+            with self._lock:
+                job = self._jobs_by_number.get(number)
+                if job is None:
+                    continue
+                if kind == "started" and job.status == "queued":
+                    job.status = "running"
+                    job.started_at = time.time()
+                elif kind == "progress" and payload:
+                    job.progress = payload
+
+    def submit(
+        self, index_name: str, incremental: bool = True, momento_env_var_name: str = "MOMENTO_API_KEY"
+    ) -> tuple[ReindexJob, bool]:
+        """Queues a reindex of `index_name` unless one is already queued or running.
+
+        Returns:
+            tuple[ReindexJob, bool]: The job reindexing `index_name`, and whether it was just
+                submitted rather than already there.
+        """
+        with self._lock:
+            if (active := self._active.get(index_name)) is not None:
+                return active, False
+            self._submitted += 1
+            job = ReindexJob(uuid.uuid4().hex, self._submitted, index_name, incremental)
+            self._jobs[job.id] = job
+            self._jobs_by_number[job.number] = job
+            self._active[index_name] = job
+            self._forget_old_jobs()
+
+        args = (self.target, job.number, index_name, momento_env_var_name, incremental)
+        executor = self._get_executor()
+        try:
+            job.future = executor.submit(_run_job, *args)
+        except BrokenProcessPool:
+            self._discard_executor(executor)
+            executor = self._get_executor()
+            job.future = executor.submit(_run_job, *args)
+
+        def finish(future: Future) -> None:
+            if future.cancelled() or isinstance(future.exception(), ReindexCancelled):
+                logger.info(f"Reindexing {index_name} was cancelled.")
+                REINDEX_RUNS.inc(outcome="cancelled")
+                status = "cancelled"
+            elif (error := future.exception()) is not None:
+                logger.error(f"Reindexing {index_name} failed.", exc_info=error)
+                REINDEX_RUNS.inc(outcome="failed")
+                status = "failed"
+                job.error = str(error) or type(error).__name__
+                if isinstance(error, BrokenProcessPool):
+                    self._discard_executor(executor)
+            else:
+                REINDEX_RUNS.inc(outcome="succeeded")
+                status = "succeeded"
+                if (metrics := future.result()) is not None:
+                    REGISTRY.merge(metrics)
+            with self._lock:
+                job.status = status
+                job.finished_at = time.time()
+                if self._active.get(index_name) is job:
+                    del self._active[index_name]
+
+        job.future.add_done_callback(finish)
+        return job, True
+
+    def _forget_old_jobs(self) -> None:
+        finished = [job for job in self._jobs.values() if job.done]
+        for job in finished[: max(0, len(finished) - REINDEX_JOB_HISTORY)]:
+            del self._jobs[job.id]
+            del self._jobs_by_number[job.number]
+
+    def get(self, job_id: str) -> Optional[ReindexJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self) -> list[ReindexJob]:
+        """The queued and running jobs and the most recent finished ones, newest first."""
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.number, reverse=True)
+
+    def cancel(self, job_id: str) -> Optional[ReindexJob]:
+        """Cancels the job `job_id` if it has not finished, and returns it, or None if there is no such job."""
+        job = self.get(job_id)
+        if job is None or job.done or job.future is None:
+            return job
+        if not job.future.cancel():
+            # Running, or already handed to the worker process, which checks for cancelled jobs
+            # before starting one and whenever it reports progress.
+            with self._lock:
+                self._cancelled[self._cancellations % CANCELLED_JOB_SLOTS] = job.number
+                self._cancellations += 1
+                if not job.done:
+                    job.status = "cancelling"
+        return job
+
+    def recycle(self) -> None:
+        """Runs later jobs in a new process, eg so that they see changed environment variables.
+        Jobs that were already submitted still run in the current process."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+            listener, self._listener = self._listener, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if listener is not None:
+            self._events.put(None)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Reindexes the Momento docs and blogs.")
+    parser.add_argument("index_name", help="The index alias to reindex.")
+    parser.add_argument("--full", action="store_true", help="Build a new index generation instead of updating in place.")
+    parser.add_argument("--momento-env-var-name", default="MOMENTO_API_KEY")
+    parser.add_argument("--snapshot", help="Read pages from this corpus snapshot, or latest, not the sitemaps.")
+    args = parser.parse_args()
+    run_reindex(args.index_name, args.momento_env_var_name, incremental=not args.full, snapshot=args.snapshot)
+
+
+if __name__ == "__main__":
+    main()
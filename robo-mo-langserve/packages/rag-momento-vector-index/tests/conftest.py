@@ -0,0 +1,5 @@
+import os
+
+# Importing the package imports the chain, which requires the key to be set. The chain only
+# creates its clients on first use, so the tests never use the key.
+os.environ.setdefault("MOMENTO_API_KEY", "unused")
@@ -0,0 +1,141 @@
+import asyncio
+import importlib
+import math
+from typing import Iterator
+
+import pytest
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import RunnableGenerator, RunnableLambda
+
+from rag_momento_vector_index import answer_cache
+from rag_momento_vector_index.answer_cache import SemanticAnswerCache, with_answer_cache
+
+
+def at_angle(degrees: float) -> list[float]:
+    return [math.cos(math.radians(degrees)), math.sin(math.radians(degrees))]
+
+
+# Questions embedded at an angle to "What is Momento?", whose cosine similarity is cos(angle).
+VECTORS = {
+    "What is Momento?": at_angle(0),
+    "what is momento": at_angle(10),  # 0.985
+    "What is Momento Cache?": at_angle(16),  # 0.961
+    "How do topics work?": at_angle(90),
+}
+
+
+class FakeEmbeddings(Embeddings):
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [VECTORS[text] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return VECTORS[text]
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(answer_cache, "time", clock)
+    return clock
+
+
+def new_cache(version: str = "g1#1", **kwargs) -> SemanticAnswerCache:
+    versions = {"current": version}
+    cache = SemanticAnswerCache(FakeEmbeddings(), index_version=lambda: versions["current"], **kwargs)
+    cache.versions = versions  # type: ignore[attr-defined]
+    return cache
+
+
+def test_enabled_by_default_with_a_strict_threshold() -> None:
+    assert answer_cache.ANSWER_CACHE_ENABLED
+    assert answer_cache.ANSWER_CACHE_SIMILARITY_THRESHOLD == 0.97
+
+
+def test_answers_only_questions_above_the_threshold(clock: Clock) -> None:
+    cache = new_cache()
+    cache.store("What is Momento?", "A serverless cache.")
+    assert cache.lookup("What is Momento?") == "A serverless cache."
+    assert cache.lookup("what is momento") == "A serverless cache."
+    assert cache.lookup("What is Momento Cache?") is None
+    assert cache.lookup("How do topics work?") is None
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2
+
+
+def test_entries_expire_after_the_ttl(clock: Clock) -> None:
+    cache = new_cache(ttl_seconds=60)
+    cache.store("What is Momento?", "A serverless cache.")
+    clock.now += 59
+    assert cache.lookup("What is Momento?") == "A serverless cache."
+    clock.now += 1
+    assert cache.lookup("What is Momento?") is None
+
+
+def test_a_new_index_version_clears_the_cache(clock: Clock) -> None:
+    cache = new_cache()
+    cache.store("What is Momento?", "A serverless cache.")
+    assert cache.lookup("What is Momento?") == "A serverless cache."
+    cache.versions["current"] = "g1#2"  # type: ignore[attr-defined]
+    assert cache.lookup("What is Momento?") is None
+    cache.store("What is Momento?", "A serverless cache and topics.")
+    assert cache.lookup("what is momento") == "A serverless cache and topics."
+
+
+def test_the_least_recently_used_entry_is_replaced_when_full(clock: Clock) -> None:
+    cache = new_cache(max_entries=2)
+    cache.store("What is Momento?", "first")
+    clock.now += 1
+    cache.store("How do topics work?", "second")
+    clock.now += 1
+    assert cache.lookup("What is Momento?") == "first"
+    clock.now += 1
+    cache.store("What is Momento Cache?", "third")
+    assert cache.lookup("How do topics work?") is None
+    assert cache.lookup("What is Momento?") == "first"
+
+
+def test_with_answer_cache_stores_streamed_answers_and_replays_them(clock: Clock) -> None:
+    calls = []
+
+    def answer(_input: Iterator[str]) -> Iterator[str]:
+        calls.append(1)
+        yield from ["A serverless ", "cache."]
+
+    cache = new_cache()
+    cached_chain = with_answer_cache(RunnableGenerator(answer), cache)
+    assert "".join(cached_chain.stream("What is Momento?")) == "A serverless cache."
+    assert "".join(cached_chain.stream("what is momento")) == "A serverless cache."
+    assert len(calls) == 1
+
+
+def test_with_answer_cache_stores_nothing_when_the_chain_fails(clock: Clock) -> None:
+    def fail(_question: str) -> str:
+        raise RuntimeError("search failed")
+
+    cache = new_cache()
+    with pytest.raises(RuntimeError):
+        with_answer_cache(RunnableLambda(fail), cache).invoke("What is Momento?")
+    assert cache.lookup("What is Momento?") is None
+
+
+def test_a_failed_search_raises_rather_than_finding_nothing(monkeypatch: pytest.MonkeyPatch) -> None:
+    class SearchError:
+        inner_exception = RuntimeError("MVI is unavailable")
+
+    class Client:
+        async def search(self, *args, **kwargs) -> SearchError:
+            return SearchError()
+
+    # The package exports the chain runnable under the name of its module.
+    chain = importlib.import_module("rag_momento_vector_index.chain")
+    monkeypatch.setattr(chain, "async_vector_index_client", lambda: Client())
+    monkeypatch.setattr(chain.index_resolver, "resolve", lambda: "momento")
+    with pytest.raises(RuntimeError, match="MVI is unavailable"):
+        asyncio.run(chain.avector_search("What is Momento?", at_angle(0)))
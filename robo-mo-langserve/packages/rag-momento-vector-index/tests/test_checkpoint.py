@@ -0,0 +1,53 @@
+from pathlib import Path
+
+from langchain.docstore.document import Document
+
+from rag_momento_vector_index.checkpoint import IngestCheckpoint
+from rag_momento_vector_index.manifest import PageEntry
+
+CHUNK = Document(page_content="Cache.", metadata={"source": "a", "start_index": 0})
+
+
+def write_partial_run(path: str) -> None:
+    """Records two pages of an ingest into momento-g2, then stops as if the process was killed."""
+    checkpoint = IngestCheckpoint.open(path, "momento-g2", incremental=False, vectors=True)
+    checkpoint.record("a", PageEntry("hash-a", {"a, chunk=0": "hash-0"}), [CHUNK], [[1.0, 0.5]], [])
+    checkpoint.record("b", PageEntry("hash-b"), [], [], ["b, chunk=0"])
+    checkpoint.commit()
+    checkpoint._file.write('{"source": "c", "content_')
+    checkpoint.close()
+
+
+def test_resumes_a_partial_run(tmp_path: Path) -> None:
+    path = str(tmp_path / "momento.checkpoint.jsonl")
+    write_partial_run(path)
+
+    checkpoint = IngestCheckpoint.open(path, "momento-g2", incremental=False, vectors=True)
+    assert list(checkpoint.pages) == ["a", "b"]
+    a, b = checkpoint.pages["a"], checkpoint.pages["b"]
+    assert a.entry == PageEntry("hash-a", {"a, chunk=0": "hash-0"})
+    assert a.upserted == [CHUNK] and a.vectors == [[1.0, 0.5]] and a.deleted == []
+    assert b.entry == PageEntry("hash-b") and b.upserted == [] and b.deleted == ["b, chunk=0"]
+
+    # Resuming rewrites the journal without the line cut short, so pages recorded now are read back.
+    checkpoint.record("c", PageEntry("hash-c"), [], [], [])
+    checkpoint.commit()
+    checkpoint.close()
+    resumed = IngestCheckpoint.load(path)
+    assert resumed is not None and list(resumed.pages) == ["a", "b", "c"]
+
+
+def test_starts_over_for_an_ingest_of_another_kind(tmp_path: Path) -> None:
+    path = str(tmp_path / "momento.checkpoint.jsonl")
+    for index_name, incremental in [("momento-g2", True), ("momento-g3", False)]:
+        write_partial_run(path)
+        checkpoint = IngestCheckpoint.open(path, index_name, incremental=incremental, vectors=True)
+        checkpoint.close()
+        assert checkpoint.pages == {}
+
+
+def test_remove(tmp_path: Path) -> None:
+    path = tmp_path / "momento.checkpoint.jsonl"
+    write_partial_run(str(path))
+    IngestCheckpoint.open(str(path), "momento-g2", incremental=False, vectors=True).remove()
+    assert not path.exists()
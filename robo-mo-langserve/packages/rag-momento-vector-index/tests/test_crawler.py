@@ -0,0 +1,203 @@
+import asyncio
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, unused_port
+
+from rag_momento_vector_index.crawler import CachedPage, CrawlCache, HostLimiter, SitemapCrawler, SitemapSource
+
+Handler = Callable[[web.Request], Awaitable[web.Response]]
+
+
+class Site:
+    """A local site with a sitemap of `pages`, each served by its handler, which records the
+    requests it gets."""
+
+    def __init__(self, pages: dict[str, Handler], lastmods: Optional[dict[str, str]] = None):
+        self.pages = pages
+        self.lastmods = lastmods or {}
+        self.requests: list[web.Request] = []
+        self.port = unused_port()
+
+    def url(self, name: str) -> str:
+        return f"http://127.0.0.1:{self.port}/{name}"
+
+    async def sitemap(self, _request: web.Request) -> web.Response:
+        entries = "".join(
+            f"<url><loc>{self.url(name)}</loc>"
+            + (f"<lastmod>{self.lastmods[name]}</lastmod>" if name in self.lastmods else "")
+            + "</url>"
+            for name in self.pages
+        )
+        return web.Response(text=f"<urlset>{entries}</urlset>", content_type="application/xml")
+
+    async def page(self, request: web.Request) -> web.Response:
+        self.requests.append(request)
+        return await self.pages[request.match_info["name"]](request)
+
+    def requests_for(self, name: str) -> list[web.Request]:
+        return [request for request in self.requests if request.match_info["name"] == name]
+
+    async def crawl(self, crawler: SitemapCrawler) -> dict[str, str]:
+        """Crawls the site, returning the content of each page by name."""
+        app = web.Application()
+        app.router.add_get("/sitemap.xml", self.sitemap)
+        app.router.add_get("/{name}", self.page)
+        server = TestServer(app, host="127.0.0.1", port=self.port)
+        await server.start_server()
+        try:
+            documents = await crawler.crawl([SitemapSource(self.url("sitemap.xml"))])
+        finally:
+            await server.close()
+        return {document.metadata["source"].rsplit("/", 1)[1]: document.page_content for document in documents}
+
+
+def respond(text: str = "", status: int = 200, **headers: str) -> Handler:
+    async def handler(_request: web.Request) -> web.Response:
+        return web.Response(text=text, status=status, headers=headers)
+
+    return handler
+
+
+def respond_in_turn(*handlers: Handler) -> Handler:
+    """Answers each request with the next handler, and with the last one from then on."""
+    remaining = list(handlers)
+
+    async def handler(request: web.Request) -> web.Response:
+        return await (remaining.pop(0) if len(remaining) > 1 else remaining[0])(request)
+
+    return handler
+
+
+def new_crawler(cache: Optional[CrawlCache] = None, **kwargs) -> SitemapCrawler:
+    return SitemapCrawler(cache, **{"max_retries": 2, "backoff_seconds": 0.001, **kwargs})
+
+
+def test_retries_transient_failures() -> None:
+    site = Site({"page": respond_in_turn(respond(status=503), respond(status=429), respond("<p>Momento</p>"))})
+    crawler = new_crawler()
+    assert asyncio.run(site.crawl(crawler)) == {"page": "Momento"}
+    assert len(site.requests_for("page")) == 3
+    assert crawler.stats.retries == 2 and crawler.stats.fetched == 1
+
+
+def test_waits_as_long_as_retry_after_says() -> None:
+    times = []
+
+    async def page(_request: web.Request) -> web.Response:
+        times.append(time.monotonic())
+        if len(times) == 1:
+            return web.Response(status=429, headers={"Retry-After": "0.3"})
+        return web.Response(text="<p>Momento</p>")
+
+    assert asyncio.run(Site({"page": page}).crawl(new_crawler())) == {"page": "Momento"}
+    assert times[1] - times[0] >= 0.3
+
+
+def test_does_not_retry_client_errors() -> None:
+    site = Site({"page": respond(status=403)})
+    crawler = new_crawler()
+    assert asyncio.run(site.crawl(crawler)) == {}
+    assert len(site.requests_for("page")) == 1
+    assert crawler.stats.retries == 0
+
+
+def test_bounds_the_requests_in_flight_to_a_host() -> None:
+    in_flight, most_in_flight = 0, 0
+
+    async def slow(_request: web.Request) -> web.Response:
+        nonlocal in_flight, most_in_flight
+        in_flight += 1
+        most_in_flight = max(most_in_flight, in_flight)
+        await asyncio.sleep(0.02)
+        in_flight -= 1
+        return web.Response(text="<p>Momento</p>")
+
+    site = Site({f"page-{i}": slow for i in range(12)})
+    crawler = new_crawler(concurrency_per_host=3, requests_per_second_per_host=0)
+    assert len(asyncio.run(site.crawl(crawler))) == 12
+    assert most_in_flight == 3
+
+
+def test_host_limiter_spaces_out_requests() -> None:
+    starts = []
+
+    async def request(limiter: HostLimiter) -> None:
+        async with limiter.acquire():
+            starts.append(time.monotonic())
+
+    async def run() -> None:
+        limiter = HostLimiter(concurrency=5, requests_per_second=20)
+        await asyncio.gather(*(request(limiter) for _ in range(5)))
+
+    asyncio.run(run())
+    gaps = [later - earlier for earlier, later in zip(starts, starts[1:])]
+    # Allowing for the resolution of the event loop's clock.
+    assert min(gaps) >= 0.045
+
+
+def test_revalidates_cached_pages_with_their_etag(tmp_path: Path) -> None:
+    async def page(request: web.Request) -> web.Response:
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.Response(text="<p>Momento</p>", headers={"ETag": '"v1"'})
+
+    site = Site({"page": page})
+    cache = CrawlCache(str(tmp_path / "crawl.sqlite3"))
+    assert asyncio.run(site.crawl(new_crawler(cache))) == {"page": "Momento"}
+    crawler = new_crawler(cache)
+    assert asyncio.run(site.crawl(crawler)) == {"page": "Momento"}
+    assert site.requests_for("page")[1].headers["If-None-Match"] == '"v1"'
+    assert crawler.stats.not_modified == 1 and crawler.stats.fetched == 0
+
+
+def test_revalidates_cached_pages_with_their_last_modified_date(tmp_path: Path) -> None:
+    last_modified = "Wed, 01 May 2024 00:00:00 GMT"
+    site = Site({"page": respond("<p>Momento</p>", **{"Last-Modified": last_modified})})
+    cache = CrawlCache(str(tmp_path / "crawl.sqlite3"))
+    asyncio.run(site.crawl(new_crawler(cache)))
+    asyncio.run(site.crawl(new_crawler(cache)))
+    assert site.requests_for("page")[1].headers["If-Modified-Since"] == last_modified
+
+
+def test_skips_pages_whose_sitemap_lastmod_did_not_change(tmp_path: Path) -> None:
+    site = Site({"page": respond("<p>Momento</p>")}, lastmods={"page": "2024-05-01"})
+    cache = CrawlCache(str(tmp_path / "crawl.sqlite3"))
+    asyncio.run(site.crawl(new_crawler(cache)))
+    crawler = new_crawler(cache)
+    assert asyncio.run(site.crawl(crawler)) == {"page": "Momento"}
+    assert len(site.requests_for("page")) == 1
+    assert crawler.stats.skipped_by_lastmod == 1
+
+    site.lastmods["page"] = "2024-06-01"
+    asyncio.run(site.crawl(new_crawler(cache)))
+    assert len(site.requests_for("page")) == 2
+
+
+def test_only_404_and_410_mean_a_page_is_gone(tmp_path: Path) -> None:
+    site = Site(
+        {
+            "ok": respond("<p>ok</p>"),
+            "not-found": respond(status=404),
+            "gone": respond(status=410),
+            "down": respond(status=503),
+            "cached-down": respond(status=500),
+            "unreachable": respond(status=429),
+        }
+    )
+    cache = CrawlCache(str(tmp_path / "crawl.sqlite3"))
+    for name in ["not-found", "cached-down"]:
+        cache.put(CachedPage(site.url(name), f"<p>old {name}</p>"))
+    crawler = new_crawler(cache)
+    assert asyncio.run(site.crawl(crawler)) == {"ok": "ok", "cached-down": "old cached-down"}
+    assert sorted(crawler.unavailable_sources()) == [site.url("down"), site.url("unreachable")]
+    assert crawler.stats.served_from_cache == 1
+    assert sorted(url.rsplit("/", 1)[1] for url in crawler.stats.failed) == [
+        "cached-down",
+        "down",
+        "gone",
+        "not-found",
+        "unreachable",
+    ]
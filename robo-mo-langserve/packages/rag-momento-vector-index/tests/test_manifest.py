@@ -0,0 +1,60 @@
+from pathlib import Path
+
+from langchain.docstore.document import Document
+
+from rag_momento_vector_index.manifest import IndexManifest, content_hash
+
+
+def page(source: str, text: str) -> Document:
+    return Document(page_content=text, metadata={"source": source})
+
+
+def chunk(source: str, start_index: int, text: str) -> Document:
+    return Document(page_content=text, metadata={"source": source, "start_index": start_index})
+
+
+def new_manifest() -> IndexManifest:
+    return IndexManifest.build(
+        "momento",
+        [page("a", "Cache. Topics."), page("b", "Vector index.")],
+        [chunk("a", 0, "Cache."), chunk("a", 7, "Topics."), chunk("b", 0, "Vector index.")],
+    )
+
+
+def test_page_changed() -> None:
+    manifest = new_manifest()
+    assert not manifest.page_changed(page("a", "Cache. Topics."))
+    assert manifest.page_changed(page("a", "Cache. Topics. Storage."))
+    assert manifest.page_changed(page("c", "Cache. Topics."))
+
+
+def test_update_page_returns_only_the_chunks_to_upsert_and_delete() -> None:
+    manifest = new_manifest()
+    upsert, delete = manifest.update_page(page("a", "Cache! Topics."), [chunk("a", 0, "Cache!")])
+    assert [chunk.page_content for chunk in upsert] == ["Cache!"]
+    assert delete == ["a, chunk=7"]
+    assert manifest.pages["a"].content_hash == content_hash("Cache! Topics.")
+    assert manifest.pages["a"].chunks == {"a, chunk=0": content_hash("Cache!")}
+
+
+def test_remove_pages_not_in() -> None:
+    manifest = new_manifest()
+    assert manifest.remove_pages_not_in({"b", "c"}) == ["a, chunk=0", "a, chunk=7"]
+    assert list(manifest.pages) == ["b"]
+    assert manifest.remove_pages_not_in({"b"}) == []
+
+
+def test_save_and_load(tmp_path: Path) -> None:
+    manifest = new_manifest()
+    path = str(tmp_path / "manifests" / "momento.json")
+    manifest.save(path)
+    loaded = IndexManifest.load(path)
+    assert loaded is not None
+    assert loaded.index_name == "momento" and loaded.pages == manifest.pages
+
+
+def test_load_ignores_missing_and_unreadable_manifests(tmp_path: Path) -> None:
+    path = tmp_path / "momento.json"
+    assert IndexManifest.load(str(path)) is None
+    path.write_text('{"version": 1, "pages"')
+    assert IndexManifest.load(str(path)) is None
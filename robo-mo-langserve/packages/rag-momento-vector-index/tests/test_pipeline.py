@@ -0,0 +1,117 @@
+from pathlib import Path
+from typing import AsyncIterator
+
+from langchain.docstore.document import Document
+from langchain_core.embeddings import Embeddings
+
+from rag_momento_vector_index.checkpoint import IngestCheckpoint
+from rag_momento_vector_index.manifest import IndexManifest
+from rag_momento_vector_index.pipeline import IngestPipeline
+
+
+def page(source: str, text: str) -> Document:
+    return Document(page_content=text, metadata={"source": source})
+
+
+def split(documents: list[Document]) -> list[Document]:
+    """One chunk per sentence."""
+    chunks = []
+    for document in documents:
+        start = 0
+        for sentence in document.page_content.split(". "):
+            chunks.append(Document(page_content=sentence, metadata={**document.metadata, "start_index": start}))
+            start += len(sentence) + 2
+    return chunks
+
+
+class Crawler:
+    def __init__(self, pages: list[Document], unavailable: list[str]):
+        self.pages = pages
+        self.unavailable = unavailable
+
+    async def iter_documents(self, _sources: list) -> AsyncIterator[Document]:
+        for document in self.pages:
+            yield document
+
+    def unavailable_sources(self) -> list[str]:
+        return list(self.unavailable)
+
+
+class FakeEmbeddings(Embeddings):
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return [float(len(text)), 1.0]
+
+
+class Client:
+    """Records the ids upserted into and deleted from the index."""
+
+    def __init__(self) -> None:
+        self.upserted: list[str] = []
+        self.deleted: list[str] = []
+
+    def create_index(self, *_args) -> object:
+        return object()
+
+    def upsert_item_batch(self, _index_name: str, items: list) -> object:
+        self.upserted.extend(item.id for item in items)
+        return object()
+
+    def delete_item_batch(self, _index_name: str, ids: list[str]) -> object:
+        self.deleted.extend(ids)
+        return object()
+
+
+PAGES = {
+    "same": "Cache. Topics",
+    "changed": "Cache. Topics",
+    "down": "Storage",
+    "gone": "Leaderboards. Webhooks",
+}
+
+
+def indexed_manifest() -> IndexManifest:
+    documents = [page(source, text) for source, text in PAGES.items()]
+    return IndexManifest.build("momento", documents, split(documents))
+
+
+def ingest(pages: list[Document], unavailable: list[str], **kwargs) -> tuple[IngestPipeline, Client]:
+    client = Client()
+    pipeline = IngestPipeline([], Crawler(pages, unavailable), split, FakeEmbeddings(), client, "momento", **kwargs)
+    pipeline.run()
+    return pipeline, client
+
+
+def test_deletes_only_the_chunks_of_pages_that_are_gone_or_changed() -> None:
+    manifest = indexed_manifest()
+    pages = [page("same", PAGES["same"]), page("changed", "Cache"), page("new", "Vector index")]
+    _pipeline, client = ingest(pages, unavailable=["down"], manifest=manifest)
+    assert sorted(client.upserted) == ["new, chunk=0"]
+    assert sorted(client.deleted) == ["changed, chunk=7", "gone, chunk=0", "gone, chunk=14"]
+    assert sorted(manifest.pages) == ["changed", "down", "new", "same"]
+
+
+def test_a_crawl_that_fetched_nothing_deletes_nothing_it_could_not_fetch() -> None:
+    manifest = indexed_manifest()
+    _pipeline, client = ingest([], unavailable=list(PAGES), manifest=manifest)
+    assert client.deleted == []
+    assert sorted(manifest.pages) == sorted(PAGES)
+
+
+def test_resumes_from_a_checkpoint_without_upserting_again(tmp_path: Path) -> None:
+    path = str(tmp_path / "momento.checkpoint.jsonl")
+    pages = [page(source, text) for source, text in PAGES.items()]
+    checkpoint = IngestCheckpoint.open(path, "momento", incremental=False, vectors=False)
+    _pipeline, client = ingest(pages[:2], unavailable=[], checkpoint=checkpoint)
+    checkpoint.close()
+    assert len(client.upserted) == 4
+
+    checkpoint = IngestCheckpoint.open(path, "momento", incremental=False, vectors=False)
+    pipeline, client = ingest(pages, unavailable=[], checkpoint=checkpoint)
+    checkpoint.close()
+    assert sorted(client.upserted) == ["down, chunk=0", "gone, chunk=0", "gone, chunk=14"]
+    assert client.deleted == []
+    assert pipeline.progress()["pages_resumed"] == 2
+    assert sorted(pipeline.manifest.pages) == sorted(PAGES)
@@ -0,0 +1,112 @@
+import asyncio
+import random
+import re
+
+import pytest
+
+from rag_momento_vector_index.postprocess import SourcesRewriter, rewrite_sources, sources_rewriter
+
+
+def postprocess(response: str) -> str:
+    """The whole-answer postprocessing that the chain ran before answers were streamed."""
+    response = re.sub(r"SOURCES:\s*$", "", response)
+    response = re.sub(r"Source:(\s*-?\[.*?\]\(http)", "SOURCES:\\1", response)
+    response = re.sub(r"SOURCES:(\s)", "\n\n*SOURCES*:\\1", response)
+    return response
+
+
+ANSWERS = [
+    "",
+    "Momento Cache is a serverless cache.",
+    "Use the CacheClient.\nSOURCES:",
+    "Use the CacheClient.\nSOURCES: \n",
+    "Use the CacheClient.\nSOURCES:\n- [Cache](https://docs.momentohq.com/cache)",
+    "Use the CacheClient.\nSOURCES: https://docs.momentohq.com/cache",
+    "Use the CacheClient.\nSource: [Cache](https://docs.momentohq.com/cache)",
+    "Use the CacheClient.\nSource:- [Cache](https://docs.momentohq.com/cache)",
+    "Use the CacheClient.\nSource:\n[Cache](http://docs.momentohq.com/cache)",
+    "Use the CacheClient.\nSource: [Cache] (https://docs.momentohq.com/cache)",
+    "Use the CacheClient.\nSource: [Cache\n](https://docs.momentohq.com/cache)",
+    "Use the CacheClient.\nSource: the Momento docs",
+    "Use the CacheClient.\nSource: [Cache](ftp://docs.momentohq.com/cache)",
+    "Use the CacheClient.\nSource: [Cache",
+    "Use the CacheClient.\nSource:",
+    "Use the CacheClient.\nSour",
+    "Sources: Source: [A](https://a.example) and Source: [B](https://b.example)\nSOURCES:",
+    "SOURCES:SOURCES: x\nSource:Source: [A](http://a)SOURCES:\t",
+]
+
+
+def stream_rewrite(chunks: list[str]) -> str:
+    rewriter = SourcesRewriter()
+    return "".join(rewriter.feed(chunk) for chunk in chunks) + rewriter.finish()
+
+
+def split_at(text: str, offsets: tuple[int, ...]) -> list[str]:
+    bounds = [0, *offsets, len(text)]
+    return [text[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+@pytest.mark.parametrize("answer", ANSWERS)
+def test_rewrite_sources_matches_postprocess(answer: str) -> None:
+    assert rewrite_sources(answer) == postprocess(answer)
+
+
+@pytest.mark.parametrize("answer", ANSWERS)
+def test_split_at_every_offset(answer: str) -> None:
+    expected = postprocess(answer)
+    for offset in range(len(answer) + 1):
+        assert stream_rewrite(split_at(answer, (offset,))) == expected, offset
+
+
+@pytest.mark.parametrize("answer", ANSWERS)
+def test_split_at_every_pair_of_offsets_around_markers(answer: str) -> None:
+    expected = postprocess(answer)
+    # Every split of the text around each marker, from a few characters before it to a few after.
+    offsets = sorted(
+        {
+            offset
+            for marker in re.finditer(r"Source:|SOURCES:", answer)
+            for offset in range(max(0, marker.start() - 2), min(len(answer), marker.end() + 3) + 1)
+        }
+    )
+    for i, first in enumerate(offsets):
+        for second in offsets[i:]:
+            assert stream_rewrite(split_at(answer, (first, second))) == expected, (first, second)
+
+
+@pytest.mark.parametrize("answer", ANSWERS)
+def test_one_character_at_a_time(answer: str) -> None:
+    assert stream_rewrite(list(answer)) == postprocess(answer)
+
+
+def test_random_answers_and_splits() -> None:
+    rng = random.Random(0)
+    fragments = ["Source:", "SOURCES:", "Sour", "SOURCES", " ", "\n", "-", "[", "]", "(", "http", "s://a)", "x", "\t"]
+    for _ in range(2000):
+        answer = "".join(rng.choice(fragments) for _ in range(rng.randint(0, 12)))
+        offsets = tuple(sorted(rng.randint(0, len(answer)) for _ in range(rng.randint(0, 4))))
+        assert stream_rewrite(split_at(answer, offsets)) == postprocess(answer), (answer, offsets)
+
+
+def test_releases_text_before_an_undecided_marker() -> None:
+    rewriter = SourcesRewriter()
+    assert rewriter.feed("Use the CacheClient.\nSour") == "Use the CacheClient.\n"
+    assert rewriter.feed("ce: [Cache") == ""
+    assert rewriter.feed("](https://docs.momentohq.com)") == "\n\n*SOURCES*: [Cache](https://docs.momentohq.com)"
+    assert rewriter.finish() == ""
+
+
+@pytest.mark.parametrize("answer", ANSWERS)
+def test_runnable_streams_the_same_answer(answer: str) -> None:
+    chunks = split_at(answer, tuple(range(3, len(answer), 3)))
+
+    async def astream() -> str:
+        async def input():
+            for chunk in chunks:
+                yield chunk
+
+        return "".join([chunk async for chunk in sources_rewriter().atransform(input())])
+
+    assert "".join(sources_rewriter().transform(iter(chunks))) == postprocess(answer)
+    assert asyncio.run(astream()) == postprocess(answer)
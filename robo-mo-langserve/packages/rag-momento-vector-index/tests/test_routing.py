@@ -0,0 +1,108 @@
+import asyncio
+from typing import AsyncIterator, Iterator
+
+import pytest
+from langchain_core.prompt_values import StringPromptValue
+from langchain_core.runnables import RunnableGenerator
+
+from rag_momento_vector_index.metrics import LLM_FALLBACKS
+from rag_momento_vector_index.routing import question_kind, term_support, with_fallback
+
+PROMPT = StringPromptValue(text="QUESTION: What is Momento Cache?")
+TIMEOUT_SECONDS = 0.05
+
+
+def model(chunks: list[str], first_token_delay: float = 0.0, fail: bool = False) -> RunnableGenerator:
+    """A fake streaming model, which waits `first_token_delay` seconds before its first chunk."""
+
+    def stream(_input: Iterator) -> Iterator[str]:
+        if fail:
+            raise RuntimeError("model failed")
+        yield from chunks
+
+    async def astream(_input: AsyncIterator) -> AsyncIterator[str]:
+        await asyncio.sleep(first_token_delay)
+        if fail:
+            raise RuntimeError("model failed")
+        for chunk in chunks:
+            yield chunk
+
+    return RunnableGenerator(stream, astream)
+
+
+async def collect(primary: RunnableGenerator, secondary: RunnableGenerator) -> list[str]:
+    llm = with_fallback(primary, secondary, "fast", first_token_timeout_seconds=TIMEOUT_SECONDS)
+    return [chunk async for chunk in llm.astream(PROMPT)]
+
+
+@pytest.fixture(autouse=True)
+def reset_fallbacks() -> None:
+    LLM_FALLBACKS.drain()
+
+
+def fallbacks_so_far() -> dict:
+    """The fallbacks counted during the test, by tier and reason."""
+    state = LLM_FALLBACKS.drain()
+    LLM_FALLBACKS.merge(state)
+    return {tuple(key): value for key, value in state}
+
+
+def test_streams_the_primary_model() -> None:
+    chunks = asyncio.run(collect(model(["Momento ", "Cache"]), model(["fallback"])))
+    assert chunks == ["Momento ", "Cache"]
+    assert fallbacks_so_far() == {}
+
+
+def test_falls_back_when_the_first_token_is_late() -> None:
+    primary = model(["too late"], first_token_delay=TIMEOUT_SECONDS * 20)
+    chunks = asyncio.run(collect(primary, model(["fallback ", "answer"])))
+    assert chunks == ["fallback ", "answer"]
+    assert fallbacks_so_far() == {("fast", "timeout"): 1.0}
+
+
+def test_falls_back_when_the_primary_model_fails() -> None:
+    chunks = asyncio.run(collect(model([], fail=True), model(["fallback"])))
+    assert chunks == ["fallback"]
+    assert fallbacks_so_far() == {("fast", "error"): 1.0}
+
+
+def test_does_not_retry_once_the_first_token_streamed() -> None:
+    async def slow_after_first_token(_input: AsyncIterator) -> AsyncIterator[str]:
+        yield "Momento "
+        await asyncio.sleep(TIMEOUT_SECONDS * 4)
+        yield "Cache"
+
+    primary = RunnableGenerator(slow_after_first_token)
+    assert asyncio.run(collect(primary, model(["fallback"]))) == ["Momento ", "Cache"]
+    assert fallbacks_so_far() == {}
+
+
+def test_an_empty_answer_is_not_retried() -> None:
+    assert asyncio.run(collect(model([]), model(["fallback"]))) == []
+    assert fallbacks_so_far() == {}
+
+
+def test_sync_calls_fall_back_on_errors() -> None:
+    llm = with_fallback(model([], fail=True), model(["fallback"]), "fast", TIMEOUT_SECONDS)
+    assert "".join(llm.stream(PROMPT)) == "fallback"
+    llm = with_fallback(model(["Momento"]), model(["fallback"]), "fast", TIMEOUT_SECONDS)
+    assert "".join(llm.stream(PROMPT)) == "Momento"
+
+
+@pytest.mark.parametrize(
+    "question, kind",
+    [
+        ("What is Momento Cache?", "lookup"),
+        ("Why does my client raise an exception on connect?", "troubleshooting"),
+        ("Momento Cache vs. Redis", "comparison"),
+        ("Show me an example of `set_if_not_exists`", "code"),
+    ],
+)
+def test_question_kind(question: str, kind: str) -> None:
+    assert question_kind(question) == kind
+
+
+def test_term_support() -> None:
+    assert term_support("What is the TTL of a cache item?", "Every cache item has a TTL.") == 1.0
+    assert term_support("How do topics work?", "Every cache item has a TTL.") == 0.0
+    assert term_support("How is it?", "") == 1.0
@@ -0,0 +1,49 @@
+import asyncio
+from typing import AsyncIterator, Callable
+
+from rag_momento_vector_index.single_flight import SingleFlight
+
+
+def answer(runs: list[int], delay: float = 0.01) -> Callable[[], AsyncIterator[str]]:
+    """Streams an answer, counting its runs in `runs`."""
+
+    async def produce() -> AsyncIterator[str]:
+        runs.append(1)
+        yield "A serverless "
+        await asyncio.sleep(delay)
+        yield "cache."
+
+    return produce
+
+
+def test_concurrent_questions_share_one_run() -> None:
+    runs: list[int] = []
+
+    async def ask(flights: SingleFlight, question: str) -> str:
+        return "".join([chunk async for chunk in flights.join(question, answer(runs)).follow()])
+
+    async def run() -> list[str]:
+        flights = SingleFlight()
+        answers = await asyncio.gather(ask(flights, "What is Momento?"), ask(flights, "what is momento"))
+        assert flights.in_flight() == 0
+        return answers
+
+    assert asyncio.run(run()) == ["A serverless cache.", "A serverless cache."]
+    assert len(runs) == 1
+
+
+def test_a_flight_everyone_left_is_not_joined_while_it_is_cancelled() -> None:
+    runs: list[int] = []
+
+    async def run() -> str:
+        flights = SingleFlight()
+        first = flights.join("What is Momento?", answer(runs))
+        stream = first.follow()
+        assert await stream.__anext__() == "A serverless "
+        await stream.aclose()
+        second = flights.join("What is Momento?", answer(runs))
+        assert second is not first
+        return "".join([chunk async for chunk in second.follow()])
+
+    assert asyncio.run(run()) == "A serverless cache."
+    assert len(runs) == 2
@@ -0,0 +1,91 @@
+"""
+Measures how long the chatbot takes to render, on a cold start and on reruns.
+
+Each run starts a fresh interpreter and runs `robo_mo/chatbot.py` with Streamlit's `AppTest`,
+reporting the first script run, which includes importing and building the clients, and the
+median of the reruns that every interaction in a session triggers. Placeholder credentials are
+used, so nothing is sent over the network.
+
+    python benchmarks/startup.py --runs 5 --reruns 20 --output startup.json
+    python benchmarks/startup.py --runs 5 --baseline startup.json --tolerance 0.15
+
+With `--baseline`, the exit status is 1 if the median of either measurement got worse by more
+than `--tolerance`.
+"""
+import argparse
+import base64
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RUN_SCRIPT = """
+import json, statistics, sys, time
+from streamlit.testing.v1 import AppTest
+
+app = AppTest.from_file("robo_mo/chatbot.py", default_timeout=120)
+start = time.perf_counter()
+app.run()
+first_run_seconds = time.perf_counter() - start
+reruns = []
+for _ in range(int(sys.argv[1])):
+    start = time.perf_counter()
+    app.run()
+    reruns.append(time.perf_counter() - start)
+print(json.dumps({"first_run_seconds": first_run_seconds, "rerun_seconds": statistics.median(reruns)}))
+"""
+
+
+def measure(reruns: int) -> dict:
+    fake_key = base64.b64encode(json.dumps({"endpoint": "fake.invalid", "api_key": "fake"}).encode()).decode()
+    env = {**os.environ, "MOMENTO_API_KEY": fake_key, "OPENAI_API_KEY": "sk-benchmark"}
+    output = subprocess.run(
+        [sys.executable, "-c", RUN_SCRIPT, str(reruns)],
+        cwd=PROJECT_DIR,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes to start.")
+    parser.add_argument("--reruns", type=int, default=20, help="Reruns of the script per process.")
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="A previous --output to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    # Warm the OS file cache so the first run is not an outlier.
+    measure(1)
+    runs = [measure(args.reruns) for _ in range(args.runs)]
+    results = {"runs": args.runs, "reruns": args.reruns}
+    for key in ["first_run_seconds", "rerun_seconds"]:
+        values = [run[key] for run in runs]
+        results[key] = {"median": statistics.median(values), "min": min(values), "max": max(values)}
+        print(f"{key:17} median {results[key]['median']:.3f}s min {min(values):.3f}s max {max(values):.3f}s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = []
+        for key in ["first_run_seconds", "rerun_seconds"]:
+            old, new = baseline.get(key, {}).get("median"), results[key]["median"]
+            if old and new > old * (1 + args.tolerance):
+                found.append(f"{key}: {old:.3f}s -> {new:.3f}s")
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
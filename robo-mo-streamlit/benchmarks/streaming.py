@@ -0,0 +1,130 @@
+"""
+Compares rendering a streamed answer token by token with `StreamingMarkdownRenderer`.
+
+Answers of increasing length are generated from markdown paragraphs, lists, code blocks and a
+SOURCES section, split into tokens of a few characters, and rendered into a stand-in for a
+Streamlit container that records what would be sent to the browser. For each length it reports
+the time spent rendering, the number of element updates and the bytes they carry, for the
+previous approach of re-rendering the whole answer on every token and for the renderer.
+
+    python benchmarks/streaming.py --tokens 500 2000 8000 --output streaming.json
+
+The renderer flushes by size only here, so that the results do not depend on the machine's speed.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from typing import Callable
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+from robo_mo.streaming import CURSOR, StreamingMarkdownRenderer  # noqa: E402
+
+BLOCKS = [
+    "Momento Cache is a serverless cache: there are no nodes to size or manage, and it scales on demand.\n\n",
+    "To get started:\n\n1. Create an API key in the console.\n2. Create a cache.\n3. Set and get items.\n\n",
+    '```python\nclient.set("cache", "key", "value")\nresponse = client.get("cache", "key")\n```\n\n',
+    "- Items expire after their TTL.\n- The least recently used items are evicted first.\n\n",
+]
+SOURCES = "SOURCES: [Momento docs](https://docs.momentohq.com/cache)\n"
+
+
+class Placeholder:
+    def __init__(self, stats: dict[str, int]):
+        self.stats = stats
+
+    def markdown(self, body: str) -> "Placeholder":
+        self.stats["updates"] += 1
+        self.stats["bytes"] += len(body.encode("utf-8"))
+        return self
+
+
+class Container:
+    def __init__(self) -> None:
+        self.stats = {"updates": 0, "bytes": 0}
+
+    def empty(self) -> Placeholder:
+        return Placeholder(self.stats)
+
+
+def synthetic_tokens(count: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    text = ""
+    while len(text) < count * 4:
+        text += rng.choice(BLOCKS)
+    text = text[: count * 4] + "\n\n" + SOURCES
+    tokens, i = [], 0
+    while i < len(text):
+        size = rng.randint(1, 7)
+        tokens.append(text[i : i + size])
+        i += size
+    return tokens
+
+
+def render_whole(tokens: list[str], container: Container) -> str:
+    """What the callback handler did before: concatenate and re-render on every token."""
+    sink = container.empty()
+    response = ""
+    for token in tokens:
+        response += token
+        sink = sink.markdown(response + CURSOR)
+    response = re.sub(r"SOURCES:\s*$", "", response)
+    response = re.sub(r"Source:(\s*-?\[.*?\]\(http)", "SOURCES:\\1", response)
+    response = re.sub(r"SOURCES:(\s)", "\n\n*SOURCES*:\\1", response)
+    sink.markdown(response)
+    return response
+
+
+def render_incrementally(tokens: list[str], container: Container, flush_chars: int) -> str:
+    renderer = StreamingMarkdownRenderer(container, flush_interval_seconds=float("inf"), flush_chars=flush_chars)
+    for token in tokens:
+        renderer.feed(token)
+    return renderer.finish()
+
+
+def measure(render: Callable[[Container], str], runs: int) -> dict:
+    timings = []
+    for _ in range(runs):
+        container = Container()
+        start = time.perf_counter()
+        render(container)
+        timings.append(time.perf_counter() - start)
+    return {"seconds": min(timings), **container.stats}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, nargs="+", default=[500, 2000, 8000])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--flush-chars", type=int, default=64)
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    results = []
+    for count in args.tokens:
+        tokens = synthetic_tokens(count)
+        whole = measure(lambda container, tokens=tokens: render_whole(tokens, container), args.runs)
+        incremental = measure(
+            lambda container, tokens=tokens: render_incrementally(tokens, container, args.flush_chars), args.runs
+        )
+        if render_whole(tokens, Container()) != render_incrementally(tokens, Container(), args.flush_chars):
+            raise AssertionError(f"The renderers disagree on the answer of {count} tokens.")
+        results.append({"tokens": count, "whole": whole, "incremental": incremental})
+        for name, result in [("whole", whole), ("incremental", incremental)]:
+            print(
+                f"{count:6} tokens {name:11} {result['seconds'] * 1000:9.2f}ms "
+                f"{result['updates']:6} updates {result['bytes'] / 1e6:9.3f}MB"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
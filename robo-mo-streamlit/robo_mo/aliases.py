@@ -0,0 +1,90 @@
+"""
+Resolves the index alias that the langserve reindexer flips to each new index generation.
+
+A full reindex builds a new generation, eg `momento-g20240101000000`, validates it and points the
+alias at it in the Momento cache `INDEX_ALIAS_CACHE_NAME`. The chatbot reads the alias from the
+same cache and key as `rag_momento_vector_index.aliases`, and only goes back to the cache once
+`INDEX_ALIAS_TTL_SECONDS` have passed, so it serves the same generation as langserve. While the
+alias was never set, it is the name of the index itself. Without the cache, the chatbot has no
+alias to resolve and searches `MOMENTO_INDEX_NAME` directly.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+from functools import cached_property
+from typing import Optional
+
+from momento import CacheClient, Configurations, CredentialProvider
+from momento.responses import CacheGet, CreateCache
+
+logger = logging.getLogger(__name__)
+
+MOMENTO_INDEX_NAME = os.environ.get("MOMENTO_INDEX_NAME", "momento")
+ALIAS_CACHE_NAME = os.environ.get("INDEX_ALIAS_CACHE_NAME")
+ALIAS_TTL_SECONDS = float(os.environ.get("INDEX_ALIAS_TTL_SECONDS", "30"))
+# As in rag_momento_vector_index.aliases.MomentoCacheAliasStore.
+KEY_PREFIX = "index-alias:"
+CACHE_TTL = timedelta(days=365)
+
+
+class IndexAlias:
+    """Resolves `alias` to its active index generation, keeping the answer for `ttl_seconds`.
+
+    If the cache cannot be reached, the last known generation keeps being served.
+
+    Args:
+        alias (str): The logical index name.
+        momento_api_key (str): The key to read the alias cache with.
+        cache_name (str): The cache the aliases are kept in.
+        ttl_seconds (float): How long a resolved name is used before it is read again.
+    """
+
+    def __init__(
+        self,
+        alias: str,
+        momento_api_key: str,
+        cache_name: str,
+        ttl_seconds: float = ALIAS_TTL_SECONDS,
+    ):
+        self.alias = alias
+        self.momento_api_key = momento_api_key
+        self.cache_name = cache_name
+        self.ttl_seconds = ttl_seconds
+        self._index_name: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    @cached_property
+    def client(self) -> CacheClient:
+        client = CacheClient(
+            Configurations.InRegion.Default.latest(), CredentialProvider.from_string(self.momento_api_key), CACHE_TTL
+        )
+        response = client.create_cache(self.cache_name)
+        if isinstance(response, CreateCache.Error):
+            raise response.inner_exception
+        return client
+
+    def _get(self) -> Optional[str]:
+        response = self.client.get(self.cache_name, KEY_PREFIX + self.alias)
+        if isinstance(response, CacheGet.Hit):
+            return response.value_string
+        elif isinstance(response, CacheGet.Miss):
+            return None
+        elif isinstance(response, CacheGet.Error):
+            raise response.inner_exception
+        raise Exception(f"Unexpected response: {response}")
+
+    def resolve(self) -> str:
+        if self._index_name is not None and time.monotonic() < self._expires_at:
+            return self._index_name
+        with self._lock:
+            try:
+                self._index_name = self._get() or self.alias
+            except Exception as e:
+                if self._index_name is None:
+                    raise
+                logger.warning(f"Could not refresh alias {self.alias}, still using {self._index_name}: {e}")
+            self._expires_at = time.monotonic() + self.ttl_seconds
+            return self._index_name
@@ -1,36 +1,27 @@
 import logging
 import os
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
 
 import streamlit as st
 from dotenv import load_dotenv
-from langchain.chains import ConversationalRetrievalChain
-from langchain.chains.qa_with_sources import load_qa_with_sources_chain
-from langchain.chat_models import ChatOpenAI
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.memory import ConversationBufferMemory
-from langchain.vectorstores import MomentoVectorIndex
-from momento import (
-    CredentialProvider,
-    PreviewVectorIndexClient,
-    VectorIndexConfigurations,
-)
 
-from robo_mo.callbacks import StreamingLLMCallbackHandler
-from robo_mo.prompts import QA_PROMPT
-from robo_mo.secrets import get_secret_from_env_var_or_secrets_manager
+from robo_mo.secrets import SecretProvider
+
+if TYPE_CHECKING:
+    from langchain.embeddings import OpenAIEmbeddings
+    from langchain.memory import ConversationSummaryBufferMemory
+    from langchain.vectorstores import MomentoVectorIndex
+    from langchain_core.language_models import BaseChatModel
+    from momento import PreviewVectorIndexClient
+
+    from robo_mo.aliases import IndexAlias
+    from robo_mo.routing import RoutedCombineDocumentsChain
 
 load_dotenv()
 
-MOMENTO_API_KEY = get_secret_from_env_var_or_secrets_manager(
-    secret_env_var_name="MOMENTO_API_KEY",
-    secret_name=os.environ.get("MOMENTO_API_KEY_SECRET_NAME"),
-    aws_region=os.environ.get("AWS_REGION"),
-)
-OPENAI_API_KEY = get_secret_from_env_var_or_secrets_manager(
-    secret_env_var_name="OPENAI_API_KEY",
-    secret_name=os.environ.get("OPENAI_API_KEY_SECRET_NAME"),
-    aws_region=os.environ.get("AWS_REGION"),
-)
+# Recent turns are kept verbatim up to this many tokens, older ones as a running summary.
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "1000"))
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -40,38 +31,124 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+@st.cache_resource
+def get_secrets() -> SecretProvider:
+    """Returns the process-wide secrets, which are refreshed in the background. When a key is
+    rotated, the clients are rebuilt for the next question."""
+    secrets = SecretProvider(
+        {
+            "MOMENTO_API_KEY": os.environ.get("MOMENTO_API_KEY_SECRET_NAME"),
+            "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY_SECRET_NAME"),
+        },
+        aws_region=os.environ.get("AWS_REGION"),
+    )
+    secrets.on_rotate(lambda _: get_clients.clear())
+    secrets.start()
+    return secrets
+
+
+@dataclass
+class ChatBotClients:
+    embedder: "OpenAIEmbeddings"
+    vector_index_client: "PreviewVectorIndexClient"
+    index_alias: Optional["IndexAlias"]
+    llm: "BaseChatModel"
+    answerer: "RoutedCombineDocumentsChain"
+
+    def store(self) -> "MomentoVectorIndex":
+        """The vector store of the index generation the alias points to right now."""
+        from langchain.vectorstores import MomentoVectorIndex
+
+        from robo_mo.aliases import MOMENTO_INDEX_NAME
+
+        index_name = self.index_alias.resolve() if self.index_alias is not None else MOMENTO_INDEX_NAME
+        return MomentoVectorIndex(embedding=self.embedder, client=self.vector_index_client, index_name=index_name)
+
+
+@st.cache_resource
+def get_clients() -> ChatBotClients:
+    """Builds the clients once per process, shared by every session and rerun, and again after a
+    key is rotated.
+
+    langchain and the Momento SDK are imported here rather than at the top of the script, so
+    that the page renders before they are loaded.
+    """
+    from langchain.embeddings import OpenAIEmbeddings
+    from langchain_community.chat_models.openai import ChatOpenAI
+    from momento import (
+        CredentialProvider,
+        PreviewVectorIndexClient,
+        VectorIndexConfigurations,
+    )
+
+    from robo_mo.aliases import ALIAS_CACHE_NAME, MOMENTO_INDEX_NAME, IndexAlias
+    from robo_mo.routing import RoutedCombineDocumentsChain, build_tiers, streaming_chat_model
+
+    secrets = get_secrets().get_all()
+    openai_api_key = secrets["OPENAI_API_KEY"]
+    return ChatBotClients(
+        embedder=OpenAIEmbeddings(model="text-embedding-ada-002", openai_api_key=openai_api_key),  # type: ignore
+        vector_index_client=PreviewVectorIndexClient(
+            configuration=VectorIndexConfigurations.Default.latest(),
+            credential_provider=CredentialProvider.from_string(secrets["MOMENTO_API_KEY"]),
+        ),
+        # MOMENTO_INDEX_NAME is an alias that full reindexes flip to a new index generation, if
+        # they keep it in a cache.
+        index_alias=(
+            IndexAlias(MOMENTO_INDEX_NAME, secrets["MOMENTO_API_KEY"], ALIAS_CACHE_NAME) if ALIAS_CACHE_NAME else None
+        ),
+        llm=ChatOpenAI(temperature=0, model="gpt-3.5-turbo", openai_api_key=openai_api_key),  # type: ignore
+        # Each question is answered by the model tier its context and wording call for, see routing.py.
+        answerer=RoutedCombineDocumentsChain(tiers=build_tiers(streaming_chat_model(openai_api_key))),
+    )
+
+
+def new_memory(clients: ChatBotClients) -> "ConversationSummaryBufferMemory":
+    from langchain.memory import ConversationSummaryBufferMemory
+
+    return ConversationSummaryBufferMemory(
+        llm=clients.llm,
+        max_token_limit=HISTORY_TOKEN_BUDGET,
+        memory_key="chat_history",
+        input_key="question",
+        output_key="answer",
+        return_messages=True,
+    )
+
+
 class ChatBot:
-    """A chatbot that answers questions about caching and Momento."""
-
-    def __init__(self):
-        embedder = OpenAIEmbeddings(model="text-embedding-ada-002", openai_api_key=OPENAI_API_KEY)  # type: ignore
-        store = MomentoVectorIndex(
-            embedding=embedder,
-            client=PreviewVectorIndexClient(
-                configuration=VectorIndexConfigurations.Default.latest(),
-                credential_provider=CredentialProvider.from_string(MOMENTO_API_KEY),
-            ),
-            index_name="momento",
-        )
+    """A chatbot that answers questions about caching and Momento.
+
+    The conversation is kept in `memory`, one per browser session. Questions that do not refer
+    back to it are answered without the history, which skips rewriting them with the LLM.
+    """
+
+    def __init__(self, clients: ChatBotClients, memory: "ConversationSummaryBufferMemory"):
+        from langchain.chains import ConversationalRetrievalChain
 
-        llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo", openai_api_key=OPENAI_API_KEY)  # type: ignore
-        streaming_llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo", streaming=True, openai_api_key=OPENAI_API_KEY)  # type: ignore
-        memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
         chain = ConversationalRetrievalChain.from_llm(
-            llm=llm,
-            retriever=store.as_retriever(),
-            memory=memory,
+            llm=clients.llm,
+            retriever=clients.store().as_retriever(),
         )
-        chain.combine_docs_chain = load_qa_with_sources_chain(streaming_llm, chain_type="stuff", prompt=QA_PROMPT)
+        chain.combine_docs_chain = clients.answerer
         self.chain = chain
+        # The memory may outlive clients rebuilt after a key rotation.
+        memory.llm = clients.llm
+        self.memory = memory
 
     def __call__(self, question):
-        return self.chain({"question": question}, callbacks=[StreamingLLMCallbackHandler()])
+        from robo_mo.callbacks import StreamingLLMCallbackHandler
+        from robo_mo.conversation import needs_history
 
+        chat_history = self.memory.load_memory_variables({})["chat_history"] if needs_history(question) else []
+        result = self.chain(
+            {"question": question, "chat_history": chat_history}, callbacks=[StreamingLLMCallbackHandler()]
+        )
+        self.memory.save_context({"question": question}, {"answer": result["answer"]})
+        return result
 
-# Everything that follows is Streamlit code to display the chatbot in the browser.
-chat_bot = ChatBot()
 
+# Everything that follows is Streamlit code to display the chatbot in the browser.
 st.title("🤖🐿️💬 Robo-Mo Chat")
 
 avatars = {
@@ -94,4 +171,10 @@ if prompt := st.chat_input("Ask Mo the caching squirrel any question about cachi
         st.markdown(prompt)
 
     with st.chat_message("assistant", avatar=avatars["assistant"]):
-        chat_bot(prompt)
+        clients = get_clients()
+        if "memory" not in st.session_state:
+            st.session_state["memory"] = new_memory(clients)
+        ChatBot(clients, st.session_state.memory)(prompt)
+else:
+    # Build the clients once the page has rendered, so the first question does not wait for them.
+    get_clients()
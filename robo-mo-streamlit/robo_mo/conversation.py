@@ -0,0 +1,27 @@
+"""
+Decides whether a chat question depends on the earlier conversation.
+
+Rewriting a follow-up question into a standalone one costs an LLM call, which most questions do
+not need. This mirrors `needs_history` in the langserve app's conversation memory.
+"""
+import re
+
+# Words that usually refer back to something said earlier in the conversation.
+REFERRING_WORDS = set(
+    "it its it's they them their theirs this that these those he him his she her "
+    "above previous earlier former latter again else same instead".split()
+)
+FOLLOW_UP_OPENING = re.compile(r"^\s*(and|but|or|so|then|what about|how about|why not)\b", re.IGNORECASE)
+# Questions this short are rarely complete on their own, eg "in python?" or "why?".
+MIN_STANDALONE_WORDS = 4
+
+
+def needs_history(question: str) -> bool:
+    """Whether `question` looks like it refers to earlier turns and so must be rewritten from
+    the history before retrieval. Errs on the side of rewriting."""
+    words = re.findall(r"[a-z']+", question.lower())
+    return (
+        len(words) < MIN_STANDALONE_WORDS
+        or not REFERRING_WORDS.isdisjoint(words)
+        or FOLLOW_UP_OPENING.match(question) is not None
+    )
@@ -1,5 +1,10 @@
+import os
+
 from langchain.prompts import PromptTemplate
 
+# "full" uses the few-shot QA_PROMPT, "compact" the much shorter COMPACT_QA_PROMPT.
+PROMPT_VARIANT = os.environ.get("PROMPT_VARIANT", "full")
+
 template = """Given the following extracted parts of a long document and a question, create a final answer with references ("SOURCES").
 If you don't know the answer, just say that you don't know. Don't try to make up an answer.
 ALWAYS return a "SOURCES" part in your answer. "SOURCES" will include the URLs of the documents that you used to find the answer.
@@ -39,3 +44,24 @@ QUESTION: {question}
 =========
 FINAL ANSWER:"""
 QA_PROMPT = PromptTemplate(template=template, input_variables=["summaries", "question"])
+
+# The instructions of QA_PROMPT without its few-shot examples, for a fraction of the input tokens.
+compact_template = """Answer the question using only the extracted parts of the documents below, with references ("SOURCES").
+If you don't know the answer, just say that you don't know. Don't try to make up an answer.
+End with a "SOURCES:" line listing the URLs of the documents you used.
+Use markdown. Code blocks must name their language, and links must have link text.
+
+QUESTION: {question}
+=========
+{summaries}
+=========
+FINAL ANSWER:"""
+COMPACT_QA_PROMPT = PromptTemplate(template=compact_template, input_variables=["summaries", "question"])
+
+
+def get_qa_prompt(variant: str = PROMPT_VARIANT) -> PromptTemplate:
+    if variant == "full":
+        return QA_PROMPT
+    if variant == "compact":
+        return COMPACT_QA_PROMPT
+    raise ValueError(f"Unknown PROMPT_VARIANT {variant!r}, expected full or compact.")
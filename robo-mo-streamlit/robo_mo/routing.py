@@ -0,0 +1,183 @@
+"""
+Routes each question to a model tier once its context has been retrieved.
+
+This mirrors `rag_momento_vector_index.routing` in the langserve app, with the same environment
+variables. With `MODEL_ROUTING=true`, short lookups that the context supports go to the `fast`
+tier and its compact prompt, code, comparison and troubleshooting questions and long contexts
+to the `strong` tier if there is one, and the rest to the `standard` tier. Without routing,
+everything goes to `standard`.
+
+With `LLM_FALLBACK_MODEL` set, a tier whose model fails, or streams nothing for
+`LLM_FIRST_TOKEN_TIMEOUT_SECONDS`, answers with the fallback model instead. The chatbot runs
+its chain synchronously, so the timeout is the read timeout of the tier's streaming request,
+which is not retried.
+"""
+import logging
+import os
+import re
+import time
+from functools import lru_cache
+from typing import Any, Callable, Optional
+
+import tiktoken
+from langchain.callbacks.manager import Callbacks
+from langchain.chains.combine_documents.base import BaseCombineDocumentsChain
+from langchain.chains.qa_with_sources import load_qa_with_sources_chain
+from langchain.docstore.document import Document
+from langchain_community.chat_models.openai import ChatOpenAI
+from langchain_core.language_models import BaseChatModel
+from langchain_core.runnables import Runnable
+
+from robo_mo.prompts import PROMPT_VARIANT, get_qa_prompt
+
+logger = logging.getLogger(__name__)
+
+MODEL_ROUTING = os.environ.get("MODEL_ROUTING", "false").lower() == "true"
+ROUTING_FAST_MODEL = os.environ.get("ROUTING_FAST_MODEL", "gpt-3.5-turbo")
+ROUTING_STANDARD_MODEL = os.environ.get("ROUTING_STANDARD_MODEL", "gpt-3.5-turbo")
+# Without a strong model, the questions it would get go to the standard tier.
+ROUTING_STRONG_MODEL = os.environ.get("ROUTING_STRONG_MODEL", "")
+# Questions with less of their terms in the context than this never go to the fast tier.
+ROUTING_MIN_SUPPORT = float(os.environ.get("ROUTING_MIN_SUPPORT", "0.6"))
+ROUTING_FAST_MAX_CONTEXT_TOKENS = int(os.environ.get("ROUTING_FAST_MAX_CONTEXT_TOKENS", "600"))
+ROUTING_LONG_CONTEXT_TOKENS = int(os.environ.get("ROUTING_LONG_CONTEXT_TOKENS", "800"))
+LLM_FALLBACK_MODEL = os.environ.get("LLM_FALLBACK_MODEL", "")
+LLM_FIRST_TOKEN_TIMEOUT_SECONDS = float(os.environ.get("LLM_FIRST_TOKEN_TIMEOUT_SECONDS", "10"))
+# The timeout of each OpenAI request. 0 leaves the client's default.
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", "0"))
+
+FAST = "fast"
+STANDARD = "standard"
+STRONG = "strong"
+
+# Checked in order; a question matching none of them is a lookup.
+QUESTION_KINDS = [
+    ("troubleshooting", re.compile(r"\b(errors?|exceptions?|fail\w*|broken|debug\w*|not working)\b", re.IGNORECASE)),
+    ("comparison", re.compile(r"\b(vs\.?|versus|compare\w*|difference\w*|instead of)\b", re.IGNORECASE)),
+    ("code", re.compile(r"`|\w\(|\b(code|snippets?|examples?|implement\w*|functions?)\b", re.IGNORECASE)),
+]
+STOPWORDS = frozenset(
+    "a an and are can do does for from how i in is it my of on or the to what when where which who why with you".split()
+)
+# As in rag_momento_vector_index.lexical.tokenize.
+IDENTIFIER = re.compile(r"\w+(?:[.\-:/]\w+)*")
+CAMEL_CASE_BOUNDARY = re.compile(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])")
+
+
+@lru_cache(maxsize=None)
+def encoding() -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model("gpt-3.5-turbo")
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased words, with compound identifiers also split into their parts."""
+    tokens = []
+    for match in IDENTIFIER.finditer(text):
+        identifier = match.group()
+        parts = [
+            part for segment in re.split(r"[.\-:/_]", identifier) for part in CAMEL_CASE_BOUNDARY.split(segment) if part
+        ]
+        tokens.append(identifier.lower())
+        if len(parts) > 1 or parts and parts[0] != identifier:
+            tokens.extend(part.lower() for part in parts)
+    return tokens
+
+
+def question_kind(question: str) -> str:
+    for kind, pattern in QUESTION_KINDS:
+        if pattern.search(question):
+            return kind
+    return "lookup"
+
+
+def term_support(question: str, context: str) -> float:
+    """The share of the question's terms, other than stopwords, that occur in `context`."""
+    terms = set(tokenize(question)) - STOPWORDS
+    if not terms:
+        return 1.0
+    return len(terms & set(tokenize(context))) / len(terms)
+
+
+def route(question: str, context: str) -> tuple[str, str]:
+    """Returns the tier to answer `question` from `context` with, and why."""
+    if term_support(question, context) < ROUTING_MIN_SUPPORT:
+        return STANDARD, "weak_support"
+    if (kind := question_kind(question)) != "lookup":
+        return STRONG, kind
+    context_tokens = len(encoding().encode(context, disallowed_special=()))
+    if context_tokens > ROUTING_LONG_CONTEXT_TOKENS:
+        return STRONG, "long_context"
+    if context_tokens <= ROUTING_FAST_MAX_CONTEXT_TOKENS:
+        return FAST, "lookup"
+    return STANDARD, "lookup"
+
+
+def streaming_chat_model(openai_api_key: str) -> Callable[[str, str], Runnable]:
+    """Returns a function creating the streaming model of a tier given its model name, falling
+    back to `LLM_FALLBACK_MODEL` if there is one."""
+
+    def chat_model(model: str, **kwargs: Any) -> BaseChatModel:
+        return ChatOpenAI(  # type: ignore[call-arg]
+            temperature=0, model=model, streaming=True, openai_api_key=openai_api_key, **kwargs
+        )
+
+    def tier_model(_tier: str, model: str) -> Runnable:
+        if not LLM_FALLBACK_MODEL or LLM_FALLBACK_MODEL == model:
+            return chat_model(model, request_timeout=LLM_TIMEOUT_SECONDS or None)
+        # The fallback stands in for the retries, so a slow first token is not waited for again.
+        primary = chat_model(model, request_timeout=LLM_FIRST_TOKEN_TIMEOUT_SECONDS or None, max_retries=0)
+        return primary.with_fallbacks([chat_model(LLM_FALLBACK_MODEL, request_timeout=LLM_TIMEOUT_SECONDS or None)])
+
+    return tier_model
+
+
+def build_tiers(chat_model: Callable[[str, str], Runnable]) -> dict[str, BaseCombineDocumentsChain]:
+    """Builds the answering chains of the tiers in use, with the models `chat_model` creates
+    given a tier and a model name."""
+    tiers = {}
+    for name, model, variant in [
+        (STANDARD, ROUTING_STANDARD_MODEL, PROMPT_VARIANT),
+        (FAST, ROUTING_FAST_MODEL, "compact"),
+        (STRONG, ROUTING_STRONG_MODEL, PROMPT_VARIANT),
+    ]:
+        if not model or (name != STANDARD and not MODEL_ROUTING):
+            continue
+        # LLMChain takes any runnable, including a model with fallbacks, as its llm.
+        llm: Any = chat_model(name, model)
+        tiers[name] = load_qa_with_sources_chain(llm, chain_type="stuff", prompt=get_qa_prompt(variant))
+    return tiers
+
+
+class RoutedCombineDocumentsChain(BaseCombineDocumentsChain):
+    """Answers a question from its documents with the chain of the tier `route` picks.
+
+    `tiers` must have a standard tier, which answers whatever would go to a missing one.
+    """
+
+    tiers: dict[str, BaseCombineDocumentsChain]
+
+    def choose(self, docs: list[Document], question: str) -> tuple[str, BaseCombineDocumentsChain]:
+        if len(self.tiers) == 1:
+            return STANDARD, self.tiers[STANDARD]
+        name, reason = route(question, "\n".join(doc.page_content for doc in docs))
+        name = name if name in self.tiers else STANDARD
+        logger.info(f"Answering with the {name} tier: {reason}.")
+        return name, self.tiers[name]
+
+    def combine_docs(
+        self, docs: list[Document], callbacks: Optional[Callbacks] = None, **kwargs: Any
+    ) -> tuple[str, dict]:
+        name, chain = self.choose(docs, kwargs["question"])
+        start = time.perf_counter()
+        output = chain.combine_docs(docs, callbacks=callbacks, **kwargs)
+        logger.info(f"The {name} tier answered in {time.perf_counter() - start:.2f}s.")
+        return output
+
+    async def acombine_docs(
+        self, docs: list[Document], callbacks: Optional[Callbacks] = None, **kwargs: Any
+    ) -> tuple[str, dict]:
+        name, chain = self.choose(docs, kwargs["question"])
+        start = time.perf_counter()
+        output = await chain.acombine_docs(docs, callbacks=callbacks, **kwargs)
+        logger.info(f"The {name} tier answered in {time.perf_counter() - start:.2f}s.")
+        return output
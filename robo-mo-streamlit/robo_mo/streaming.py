@@ -0,0 +1,141 @@
+"""
+Renders a streamed answer without re-sending all of it on every token.
+
+Streamlit can only replace the content of an element, so rendering each token by setting the
+whole answer so far sends, and re-renders, a payload that grows with the answer: quadratic in
+its length overall. `StreamingMarkdownRenderer` instead coalesces tokens into flushes bounded by
+time and size, and moves every finished markdown block into an element of its own, so that a
+flush only re-sends the block still being written.
+
+The rewrites that format the SOURCES section of the answer are applied as lines complete, rather
+than to the whole answer once it is done.
+"""
+import os
+import re
+import time
+from typing import Any, Optional
+
+FLUSH_INTERVAL_SECONDS = float(os.environ.get("STREAMING_FLUSH_INTERVAL_SECONDS", "0.05"))
+FLUSH_CHARS = int(os.environ.get("STREAMING_FLUSH_CHARS", "256"))
+CURSOR = "▌"
+
+TRAILING_SOURCES = re.compile(r"SOURCES:\s*$")
+SOURCE_LINK = re.compile(r"Source:(\s*-?\[.*?\]\(http)")
+SOURCES_HEADING = re.compile(r"SOURCES:(\s)")
+# A source heading with nothing after it yet, which the rewrites above cannot decide on.
+UNRESOLVED_SOURCE = re.compile(r"(?:Source|SOURCES):\s*$")
+
+
+def rewrite_sources(text: str) -> str:
+    """Formats the SOURCES section of a complete answer."""
+    text = TRAILING_SOURCES.sub("", text)
+    return rewrite_source_lines(text)
+
+
+def rewrite_source_lines(text: str) -> str:
+    text = SOURCE_LINK.sub("SOURCES:\\1", text)
+    return SOURCES_HEADING.sub("\n\n*SOURCES*:\\1", text)
+
+
+class IncrementalSourcesRewriter:
+    """Applies `rewrite_sources` to an answer as it streams in, with the same result.
+
+    Text is released a line at a time. A source heading that nothing but whitespace follows yet
+    is held back, since whether and how it is rewritten depends on what comes next.
+    """
+
+    def __init__(self) -> None:
+        self.pending = ""
+
+    def feed(self, text: str) -> str:
+        """Adds `text` and returns the rewritten text that is now final."""
+        self.pending += text
+        end = self.pending.rfind("\n") + 1
+        if end == 0:
+            return ""
+        if (unresolved := UNRESOLVED_SOURCE.search(self.pending, 0, end)) is not None:
+            end = unresolved.start()
+        ready, self.pending = self.pending[:end], self.pending[end:]
+        return rewrite_source_lines(ready)
+
+    def finish(self) -> str:
+        """Returns the rest of the rewritten text, once the answer is complete."""
+        rest, self.pending = self.pending, ""
+        return rewrite_sources(rest)
+
+
+class StreamingMarkdownRenderer:
+    """Renders streamed markdown into `container` with bounded, incremental updates.
+
+    Tokens are buffered until `flush_interval_seconds` have passed or `flush_chars` characters
+    are waiting. Completed blocks, ie those followed by a blank line and an unindented line
+    outside of a code fence, are rendered once into their own element.
+
+    Args:
+        container (Any): A Streamlit container, eg `st.container()`, or anything else with an
+            `empty()` method returning a placeholder with a `markdown(body)` method.
+        flush_interval_seconds (float): The longest a token waits to be rendered.
+        flush_chars (int): How many characters may wait before they are rendered regardless.
+    """
+
+    def __init__(
+        self,
+        container: Any,
+        flush_interval_seconds: float = FLUSH_INTERVAL_SECONDS,
+        flush_chars: int = FLUSH_CHARS,
+    ):
+        self.container = container
+        self.flush_interval_seconds = flush_interval_seconds
+        self.flush_chars = flush_chars
+        self._rewriter = IncrementalSourcesRewriter()
+        self._unflushed: list[str] = []
+        self._unflushed_chars = 0
+        self._flushed_at = time.monotonic()
+        self._response: list[str] = []
+        self._block: list[str] = []
+        self._in_fence = False
+        self._after_blank = False
+        self._live: Optional[Any] = None
+
+    def feed(self, token: str) -> None:
+        self._unflushed.append(token)
+        self._unflushed_chars += len(token)
+        if (
+            self._unflushed_chars >= self.flush_chars
+            or time.monotonic() - self._flushed_at >= self.flush_interval_seconds
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        ready = self._rewriter.feed("".join(self._unflushed))
+        self._unflushed.clear()
+        self._unflushed_chars = 0
+        self._add_lines(ready)
+        self._render("".join(self._block) + self._rewriter.pending + CURSOR)
+        self._flushed_at = time.monotonic()
+
+    def finish(self) -> str:
+        """Renders the rest of the answer and returns the whole of it, rewritten."""
+        ready = self._rewriter.feed("".join(self._unflushed))
+        self._unflushed.clear()
+        self._add_lines(ready + self._rewriter.finish())
+        self._render("".join(self._block))
+        return "".join(self._response)
+
+    def _add_lines(self, text: str) -> None:
+        self._response.append(text)
+        for line in text.splitlines(keepends=True):
+            starts_block = line.strip() and not line[0].isspace()
+            if self._block and self._after_blank and starts_block and not self._in_fence:
+                self._render("".join(self._block))
+                self._block.clear()
+                self._live = None
+            if line.lstrip().startswith("```"):
+                self._in_fence = not self._in_fence
+            self._after_blank = not line.strip()
+            self._block.append(line)
+
+    def _render(self, body: str) -> None:
+        if self._live is None:
+            self._live = self.container.empty()
+        self._live.markdown(body)